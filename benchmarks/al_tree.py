@@ -0,0 +1,102 @@
+# coding=utf-8
+"""
+AL_ShardedPerTenantNode benchmarks:
+
+* get_tree: query count and latency by tree size, compared with the
+  former one get_children() query per node;
+* load_bulk: import time of a whole tree.
+"""
+from .utils import measure, print_table, setup
+
+setup()
+
+from shardy.tests.models import TShardedNode  # noqa: E402
+
+PID = 1
+SIZES = (50, 500, 5000)
+LOAD_SIZES = (1000, 10000, 100000)
+FANOUT = 10
+
+
+def build(size):
+    TShardedNode.objects.filter(partner_id=PID).delete()
+    nodes = [TShardedNode.objects.create(
+        partner_id=PID, desc='root', sib_order=1
+    )]
+    index = 0
+    while len(nodes) < size:
+        parent = nodes[index]
+        for order in range(1, FANOUT + 1):
+            if len(nodes) >= size:
+                break
+            nodes.append(TShardedNode.objects.create(
+                partner_id=PID, parent=parent, sib_order=order, desc='node'
+            ))
+        index += 1
+
+
+def get_tree_per_node():
+    results = []
+
+    def walk(nodes, depth):
+        for node in nodes:
+            node._cached_depth = depth
+            results.append(node)
+            walk(node.get_children(), depth + 1)
+
+    walk(TShardedNode.get_root_nodes(PID), 1)
+    return results
+
+
+def make_bulk_data(size):
+    """Tree of ``size`` nodes with FANOUT children per node, ids included"""
+    roots = [{'id': 1, 'data': {'desc': 'root'}}]
+    queue = list(roots)
+    next_id = 2
+    while queue and next_id <= size:
+        node = queue.pop(0)
+        children = node.setdefault('children', [])
+        for _ in range(FANOUT):
+            if next_id > size:
+                break
+            child = {'id': next_id, 'data': {'desc': 'node'}}
+            children.append(child)
+            queue.append(child)
+            next_id += 1
+    return roots
+
+
+def load_bulk(size):
+    TShardedNode.objects.filter(partner_id=PID).delete()
+    data = make_bulk_data(size)
+    return measure(
+        lambda: TShardedNode.load_bulk(PID, data, keep_ids=True), repeat=1
+    )
+
+
+def main():
+    rows = []
+    for size in SIZES:
+        build(size)
+        old_time, old_queries = measure(get_tree_per_node, repeat=1)
+        new_time, new_queries = measure(lambda: TShardedNode.get_tree(PID))
+        rows.append((
+            size,
+            old_queries, '{:.4f}'.format(old_time),
+            new_queries, '{:.4f}'.format(new_time),
+        ))
+    print_table(
+        ('nodes', 'per-node q', 'per-node s', 'get_tree q', 'get_tree s'),
+        rows
+    )
+    print()
+
+    rows = []
+    for size in LOAD_SIZES:
+        load_time, load_queries = load_bulk(size)
+        rows.append((size, load_queries, '{:.4f}'.format(load_time)))
+    print_table(('nodes', 'load_bulk q', 'load_bulk s'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+"""
+Column export: wall time and peak Python memory (tracemalloc) of reading
+rows as model instances, as values_list() tuples and with to_arrays().
+"""
+import datetime
+import tracemalloc
+from decimal import Decimal
+
+from .utils import measure, print_table, setup
+
+setup()
+
+from django.conf import settings  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from shardy.tests.models import TShardedMetric  # noqa: E402
+
+PID = 1
+SIZES = (10000, 100000)
+FIELDS = ['id', 'value', 'amount', 'flag', 'created', 'visits']
+
+
+def build(size):
+    TShardedMetric.objects.filter(partner_id=PID).delete()
+    created = datetime.datetime(2020, 1, 1)
+    if settings.USE_TZ:
+        created = timezone.make_aware(created, timezone.utc)
+    TShardedMetric.objects.bulk_create([
+        TShardedMetric(
+            partner_id=PID, value=i * 0.5, amount=Decimal(i % 100),
+            flag=bool(i % 2), created=created, day=created.date(),
+            visits=i, label='x',
+        )
+        for i in range(size)
+    ], batch_size=500)
+
+
+def queryset():
+    return TShardedMetric.objects.filter(partner_id=PID)
+
+
+def instances():
+    return list(queryset())
+
+
+def tuples():
+    return list(queryset().values_list(*FIELDS))
+
+
+def arrays():
+    return queryset().to_arrays(FIELDS)
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main():
+    rows = []
+    for size in SIZES:
+        build(size)
+        for name, func in (
+                ('instances', instances),
+                ('values_list', tuples),
+                ('to_arrays', arrays),
+        ):
+            elapsed, _ = measure(func)
+            rows.append((
+                size, name, '{:.3f}'.format(elapsed),
+                '{:.1f}'.format(peak_memory(func) / 2 ** 20),
+            ))
+    print_table(('rows', 'method', 'seconds', 'peak MiB'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+Snowflake id throughput: ids per second of one generator from one and many
+threads, and bulk inserts with client-side ids compared with database
+sequences. On SQLite a BIGINT primary key is a separate index (not the
+rowid), which costs the snowflake inserts a little.
+"""
+import threading
+import time
+
+from .utils import measure, print_table, setup
+
+setup()
+
+from shardy.ids import SnowflakeGenerator  # noqa: E402
+from shardy.tests.models import TShardedModel, TSnowflakeModel  # noqa: E402
+
+PID = 1
+IDS = 200000
+THREADS = (1, 4, 16)
+ROWS = (1000, 10000)
+
+
+def generate(threads, batch):
+    generator = SnowflakeGenerator(1)
+    per_thread = IDS // threads
+
+    def run():
+        if batch:
+            for _ in range(per_thread // batch):
+                generator.next_ids(batch)
+        else:
+            for _ in range(per_thread):
+                generator.next_id()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    started_at = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started_at
+
+
+def insert(model, size):
+    model.objects.filter(partner_id=PID).delete()
+    model.objects.bulk_create(
+        [model(partner_id=PID, name='x') for _ in range(size)],
+        batch_size=500,
+    )
+
+
+def main():
+    rows = []
+    for threads in THREADS:
+        for batch in (None, 1000):
+            elapsed = min(generate(threads, batch) for _ in range(3))
+            rows.append((
+                threads, batch or '-', '{:.0f}'.format(IDS / elapsed),
+            ))
+    print_table(('threads', 'batch', 'ids/s'), rows)
+    print()
+
+    rows = []
+    for size in ROWS:
+        sequence, _ = measure(lambda: insert(TShardedModel, size))
+        snowflake, _ = measure(lambda: insert(TSnowflakeModel, size))
+        rows.append((
+            size,
+            '{:.0f}'.format(size / sequence),
+            '{:.0f}'.format(size / snowflake),
+        ))
+    print_table(('rows', 'sequence rows/s', 'snowflake rows/s'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# coding=utf-8
+"""
+Deep pages: wall time of one page at increasing depth with OFFSET
+slicing and with the keyset cursor of ShardCursorPaginator, over the
+tenants of one shard.
+"""
+from .utils import measure, print_table, setup
+
+setup()
+
+from shardy.pagination import ShardCursorPaginator  # noqa: E402
+from shardy.tests.models import TShardedModel  # noqa: E402
+
+TENANTS = [1, 2, 3, 4]
+ROWS = 100000
+PAGE_SIZE = 50
+DEPTHS = (1, 100, 1000, 1900)
+
+
+def build():
+    TShardedModel.objects.all().for_tenants(TENANTS).delete()
+    for partner_id in TENANTS:
+        TShardedModel.objects.bulk_create([
+            TShardedModel(partner_id=partner_id, name=str(i % 1000))
+            for i in range(ROWS // len(TENANTS))
+        ], batch_size=500)
+
+
+def main():
+    build()
+    queryset = TShardedModel.objects.all().for_tenants(TENANTS)
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    paginator = ShardCursorPaginator(
+        TShardedModel.objects.all(), 'pk', PAGE_SIZE,
+        tenant_ids=TENANTS, parallel=False,
+    )
+    rows = []
+    for depth in DEPTHS:
+        offset = (depth - 1) * PAGE_SIZE
+
+        def offset_page():
+            return list(queryset.order_by('pk')[offset:offset + PAGE_SIZE])
+
+        cursor = None
+        if offset:
+            last = pks[offset - 1]
+            cursor = paginator.encode_cursor({'default': (last, last)}, ())
+
+        def cursor_page():
+            return list(paginator.page(cursor))
+
+        assert [obj.pk for obj in offset_page()] == [
+            obj.pk for obj in cursor_page()
+        ]
+        offset_time, _ = measure(offset_page)
+        cursor_time, _ = measure(cursor_page)
+        rows.append((
+            depth, '{:.4f}'.format(offset_time),
+            '{:.4f}'.format(cursor_time),
+        ))
+    print_table(('page', 'OFFSET s', 'cursor s'), rows)
+
+
+if __name__ == '__main__':
+    main()
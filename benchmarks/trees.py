@@ -0,0 +1,122 @@
+# coding=utf-8
+"""
+Sharded tree implementations compared on a deep (a chain) and a wide
+(one root with many children) tree:
+
+* get_tree: the whole tree of the tenant;
+* descendants: every descendant of the root;
+* ancestors: every ancestor of the deepest (or last) node.
+"""
+from .utils import measure, print_table, setup
+
+setup()
+
+from shardy.tests.models import (  # noqa: E402
+    TShardedMPNode, TShardedNode, TShardedNSNode
+)
+
+PID = 1
+# MP paths are limited to 255 / steplen levels
+DEEP = 60
+WIDE = 5000
+
+
+def make_deep():
+    root = node = {'data': {'desc': '0'}}
+    for level in range(1, DEEP):
+        child = {'data': {'desc': str(level)}}
+        node['children'] = [child]
+        node = child
+    return [root]
+
+
+def make_wide():
+    return [{
+        'data': {'desc': 'root'},
+        'children': [
+            {'data': {'desc': str(i)}} for i in range(WIDE)
+        ],
+    }]
+
+
+def build_al(data):
+    TShardedNode.objects.filter(partner_id=PID).delete()
+    TShardedNode.load_bulk(PID, data)
+
+
+def build_mp(data):
+    TShardedMPNode.objects.filter(partner_id=PID).delete()
+    objs = []
+
+    def walk(nodes, parent_path, depth):
+        for i, node in enumerate(nodes, 1):
+            path = TShardedMPNode._get_path(parent_path, depth, i)
+            children = node.get('children', [])
+            objs.append(TShardedMPNode(
+                partner_id=PID, path=path, depth=depth,
+                numchild=len(children), **node['data']
+            ))
+            walk(children, path, depth + 1)
+
+    walk(data, None, 1)
+    TShardedMPNode.objects.bulk_create(objs, batch_size=500)
+
+
+def build_ns(data):
+    TShardedNSNode.objects.filter(partner_id=PID).delete()
+    objs = []
+
+    def walk(nodes, tree_id, lft, depth):
+        for node in nodes:
+            obj = TShardedNSNode(
+                partner_id=PID, tree_id=tree_id, lft=lft, depth=depth,
+                **node['data']
+            )
+            objs.append(obj)
+            obj.rgt = walk(node.get('children', []), tree_id, lft + 1,
+                           depth + 1)
+            lft = obj.rgt + 1
+        return lft
+
+    for tree_id, root in enumerate(data, 1):
+        walk([root], tree_id, 1, 1)
+    TShardedNSNode.objects.bulk_create(objs, batch_size=500)
+
+
+IMPLEMENTATIONS = (
+    ('AL', TShardedNode, build_al),
+    ('MP', TShardedMPNode, build_mp),
+    ('NS', TShardedNSNode, build_ns),
+)
+
+
+def run(shape, data):
+    rows = []
+    for name, model, build in IMPLEMENTATIONS:
+        build(data)
+        nodes = model.objects.filter(partner_id=PID)
+        root = nodes.order_by('pk').first()
+        leaf = nodes.order_by('-pk').first()
+        row = [shape, name]
+        for func in (
+            lambda: list(model.get_tree(PID)),
+            lambda: list(root.get_descendants()),
+            lambda: list(leaf.get_ancestors()),
+        ):
+            seconds, queries = measure(func)
+            row.extend((queries, '{:.4f}'.format(seconds)))
+        rows.append(row)
+    return rows
+
+
+def main():
+    rows = run('deep', make_deep()) + run('wide', make_wide())
+    print_table(
+        ('tree', 'impl', 'get_tree q', 'get_tree s', 'descendants q',
+         'descendants s', 'ancestors q', 'ancestors s'),
+        rows
+    )
+
+
+if __name__ == '__main__':
+    main()
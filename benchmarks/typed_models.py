@@ -0,0 +1,64 @@
+# coding=utf-8
+"""
+ShardedTypedModel materialization throughput: rows per second of the
+from_db fast path compared with the regular __init__ + recast() path.
+"""
+from unittest import mock
+
+from django.db import models
+
+from .utils import measure, print_table, setup
+
+setup()
+
+from shardy.tests.models import (  # noqa: E402
+    TShardedTypedA, TShardedTypedB, TShardedTypedModel
+)
+
+PID = 1
+SIZES = (10000, 100000)
+
+
+def build(size):
+    TShardedTypedModel.objects.filter(partner_id=PID).delete()
+    objs = []
+    for i in range(size):
+        if i % 2:
+            objs.append(TShardedTypedA(partner_id=PID, name='a', a_value=i))
+        else:
+            objs.append(TShardedTypedB(partner_id=PID, name='b', b_value='b'))
+    TShardedTypedModel.objects.bulk_create(objs, batch_size=500)
+
+
+def load():
+    return list(TShardedTypedModel.objects.filter(partner_id=PID))
+
+
+def load_regular():
+    # the inherited Model.from_db: cls(*values) -> __init__ -> recast()
+    with mock.patch.object(
+        TShardedTypedModel, 'from_db',
+        classmethod(models.Model.from_db.__func__)
+    ):
+        return load()
+
+
+def main():
+    rows = []
+    for size in SIZES:
+        build(size)
+        regular, _ = measure(load_regular)
+        fast, _ = measure(load)
+        rows.append((
+            size,
+            '{:.3f}'.format(regular), '{:.0f}'.format(size / regular),
+            '{:.3f}'.format(fast), '{:.0f}'.format(size / fast),
+        ))
+    print_table(
+        ('rows', 'regular s', 'regular rows/s', 'from_db s', 'from_db rows/s'),
+        rows
+    )
+
+
+if __name__ == '__main__':
+    main()
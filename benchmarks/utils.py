@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+Helpers for the benchmarks.
+
+Benchmarks run against an in-memory SQLite database unless
+DJANGO_SETTINGS_MODULE points at other settings, run them from the
+repository root:
+
+    python -m benchmarks.al_tree
+"""
+import os
+import time
+
+import django
+from django.conf import settings
+
+
+def setup():
+    if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        settings.configure(
+            DATABASES={
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                }
+            },
+            INSTALLED_APPS=['shardy.apps.ShardyConfig'],
+            DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+            DEFAULT_DB_GROUP='default',
+            DATABASE_CONFIG={'routing': {}},
+            MIGRATION_MODULES={'shardy': None},
+            # signs the cursors of shardy.pagination
+            SECRET_KEY='benchmarks',
+            SHARD_SNOWFLAKE_NODE_ID=1,
+        )
+    django.setup()
+
+    from django.apps import apps
+    from django.db import connection
+    import shardy.tests.models  # noqa: registers the test models
+
+    existing = set(connection.introspection.table_names())
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config('shardy').get_models():
+            # proxies share the table of their concrete model
+            if model._meta.db_table not in existing:
+                editor.create_model(model)
+                existing.add(model._meta.db_table)
+
+
+def measure(func, repeat=3):
+    """
+    :return: (best wall time in seconds, number of queries of one call)
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    best = None
+    queries = 0
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            started_at = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started_at
+        queries = len(context.captured_queries)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, queries
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(value)) for value in column)
+        for column in zip(headers, *rows)
+    ]
+    line = '  '.join('{{:>{}}}'.format(width) for width in widths)
+    print(line.format(*headers))
+    for row in rows:
+        print(line.format(*row))
@@ -130,3 +130,7 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Snowflake ids: every process writing ids needs its own node id (0..1023)
+SHARD_SNOWFLAKE_NODE_ID = int(os.environ.get('SHARD_SNOWFLAKE_NODE_ID', 1))
@@ -14,7 +14,13 @@ with open('req.txt') as f:
 setup(
     name='django-shardy',
     version='0.0.5',
-    packages=['shardy', 'shardy.migrations', 'shardy.tests'],
+    packages=[
+        'shardy',
+        'shardy.management',
+        'shardy.management.commands',
+        'shardy.migrations',
+        'shardy.tests',
+    ],
     include_package_data=True,
     license='',  # example license
     description='Sharding db per tenant utils for Django ORM.',
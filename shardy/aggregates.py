@@ -0,0 +1,178 @@
+# coding=utf-8
+"""Top-k rows and approximate distinct counts across shards"""
+import heapq
+from itertools import chain
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F
+from django.db.models.query import (
+    FlatValuesListIterable, ValuesIterable, ValuesListIterable,
+)
+
+from .sketches import HyperLogLog
+
+
+class TopRows(list):
+    """
+    Rows of a cross shard top-k. ``fan_out`` is the FanOutResult, the rows
+    of the shards it lists as failed or skipped are missing.
+    """
+
+    fan_out = None
+
+    @property
+    def partial(self):
+        return self.fan_out is not None and self.fan_out.partial
+
+
+class ApproximateCount(object):
+    """
+    Estimated distinct count. ``relative_error`` is the relative standard
+    error of the sketch: the real count is within ``bounds()`` for ~95%
+    of the estimates (two standard errors).
+    """
+
+    def __init__(self, estimate, relative_error, fan_out):
+        self.estimate = estimate
+        self.relative_error = relative_error
+        self.fan_out = fan_out
+
+    @property
+    def partial(self):
+        return self.fan_out.partial
+
+    def bounds(self, deviations=2):
+        """:return: (low, high) estimate +/- ``deviations`` standard errors"""
+        error = self.estimate * self.relative_error * deviations
+        return max(0, int(self.estimate - error)), int(self.estimate + error)
+
+    def __int__(self):
+        return self.estimate
+
+    def __repr__(self):
+        return '<ApproximateCount {} +/-{:.2%}>'.format(
+            self.estimate, self.relative_error
+        )
+
+
+class _Descending(object):
+    """Reverses the order of a value in a sort key"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _value_getter(queryset, name):
+    """:return: function reading the value of ``name`` from a row"""
+    iterable = queryset._iterable_class
+    if iterable is FlatValuesListIterable:
+        return lambda row: row
+    if iterable is ValuesListIterable:
+        names = list(queryset._fields or ())
+        if name not in names:
+            raise ValueError(
+                '{} is not among the values_list() fields'.format(name)
+            )
+        position = names.index(name)
+        return lambda row: row[position]
+    if iterable is ValuesIterable:
+        return lambda row: row[name]
+    try:
+        field = queryset.model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # an annotation
+        attname = name
+    else:
+        attname = getattr(field, 'attname', name)
+    return lambda row: getattr(row, attname)
+
+
+def top_k(queryset, k, ordering, **kwargs):
+    """
+    The first ``k`` rows of the queryset across shards: every shard runs
+    ``ORDER BY ordering LIMIT k``, then the shard results are merged with
+    a heap. Nulls sort last on every backend. Aggregated rows are exact
+    when each group lives on one shard, i.e. groups of a tenant.
+
+    :param ordering: list of field or annotation names, '-' prefixed for
+        descending order
+    :param kwargs: passed on to fan_out (tenant_ids, using, timeout...)
+    :return: TopRows
+    """
+    from .fanout import fan_out
+
+    if k < 1:
+        raise ValueError('k must be positive')
+    ordering = list(ordering)
+    order_by = []
+    getters = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        expression = F(name)
+        order_by.append(
+            expression.desc(nulls_last=True) if descending
+            else expression.asc(nulls_last=True)
+        )
+        getters.append((_value_getter(queryset, name), descending))
+
+    def key(row):
+        values = []
+        for getter, descending in getters:
+            value = getter(row)
+            values.append((
+                value is None,
+                _Descending(value) if descending else value,
+            ))
+        return values
+
+    result = fan_out(
+        queryset,
+        lambda shard: list(shard.order_by(*order_by)[:k]),
+        **kwargs
+    )
+    rows = TopRows(heapq.nsmallest(
+        k, chain.from_iterable(result.results.values()), key=key
+    ))
+    rows.fan_out = result
+    return rows
+
+
+def count_distinct(queryset, field, precision=14, chunk_size=2000,
+                   **kwargs):
+    """
+    Approximate number of distinct values of ``field`` across shards. Each
+    shard streams its distinct values into a HyperLogLog sketch, the
+    sketches are merged, so values present on several shards are counted
+    once and memory stays at ``2 ** precision`` bytes per shard.
+
+    :param precision: see HyperLogLog, the relative standard error is
+        1.04 / sqrt(2 ** precision)
+    :param kwargs: passed on to fan_out (tenant_ids, using, timeout...)
+    :return: ApproximateCount
+    """
+    from .fanout import fan_out
+
+    def sketch(shard):
+        hll = HyperLogLog(precision)
+        hll.update(
+            value for value in shard.order_by().values_list(
+                field, flat=True
+            ).distinct().iterator(chunk_size=chunk_size)
+            if value is not None
+        )
+        return hll
+
+    result = fan_out(queryset, sketch, **kwargs)
+    merged = HyperLogLog(precision)
+    for hll in result.results.values():
+        merged.merge(hll)
+    return ApproximateCount(merged.count(), merged.relative_error, result)
@@ -1,10 +1,35 @@
 # coding=utf-8
 """Adjacency List"""
+from django.core import serializers
+from django.db import connections, router, transaction
+from django.db.models import Case, F, IntegerField, Max, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils.translation import ugettext_noop as _
 from treebeard.al_tree import AL_Node
-from treebeard.exceptions import NodeAlreadySaved
+from treebeard.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
 
 from .managers import ShardedPerTenantManager
 from .models import ShardedPerTenantModel
+from .models.fields import assign_ids
+from .tree_cache import TOO_LARGE, TenantTree, get_tree_cache, invalidate_tree
+
+
+# max number of ids in one ``IN (...)`` clause
+IN_BATCH_SIZE = 500
+
+# annotation with the distance from the node, set on get_ancestors() results
+ANCESTOR_DISTANCE = 'ancestor_distance'
+
+RECURSIVE_CTE_VENDORS = ('postgresql', 'sqlite')
+
+
+class InSubquerySQL(RawSQL):
+    """
+    Raw subquery for ``__in`` lookups, which add the parentheses themselves
+    (``IN ((SELECT ...))`` is a scalar comparison on SQLite).
+    """
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
 
 
 def get_result_class(cls):
@@ -43,10 +68,23 @@ class AL_ShardedNodeManager(ShardedPerTenantManager):
 
 
 class AL_ShardedPerTenantNode(AL_Node, ShardedPerTenantModel):
-    """Abstract model to create your own Adjacency List Trees."""
+    """
+    Abstract model to create your own Adjacency List Trees.
+
+    With ``use_tree_cache = True`` get_tree, get_children, get_ancestors
+    and get_descendants are answered from a per-tenant in-memory copy of
+    the tree (see shardy.tree_cache) and return lists. The copy is dropped
+    by the writes of the node methods; after queryset update()/delete()
+    call invalidate_tree_cache(). Writes of other processes show up after
+    SHARD_TREE_CACHE_TIMEOUT seconds at most.
+    """
+
+    # tree operations read what the previous ones wrote
+    buffer_writes = False
 
     objects = AL_ShardedNodeManager()
     node_order_by = None
+    use_tree_cache = False
 
     class Meta:
         """Abstract model."""
@@ -61,8 +99,51 @@ class AL_ShardedPerTenantNode(AL_Node, ShardedPerTenantModel):
         }
         return get_result_class(cls).objects.filter(**lookup)
 
+    @classmethod
+    def _get_cached_tree(cls, shared_value):
+        """:returns: TenantTree of the tenant or None if not cached"""
+        if not cls.use_tree_cache:
+            return None
+        cls = get_result_class(cls)
+        cache = get_tree_cache()
+        tree = cache.get(cls, shared_value)
+        if tree is None:
+            # read before the load: a write during the load discards it
+            version = cache.version(cls, shared_value)
+            lookup = {cls.sharded_field: shared_value}
+            tree = TenantTree.load(
+                cls, cls.objects.filter(**lookup), cache.max_nodes
+            )
+            cache.set(cls, shared_value, tree, version)
+        if tree is TOO_LARGE:
+            return None
+        return tree
+
+    def _get_cached_position(self):
+        """:returns: (TenantTree, row of the node) or (None, None)"""
+        tree = self._get_cached_tree(self.sharded_value)
+        if tree is None:
+            return None, None
+        position = tree.position(self.pk)
+        if position is None:
+            return None, None
+        return tree, position
+
+    @classmethod
+    def invalidate_tree_cache(cls, shared_value):
+        """Drops the cached tree of the tenant."""
+        invalidate_tree(get_result_class(cls), shared_value)
+
+    def save(self, *args, **kwargs):
+        super(AL_ShardedPerTenantNode, self).save(*args, **kwargs)
+        self.invalidate_tree_cache(self.sharded_value)
+
     def get_children(self):
         """:returns: A queryset of all the node's children"""
+        tree, position = self._get_cached_position()
+        if tree is not None:
+            return tree.nodes(tree.children(position))
+
         lookup = {
             self.sharded_field: getattr(self, self.sharded_field),
             'parent': self
@@ -89,35 +170,224 @@ class AL_ShardedPerTenantNode(AL_Node, ShardedPerTenantModel):
 
     def get_ancestors(self):
         """
-        :returns: A *list* containing the current node object's ancestors,
+        :returns: A queryset of the current node object's ancestors,
             starting by the root node and descending to the parent.
+            Every node is annotated with ``ancestor_distance`` (1 for the
+            parent). Costs one query on backends with recursive CTEs.
         """
-        ancestors = []
-        if self._meta.proxy_for_model:
-            # the current node is a proxy model; our result set
-            # should use the same proxy model, so we need to
-            # explicitly fetch instances of that model
-            # when following the 'parent' relation
-            cls = self.__class__
-            node = self
-            while node.parent_id:
-                lookup = {
-                    self.sharded_field: getattr(self, self.sharded_field),
-                    'pk': node.parent_id,
-                }
-                node = cls.objects.get(**lookup)
-                ancestors.insert(0, node)
+        if self.parent_id is None:
+            return self._get_tenant_nodes().none()
+
+        tree, position = self._get_cached_position()
+        if tree is not None:
+            ancestors = tree.ancestors(position)
+            results = tree.nodes(ancestors)
+            for node in results:
+                setattr(node, ANCESTOR_DISTANCE,
+                        tree.depths[position] - node._cached_depth)
+            return results
+
+        nodes = self._get_tenant_nodes()
+
+        alias = nodes.db
+        if connections[alias].vendor in RECURSIVE_CTE_VENDORS:
+            sql, params = self._get_ancestors_sql(alias)
+            distance = RawSQL(
+                'SELECT distance FROM ({sql}) ancestors '
+                'WHERE ancestors.id = {table}.{pk}'.format(
+                    sql=sql, **self._get_tree_sql_names(alias)
+                ),
+                params,
+                output_field=IntegerField()
+            )
+            nodes = nodes.filter(pk__in=InSubquerySQL(
+                'SELECT id FROM ({}) ancestors'.format(sql), params
+            ))
         else:
-            node = self.parent
-            while node:
-                ancestors.insert(0, node)
-                node = node.parent
-        return ancestors
+            ids = []
+            parent_id = self.parent_id
+            while parent_id is not None:
+                ids.append(parent_id)
+                parent_id = nodes.filter(pk=parent_id).values_list(
+                    'parent_id', flat=True
+                )[0]
+            distance = Case(
+                *[
+                    When(pk=pk, then=Value(i))
+                    for i, pk in enumerate(ids, start=1)
+                ],
+                output_field=IntegerField()
+            )
+            nodes = nodes.filter(pk__in=ids)
+
+        return nodes.annotate(
+            **{ANCESTOR_DISTANCE: distance}
+        ).order_by('-' + ANCESTOR_DISTANCE)
+
+    def _get_tenant_nodes(self):
+        lookup = {self.sharded_field: getattr(self, self.sharded_field)}
+        return get_result_class(self.__class__).objects.filter(**lookup)
+
+    def _get_tree_sql_names(self, alias):
+        qn = connections[alias].ops.quote_name
+        opts = get_result_class(self.__class__)._meta
+        return {
+            'table': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'parent': qn(opts.get_field('parent').column),
+            'sharded': qn(opts.get_field(self.sharded_field).column),
+        }
+
+    def _get_ancestors_sql(self, alias):
+        """:returns: sql selecting (id, distance) of all the ancestors"""
+        sql = (
+            'WITH RECURSIVE tree (id, parent_id, distance) AS ('
+            'SELECT {pk}, {parent}, 1 FROM {table} '
+            'WHERE {pk} = %s AND {sharded} = %s '
+            'UNION ALL '
+            'SELECT t.{pk}, t.{parent}, tree.distance + 1 '
+            'FROM {table} t INNER JOIN tree ON t.{pk} = tree.parent_id '
+            'WHERE t.{sharded} = %s'
+            ') SELECT id, distance FROM tree'
+        ).format(**self._get_tree_sql_names(alias))
+        return sql, [self.parent_id, self.sharded_value, self.sharded_value]
+
+    def _get_descendants_sql(self, alias, deepest_first=False):
+        """:returns: sql selecting ids of all the descendants"""
+        sql = (
+            'WITH RECURSIVE tree (id, depth) AS ('
+            'SELECT {pk}, 1 FROM {table} '
+            'WHERE {parent} = %s AND {sharded} = %s '
+            'UNION ALL '
+            'SELECT t.{pk}, tree.depth + 1 FROM {table} t '
+            'INNER JOIN tree ON t.{parent} = tree.id '
+            'WHERE t.{sharded} = %s'
+            ') SELECT id FROM tree'
+        ).format(**self._get_tree_sql_names(alias))
+        if deepest_first:
+            sql += ' ORDER BY depth DESC'
+        return sql, [self.pk, self.sharded_value, self.sharded_value]
 
     @classmethod
-    def dump_bulk(cls, parent=None, keep_ids=True):
-        """Dumps a tree branch to a python data structure."""
-        raise NotImplementedError
+    def dump_bulk(cls, shared_value, parent=None, keep_ids=True):
+        """
+        Dumps a tree branch to a python data structure (one query, see
+        get_tree). The sharded field is left out of ``data`` so the dump
+        can be loaded into any tenant.
+        """
+        serializable_cls = cls._get_serializable_model()
+        if (
+                parent and serializable_cls != cls and
+                parent.__class__ != serializable_cls
+        ):
+            lookup = {cls.sharded_field: shared_value, 'pk': parent.pk}
+            parent = serializable_cls.objects.get(**lookup)
+
+        objs = serializable_cls.get_tree(shared_value, parent)
+
+        ret, lnk = [], {}
+        for node, pyobj in zip(objs, serializers.serialize('python', objs)):
+            # django's serializer stores the attributes in 'fields'
+            fields = pyobj['fields']
+            for name in ('parent', 'sib_order', 'id', cls.sharded_field):
+                fields.pop(name, None)
+
+            newobj = {'data': fields}
+            if keep_ids:
+                newobj['id'] = pyobj['pk']
+
+            if node.parent_id in lnk:
+                lnk[node.parent_id].setdefault('children', []).append(newobj)
+            else:
+                ret.append(newobj)
+            lnk[node.pk] = newobj
+        return ret
+
+    @classmethod
+    def load_bulk(cls, shared_value, bulk_data, parent=None, keep_ids=False,
+                  batch_size=None):
+        """
+        Loads a list/dictionary structure (see dump_bulk) to the tenant
+        tree, under ``parent`` or as new root nodes.
+
+        Nodes are inserted level by level with bulk_create in one
+        transaction: sib_order is computed in memory, parent ids are
+        remapped from the created rows. Backends that can't return ids from
+        bulk inserts fall back to one insert per node unless ``keep_ids``.
+
+        :returns: a list of the pks of the added nodes
+        """
+        cls = get_result_class(cls)
+        if parent is not None and parent.sharded_value != shared_value:
+            raise ValueError("Can't add a node to another tenant's tree.")
+        lookup = {cls.sharded_field: shared_value}
+        alias = router.db_for_write(cls, exact_lookups=lookup)
+        nodes = cls.objects.filter(**lookup)
+        nodes._pinned_db = alias
+        if parent is None:
+            siblings = nodes.filter(parent__isnull=True)
+        else:
+            siblings = nodes.filter(parent=parent)
+
+        foreign_keys = [
+            field for field in cls._meta.fields
+            if field.is_relation and field.name != 'parent'
+        ]
+
+        features = connections[alias].features
+        bulk_ids = keep_ids or features.can_return_ids_from_bulk_insert
+
+        added = []
+        level = [
+            (parent.pk if parent else None, node_struct)
+            for node_struct in bulk_data
+        ]
+        with transaction.atomic(using=alias):
+            first_sib_order = 0
+            if not cls.node_order_by:
+                first_sib_order = siblings.order_by(
+                    '-sib_order'
+                ).values_list('sib_order', flat=True).first() or 0
+
+            while level:
+                objs = []
+                sib_orders = {}
+                for parent_id, node_struct in level:
+                    data = dict(node_struct['data'])
+                    for field in foreign_keys:
+                        # dumps store related pks, no need to fetch objects
+                        if field.name in data:
+                            data[field.attname] = data.pop(field.name)
+                    data[cls.sharded_field] = shared_value
+                    if keep_ids:
+                        data[cls._meta.pk.attname] = node_struct['id']
+
+                    obj = cls(**data)
+                    obj.parent_id = parent_id
+                    if not cls.node_order_by:
+                        sib_orders.setdefault(parent_id, first_sib_order)
+                        sib_orders[parent_id] += 1
+                        obj.sib_order = sib_orders[parent_id]
+                    objs.append(obj)
+
+                if bulk_ids:
+                    nodes.bulk_create(objs, batch_size=batch_size)
+                else:
+                    for obj in objs:
+                        obj.save(using=alias)
+
+                next_level = []
+                for obj, (_, node_struct) in zip(objs, level):
+                    added.append(obj.pk)
+                    next_level.extend(
+                        (obj.pk, child)
+                        for child in node_struct.get('children', [])
+                    )
+                level = next_level
+                # only the nodes of the first level get existing siblings
+                first_sib_order = 0
+        cls.invalidate_tree_cache(shared_value)
+        return added
 
     def add_child(self, **kwargs):
         """Adds a child to the node."""
@@ -150,16 +420,86 @@ class AL_ShardedPerTenantNode(AL_Node, ShardedPerTenantModel):
         newobj.save()
         return newobj
 
-    @classmethod
-    def _get_tree_recursively(cls, shared_value, results, parent, depth):
-        if parent:
-            nodes = parent.get_children()
+    def add_children(self, children, batch_size=None):
+        """
+        Adds children to the node, after the existing ones and in the given
+        order.
+
+        The max sib_order is read once and the children are inserted with
+        one bulk_create on the write alias of the tenant shard (no save
+        signals). Backends that can't return ids from bulk inserts fall back
+        to one insert per child in one transaction, unless every child has
+        its pk set. Children of another tenant raise ValueError.
+
+        :param children: list of kwargs dicts or unsaved instances
+        :returns: the list of added nodes
+        """
+        cls = get_result_class(self.__class__)
+        shared_value = getattr(self, self.sharded_field)
+
+        objs = []
+        for child in children:
+            if isinstance(child, dict):
+                newobj = cls(**child)
+            else:
+                newobj = child
+                # pks may be preset, bulk_create then needs no returned ids
+                if not newobj._state.adding:
+                    raise NodeAlreadySaved("Attempted to add a tree node "
+                                           "that is already in the database")
+            value = getattr(newobj, cls.sharded_field)
+            if value is None:
+                setattr(newobj, cls.sharded_field, shared_value)
+            elif value != shared_value:
+                raise ValueError("Can't add a node to another tenant's tree.")
+            newobj.parent = self
+            objs.append(newobj)
+        if not objs:
+            return objs
+
+        alias = router.db_for_write(cls, instance=self)
+        nodes = cls.objects.filter(**{cls.sharded_field: shared_value})
+        nodes._pinned_db = alias
+        if not cls.node_order_by:
+            max_sib_order = nodes.filter(parent=self).order_by(
+                '-sib_order'
+            ).values_list('sib_order', flat=True).first() or 0
+            for sib_order, newobj in enumerate(objs, max_sib_order + 1):
+                newobj.sib_order = sib_order
+
+        depth = self.get_depth()
+        for newobj in objs:
+            newobj._cached_depth = depth + 1
+
+        assign_ids(cls, objs)
+        features = connections[alias].features
+        if features.can_return_ids_from_bulk_insert or all(
+            newobj.pk is not None for newobj in objs
+        ):
+            nodes.bulk_create(objs, batch_size=batch_size)
+            self.invalidate_tree_cache(shared_value)
         else:
-            nodes = cls.get_root_nodes(shared_value)
+            with transaction.atomic(using=alias):
+                for newobj in objs:
+                    newobj.save(using=alias)
+        return objs
+
+    @classmethod
+    def _get_children_index(cls, shared_value, parent=None):
+        """
+        :returns: dict parent pk -> ordered list of child nodes for the whole
+            tenant tree or for the subtree of ``parent``.
+        """
+        lookup = {cls.sharded_field: shared_value}
+        nodes = get_result_class(cls).objects.filter(**lookup)
+
+        if parent is not None:
+            nodes = parent._get_descendants_queryset()
+
+        index = {}
         for node in nodes:
-            node._cached_depth = depth
-            results.append(node)
-            cls._get_tree_recursively(shared_value, results, node, depth + 1)
+            index.setdefault(node.parent_id, []).append(node)
+        return index
 
     @classmethod
     def get_tree(cls, shared_value, parent=None):
@@ -167,38 +507,226 @@ class AL_ShardedPerTenantNode(AL_Node, ShardedPerTenantModel):
         :returns: A list of nodes ordered as DFS, including the parent. If
                   no parent is given, the entire tree is returned.
         """
+        tree = cls._get_cached_tree(shared_value)
+        if tree is not None:
+            if parent is None:
+                return tree.nodes(range(len(tree)))
+            position = tree.position(parent.pk)
+            if position is not None:
+                parent._cached_depth = tree.depths[position]
+                return [parent] + tree.nodes(
+                    tree.subtree(position)[1:]
+                )
+
         if parent:
             depth = parent.get_depth() + 1
             results = [parent]
         else:
             depth = 1
             results = []
-        cls._get_tree_recursively(shared_value, results, parent, depth)
+
+        index = cls._get_children_index(shared_value, parent)
+        stack = [
+            (node, depth)
+            for node in reversed(index.get(parent.pk if parent else None, []))
+        ]
+        while stack:
+            node, depth = stack.pop()
+            node._cached_depth = depth
+            results.append(node)
+            stack.extend(
+                (child, depth + 1)
+                for child in reversed(index.get(node.pk, []))
+            )
         return results
 
     def get_descendants(self):
         """
-        :returns: A *list* of all the node's descendants, doesn't
-            include the node itself
+        :returns: A queryset of all the node's descendants, doesn't
+            include the node itself. Nodes keep the manager ordering
+            (use get_tree for DFS order). Costs one query on backends
+            with recursive CTEs, one query per level otherwise.
         """
-        lookup = {
-            self.sharded_field: getattr(self, self.sharded_field),
-            'parent': self,
-        }
-        return self.__class__.get_tree(**lookup)[1:]
+        tree, position = self._get_cached_position()
+        if tree is not None:
+            return tree.nodes(tree.subtree(position)[1:])
+        return self._get_descendants_queryset()
+
+    def _get_descendants_queryset(self):
+        nodes = self._get_tenant_nodes()
+        alias = nodes.db
+        if connections[alias].vendor in RECURSIVE_CTE_VENDORS:
+            return nodes.filter(
+                pk__in=InSubquerySQL(*self._get_descendants_sql(alias))
+            )
+
+        ids = []
+        for level in self._get_descendant_levels(nodes):
+            ids.extend(level)
+        return nodes.filter(pk__in=ids)
+
+    def _get_descendant_levels(self, nodes):
+        """:returns: lists of descendant pks, level by level (BFS)"""
+        levels = []
+        level = [self.pk]
+        while level:
+            next_level = []
+            for start in range(0, len(level), IN_BATCH_SIZE):
+                next_level.extend(nodes.filter(
+                    parent__in=level[start:start + IN_BATCH_SIZE]
+                ).values_list('pk', flat=True))
+            if next_level:
+                levels.append(next_level)
+            level = next_level
+        return levels
+
+    def _get_subtree_ids_deepest_first(self, nodes):
+        """:returns: pks of the node and its descendants, leaves first"""
+        alias = nodes.db
+        if connections[alias].vendor in RECURSIVE_CTE_VENDORS:
+            sql, params = self._get_descendants_sql(alias, deepest_first=True)
+            with connections[alias].cursor() as cursor:
+                cursor.execute(sql, params)
+                ids = [row[0] for row in cursor.fetchall()]
+        else:
+            ids = []
+            for level in reversed(self._get_descendant_levels(nodes)):
+                ids.extend(level)
+        ids.append(self.pk)
+        return ids
+
+    def get_descendant_count(self):
+        """:returns: the number of descendants of a node"""
+        tree, position = self._get_cached_position()
+        if tree is not None:
+            return tree.ends[position] - position - 1
+        return self._get_descendants_queryset().count()
+
+    def is_descendant_of(self, node):
+        """
+        :returns: ``True`` if the node is a descendant of another node given
+            as an argument, else, returns ``False``
+        """
+        tree, position = node._get_cached_position()
+        if tree is not None:
+            other = tree.position(self.pk)
+            return other is not None and position < other < tree.ends[position]
+        return node._get_descendants_queryset().filter(pk=self.pk).exists()
 
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
-        relative to another node.
+        relative to another node of the same tenant.
+
+        Only the moved node row and the sib_order of its new siblings are
+        updated (set-based, scoped to the tenant) in one transaction, so the
+        number of queries doesn't depend on the subtree size.
         """
-        # пока не используем этот метод для шардированных моделей
-        raise NotImplementedError
+        if target.sharded_value != self.sharded_value:
+            raise ValueError("Can't move a node to another tenant's tree.")
+        pos = self._prepare_pos_var_for_move(pos)
+        cls = get_result_class(self.__class__)
+        nodes = self._get_tenant_nodes()
 
-    def delete(self):
-        """Removes a node and all it's descendants."""
-        lookup = {
-            self.sharded_field: getattr(self, self.sharded_field),
-            'pk': self.pk,
-        }
-        self.__class__.objects.filter(**lookup).delete()
\ No newline at end of file
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            parent_id = target.pk
+        else:
+            if target.pk == self.pk and pos in ('left', 'right'):
+                # not actually moving the node
+                return
+            parent_id = target.parent_id
+
+        if parent_id is not None and (
+                parent_id == self.pk or
+                self._get_descendants_queryset().filter(
+                    pk=parent_id
+                ).exists()
+        ):
+            raise InvalidMoveToDescendant(
+                _("Can't move node to a descendant."))
+
+        alias = router.db_for_write(cls, instance=self)
+        with transaction.atomic(using=alias):
+            if parent_id is None:
+                siblings = nodes.filter(parent__isnull=True)
+            else:
+                siblings = nodes.filter(parent_id=parent_id)
+            siblings = siblings.exclude(pk=self.pk)
+
+            values = {'parent_id': parent_id}
+            if not cls.node_order_by:
+                values['sib_order'] = self._make_hole_for_move(
+                    siblings, target, pos
+                )
+            nodes.filter(pk=self.pk).update(**values)
+
+        for name, value in values.items():
+            setattr(self, name, value)
+        self.__dict__.pop('_cached_depth', None)
+        self.invalidate_tree_cache(self.sharded_value)
+
+    @staticmethod
+    def _make_hole_for_move(siblings, target, pos):
+        """
+        Shifts the siblings right of the new position with one UPDATE.
+
+        :returns: the sib_order of the moved node
+        """
+        if pos in ('last-child', 'last-sibling'):
+            last = siblings.aggregate(last=Max('sib_order'))['last']
+            return (last or 0) + 1
+
+        if pos in ('first-child', 'first-sibling'):
+            sib_order = 1
+            hole = siblings
+        else:
+            # target sib_order may have changed since it was loaded
+            sib_order = siblings.model.objects.filter(
+                **{target.sharded_field: target.sharded_value, 'pk': target.pk}
+            ).values_list('sib_order', flat=True)[0]
+            if pos == 'right':
+                sib_order += 1
+            hole = siblings.filter(sib_order__gte=sib_order)
+
+        hole.update(sib_order=F('sib_order') + 1)
+        return sib_order
+
+    def delete(self, send_signals=True):
+        """
+        Removes a node and all it's descendants.
+
+        The subtree pks are found with one query (one query per level
+        without recursive CTEs) and deleted leaves first in chunks of
+        IN_BATCH_SIZE, in one transaction on the tenant shard. Every chunk
+        goes through the deletion collector (signals, cascades to other
+        models), whose lookup of children then finds nothing new.
+
+        :param send_signals: with False the chunks are deleted with plain
+            ``DELETE ... WHERE id IN`` statements: no signals, no
+            cascades to other models
+        :returns: (number of deleted objects, {model label: count})
+        """
+        cls = get_result_class(self.__class__)
+        alias = router.db_for_write(cls, instance=self)
+        nodes = self._get_tenant_nodes()
+        # the pks are read in the transaction on the primary
+        nodes._pinned_db = alias
+
+        deleted = 0
+        counts = {}
+        with transaction.atomic(using=alias):
+            ids = self._get_subtree_ids_deepest_first(nodes)
+            for start in range(0, len(ids), IN_BATCH_SIZE):
+                batch = nodes.filter(pk__in=ids[start:start + IN_BATCH_SIZE])
+                if send_signals:
+                    batch_deleted, batch_counts = batch.delete()
+                else:
+                    batch_deleted = batch._raw_delete(alias)
+                    batch_counts = {cls._meta.label: batch_deleted}
+                deleted += batch_deleted
+                for label, count in batch_counts.items():
+                    counts[label] = counts.get(label, 0) + count
+        if not send_signals:
+            nodes._evict_identity_map()
+        self.invalidate_tree_cache(self.sharded_value)
+        return deleted, counts
\ No newline at end of file
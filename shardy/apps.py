@@ -2,15 +2,50 @@ from django.apps import AppConfig
 from django.conf import settings
 
 
+class Config(object):
+    """
+    Shardy settings with their defaults. Values are read from django
+    settings on every access (so override_settings works) without building
+    anything per access: the router reads them for every query.
+    """
+
+    defaults = {
+        'DEFAULT_DB_GROUP': 'default',
+        'SHARD_SEPARATOR': '__',
+        'DATABASE_CONFIG': {},
+        'DATABASES': None,
+        'SHARD_LOAD_TRACKING': False,
+        'SHARD_LOAD_TRACKER_CAPACITY': 100,
+        'SHARD_LOAD_CACHE_ALIAS': 'default',
+        'SHARD_LOAD_PUBLISH_INTERVAL': 60,
+        'SHARD_RESULT_CACHE': None,
+        'SHARD_TREE_CACHE_MAX_TENANTS': 100,
+        'SHARD_TREE_CACHE_MAX_NODES': 10000,
+        'SHARD_TREE_CACHE_TIMEOUT': 60,
+        'SHARD_TENANT_REGISTRY': None,
+        'SHARD_TENANT_REGISTRY_TTL': 300,
+        'SHARD_HEALTH_CHECKS': False,
+        'SHARD_HEALTH_FAILURE_THRESHOLD': 5,
+        'SHARD_HEALTH_RESET_TIMEOUT': 30,
+        'SHARD_REPLICA_SUFFIX': 'replica',
+        'SHARD_SNOWFLAKE_NODE_ID': None,
+        # 2020-01-01 00:00:00 UTC in milliseconds
+        'SHARD_SNOWFLAKE_EPOCH': 1577836800000,
+    }
+
+    def __getattr__(self, name):
+        try:
+            default = self.defaults[name]
+        except KeyError:
+            raise AttributeError(name)
+        return getattr(settings, name, default)
+
+
 class ShardyConfig(AppConfig):
     name = 'shardy'
 
+    _settings = Config()
+
     @property
     def settings(self):
-        class Config:
-            DEFAULT_DB_GROUP = getattr(settings, 'DEFAULT_DB_GROUP', 'default')
-            SHARD_SEPARATOR = getattr(settings, 'SHARD_SEPARATOR', '__')
-            DATABASE_CONFIG = getattr(settings, 'DATABASE_CONFIG', {})
-            DATABASES = getattr(settings, 'DATABASES')
-
-        return Config()
+        return self._settings
@@ -0,0 +1,230 @@
+# coding=utf-8
+"""Columnar export of sharded querysets to NumPy arrays"""
+from collections import OrderedDict
+from datetime import timezone
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models.sql.constants import MULTI
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+INTEGER_TYPES = {
+    'AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField',
+    'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+}
+FLOAT_TYPES = {'FloatField', 'DecimalField'}
+
+
+class Columns(OrderedDict):
+    """
+    Arrays by field name. ``fan_out`` holds the FanOutResult of an export
+    across shards, the columns miss the rows of the shards it lists as
+    failed or skipped.
+    """
+
+    fan_out = None
+
+    @property
+    def partial(self):
+        return self.fan_out is not None and self.fan_out.partial
+
+    def __len__(self):
+        for column in self.values():
+            return len(column)
+        return 0
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('numpy is required to export arrays')
+
+
+def field_dtype(field):
+    """
+    :return: numpy dtype of the column of a model field: int64 (float64
+        with NaN for nullable ones), float64, bool, datetime64 (NaT for
+        null) or object
+    """
+    if field.is_relation:
+        return field_dtype(field.target_field)
+    internal_type = field.get_internal_type()
+    if internal_type in INTEGER_TYPES:
+        return 'float64' if field.null else 'int64'
+    if internal_type in FLOAT_TYPES:
+        return 'float64'
+    if internal_type == 'BooleanField' and not field.null:
+        return 'bool'
+    if internal_type == 'DateTimeField':
+        return 'datetime64[us]'
+    if internal_type == 'DateField':
+        return 'datetime64[D]'
+    return 'object'
+
+
+class ArrayBuilder(object):
+    """
+    Typed columns filled a chunk at a time, the capacity doubles when
+    it's reached and is trimmed by finish().
+    """
+
+    def __init__(self, names, dtypes, capacity=1024):
+        _require_numpy()
+        self.names = list(names)
+        self.size = 0
+        self._columns = [
+            numpy.empty(capacity, dtype=dtype) for dtype in dtypes
+        ]
+
+    def _reserve(self, count):
+        capacity = len(self._columns[0]) if self._columns else 0
+        needed = self.size + count
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity = max(1, capacity * 2)
+        for column in self._columns:
+            column.resize(capacity, refcheck=False)
+
+    def extend(self, columns, count):
+        """:param columns: one sequence of ``count`` values per column"""
+        if not count:
+            return
+        self._reserve(count)
+        end = self.size + count
+        for column, values in zip(self._columns, columns):
+            column[self.size:end] = values
+        self.size = end
+
+    def finish(self):
+        """:return: Columns trimmed to the rows read"""
+        result = Columns()
+        for name, column in zip(self.names, self._columns):
+            column.resize(self.size, refcheck=False)
+            result[name] = column
+        return result
+
+
+def _naive_utc(values):
+    """datetime64 has no time zone, aware values are stored in UTC"""
+    return [
+        value.astimezone(timezone.utc).replace(tzinfo=None)
+        if getattr(value, 'tzinfo', None) is not None else value
+        for value in values
+    ]
+
+
+def _iter_chunks(queryset, fields, chunk_size, unconverted=()):
+    """
+    Reads the values of ``fields`` with chunked fetches, bypassing the
+    tuples and instances of the ORM iterables.
+
+    :param unconverted: positions of the columns numpy converts from the
+        values of the database driver, without the field converters
+    :return: iterator of (list of column value lists, row count)
+    """
+    queryset = queryset.values_list(*fields)
+    alias = queryset.db
+    connection = connections[alias]
+    compiler = queryset.query.get_compiler(using=alias)
+    results = compiler.execute_sql(
+        MULTI, chunked_fetch=True, chunk_size=chunk_size
+    )
+    converters = None
+    for rows in results:
+        if converters is None:
+            # the select is known once the query ran
+            count = compiler.col_count
+            converters = compiler.get_converters(
+                [select[0] for select in compiler.select[:count]]
+            )
+            for position in unconverted:
+                converters.pop(position, None)
+        columns = list(zip(*rows))[:count]
+        for position, (functions, expression) in converters.items():
+            values = columns[position]
+            for function in functions:
+                values = [
+                    function(value, expression, connection)
+                    for value in values
+                ]
+            columns[position] = values
+        yield columns, len(rows)
+
+
+def column_dtypes(model, fields, dtypes=None):
+    """
+    :param fields: field names (lookups through relations and annotations
+        become object columns unless given in ``dtypes``)
+    :param dtypes: dict field name -> numpy dtype overriding field_dtype()
+    :return: list of the dtypes of the columns
+    """
+    dtypes = dtypes or {}
+    opts = model._meta
+    result = []
+    for name in fields:
+        if name in dtypes:
+            result.append(dtypes[name])
+            continue
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            result.append('object')
+        else:
+            result.append(field_dtype(field))
+    return result
+
+
+def read_arrays(queryset, fields, dtypes=None, chunk_size=2000):
+    """
+    Exports the rows of a queryset routed to one shard.
+
+    :param dtypes: see column_dtypes()
+    :return: Columns
+    """
+    _require_numpy()
+    types = column_dtypes(queryset.model, fields, dtypes)
+    kinds = [numpy.dtype(dtype).kind for dtype in types]
+    # numbers, booleans and datetimes are cast by numpy
+    unconverted = [
+        position for position, kind in enumerate(kinds) if kind in 'biufM'
+    ]
+    datetimes = [
+        position for position, kind in enumerate(kinds) if kind == 'M'
+    ]
+    builder = ArrayBuilder(fields, types, capacity=chunk_size)
+    for columns, count in _iter_chunks(
+            queryset, fields, chunk_size, unconverted
+    ):
+        for position in datetimes:
+            columns[position] = _naive_utc(columns[position])
+        builder.extend(columns, count)
+    return builder.finish()
+
+
+def concatenate(model, parts, fields, dtypes=None, shard_column=None):
+    """
+    :param parts: list of (alias, Columns)
+    :param shard_column: name of a column of the alias of every row
+    :return: Columns
+    """
+    _require_numpy()
+    if not parts:
+        result = ArrayBuilder(
+            fields, column_dtypes(model, fields, dtypes), capacity=0
+        ).finish()
+        if shard_column:
+            result[shard_column] = numpy.empty(0, dtype=str)
+        return result
+    result = Columns()
+    for name in fields:
+        result[name] = numpy.concatenate([part[name] for _, part in parts])
+    if shard_column:
+        result[shard_column] = numpy.concatenate([
+            numpy.full(len(part), alias) for alias, part in parts
+        ])
+    return result
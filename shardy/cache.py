@@ -0,0 +1,259 @@
+# coding=utf-8
+"""Tenant scoped query result cache"""
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.cache import caches
+from django.db import transaction
+
+
+app = apps.get_app_config('shardy')
+
+KEY_PREFIX = 'shardy:rc'
+
+
+class LocalMemoryBackend(object):
+    """Process local LRU storage"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        # generations come from one counter; a tenant whose generation was
+        # evicted gets the highest evicted one, newer than its stale entries
+        self._generations = OrderedDict()
+        self._counter = 0
+        self._evicted = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return None
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.time() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_generation(self, tenant):
+        with self._lock:
+            try:
+                self._generations.move_to_end(tenant)
+            except KeyError:
+                return self._evicted
+            return self._generations[tenant]
+
+    def incr_generation(self, tenant):
+        with self._lock:
+            self._counter += 1
+            self._generations[tenant] = self._counter
+            self._generations.move_to_end(tenant)
+            while len(self._generations) > self.max_entries:
+                _, generation = self._generations.popitem(last=False)
+                self._evicted = max(self._evicted, generation)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+
+class DjangoCacheBackend(object):
+    """Storage in one of the CACHES, shared between processes"""
+
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    @property
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self._cache.set(key, value, timeout)
+
+    def get_generation(self, tenant):
+        key = self._generation_key(tenant)
+        generation = self._cache.get(key)
+        if generation is None:
+            # never set or evicted: a random start can't match the keys of
+            # entries stored under a lost generation; add() keeps a
+            # concurrently created one
+            generation = _new_generation()
+            if not self._cache.add(key, generation, None):
+                generation = self._cache.get(key, generation)
+        return generation
+
+    def incr_generation(self, tenant):
+        key = self._generation_key(tenant)
+        try:
+            self._cache.incr(key)
+        except ValueError:
+            if not self._cache.add(key, _new_generation(), None):
+                self._cache.incr(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    @staticmethod
+    def _generation_key(tenant):
+        return '{}:gen:{}'.format(KEY_PREFIX, tenant)
+
+
+def _new_generation():
+    # room left for increments below 2 ** 63 (signed counters of redis)
+    return random.getrandbits(62)
+
+
+class TenantResultCache(object):
+    """
+    Query results keyed by shard alias, sql and params, tagged by tenant.
+
+    Every key contains the tenant generation, so bumping the generation on a
+    write makes all entries of that tenant unreachable at once; they are
+    dropped later by LRU or timeout.
+    """
+
+    def __init__(self, backend, timeout=None):
+        self.backend = backend
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, alias, tenant, sql, params, kind=''):
+        tenant = str(tenant)
+        digest = hashlib.md5(
+            repr((alias, kind, sql, tuple(params))).encode('utf-8')
+        ).hexdigest()
+        return '{}:{}:{}:{}'.format(
+            KEY_PREFIX, tenant, self.backend.get_generation(tenant), digest
+        )
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout or self.timeout)
+
+    def invalidate(self, tenant):
+        self.backend.incr_generation(str(tenant))
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.hits = self.misses = 0
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def build_result_cache(config):
+    """
+    :param config: SHARD_RESULT_CACHE setting, e.g.
+        {'BACKEND': 'django', 'CACHE_ALIAS': 'default', 'TIMEOUT': 300} or
+        {'BACKEND': 'locmem', 'MAX_ENTRIES': 1000}
+    """
+    config = config or {}
+    backend_name = config.get('BACKEND', 'locmem')
+    if backend_name == 'locmem':
+        backend = LocalMemoryBackend(config.get('MAX_ENTRIES', 1000))
+    elif backend_name == 'django':
+        backend = DjangoCacheBackend(config.get('CACHE_ALIAS', 'default'))
+    else:
+        raise ValueError(
+            'Unknown SHARD_RESULT_CACHE backend {!r}'.format(backend_name)
+        )
+    return TenantResultCache(backend, timeout=config.get('TIMEOUT'))
+
+
+def get_result_cache(create=True):
+    """
+    :param create: build the cache from settings if it does not exist yet
+    :return: the process wide TenantResultCache or None
+    """
+    global _result_cache
+    if _result_cache is None and create:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = build_result_cache(
+                    app.settings.SHARD_RESULT_CACHE
+                )
+    return _result_cache
+
+
+def invalidate_tenant(tenant):
+    """
+    Drops every cached result of the tenant. Cheap no-op when the result
+    cache is neither configured nor used in this process.
+    """
+    if tenant is None:
+        return
+    cache = get_result_cache(create=bool(app.settings.SHARD_RESULT_CACHE))
+    if cache is not None:
+        cache.invalidate(tenant)
+
+
+def invalidate_tenant_on_commit(tenant, using):
+    """
+    Invalidates the tenant for a write on the ``using`` connection: at once,
+    and inside a transaction once more when it commits, dropping what other
+    connections cached from the rows as they were before the commit.
+    """
+    if tenant is None:
+        return
+    cache = get_result_cache(create=bool(app.settings.SHARD_RESULT_CACHE))
+    if cache is None:
+        return
+    cache.invalidate(tenant)
+
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return
+    # one callback per tenant and transaction
+    for _, func in connection.run_on_commit:
+        if getattr(func, 'tenant', None) == tenant:
+            return
+    callback = _InvalidateOnCommit(tenant)
+    transaction.on_commit(callback, using=using)
+
+
+class _InvalidateOnCommit(object):
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+
+    def __call__(self):
+        invalidate_tenant(self.tenant)
@@ -36,16 +36,21 @@ class ShardedPerTenantRouter(object):
     def db_for_write(self, model, **hints):
         if self._is_sharded_model(model):
             self._write_mode = True
-            return self._get_shard(model, **hints)
+            return self._get_shard(model, write=True, **hints)
         return None
 
     def _is_sharded_model(self, model):
         from .models import ShardedPerTenantModel
         return issubclass(model, ShardedPerTenantModel)
 
-    def _get_shard(self, model, **hints):
+    def _get_shard(self, model, write=False, **hints):
         if hints.get("instance", None):
-            return self._get_shard_for_instance(instance=hints["instance"])
+            instance = hints["instance"]
+            alias = self._get_shard_for_instance(instance=instance)
+            self._shard_resolved(
+                alias, getattr(instance, "sharded_value", None), write
+            )
+            return alias
 
         try:
             exact_lookups = hints['exact_lookups']
@@ -63,7 +68,24 @@ class ShardedPerTenantRouter(object):
                 )
             )
 
-        return self._build_db_alias(shared_value, model)
+        alias = self._build_db_alias(shared_value, model)
+        self._shard_resolved(alias, shared_value, write)
+        return alias
+
+    def _shard_resolved(self, alias, shared_value, write=False):
+        if app.settings.SHARD_HEALTH_CHECKS:
+            from .health import get_shard_health
+            health = get_shard_health()
+            # one caller runs the half-open trial, the others fail fast
+            health.check(alias)
+            health.track(alias)
+        if app.settings.SHARD_LOAD_TRACKING:
+            from .load import get_load_tracker
+            get_load_tracker().record_resolved(alias, shared_value)
+        if write:
+            # not _write_mode: the router is shared by all threads
+            from .cache import invalidate_tenant_on_commit
+            invalidate_tenant_on_commit(shared_value, alias)
 
     def _get_shard_for_instance(self, instance):
         if instance._state.db:
@@ -0,0 +1,195 @@
+# coding=utf-8
+"""Time budgets of multi-shard requests"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import DatabaseError, connections
+
+
+# SQLite virtual machine instructions between two deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+
+# share of the statement timeout sent to a connection the remaining budget
+# has to lose before a new one is sent
+STATEMENT_TIMEOUT_SLACK = 0.1
+
+
+class DeadlineExceeded(DatabaseError):
+    """
+    The budget was spent before or while querying the alias. Not an
+    OperationalError: a slow answer is not recorded as a shard failure.
+    """
+
+    def __init__(self, alias=None):
+        super(DeadlineExceeded, self).__init__(
+            'Deadline exceeded on {}'.format(alias)
+        )
+        self.alias = alias
+
+
+class Deadline(object):
+    """
+    Point in time a request must be answered by. Applied to a connection,
+    every query gets the remaining budget as its statement timeout:
+
+    * PostgreSQL: ``statement_timeout`` (``SET LOCAL`` inside a
+      transaction);
+    * MySQL: ``max_execution_time`` (SELECT only);
+    * SQLite: a progress handler interrupting the statement;
+    * other backends are only checked before each query.
+
+    PostgreSQL and MySQL get the timeout with the first query of the block
+    and again once the budget has shrunk by ``STATEMENT_TIMEOUT_SLACK`` of
+    the timeout sent, a query can overrun the deadline by that share. A
+    ``SET LOCAL`` is sent again in every transaction, and undone when the
+    block ends inside the transaction it was sent in. A query interrupted
+    that way raises DeadlineExceeded.
+    """
+
+    def __init__(self, timeout):
+        """:param timeout: budget in seconds from now"""
+        self.timeout = timeout
+        self.end = time.monotonic() + timeout
+
+    def remaining(self):
+        """:return: seconds left, 0 once expired"""
+        return max(0.0, self.end - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.end
+
+    def _interrupt(self):
+        return 1 if time.monotonic() >= self.end else 0
+
+    def _execute_wrapper(self, alias, vendor, state):
+        def wrapper(execute, sql, params, many, context):
+            remaining = self.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded(alias)
+            if vendor in ('postgresql', 'mysql'):
+                connection = context['connection']
+                local = vendor == 'postgresql' and connection.in_atomic_block
+                sent = state['session']
+                if local and _in_transaction(connection, state['mark']):
+                    sent = state['local']
+                if sent is None or (
+                        remaining < sent * (1 - STATEMENT_TIMEOUT_SLACK)
+                ):
+                    _set_statement_timeout(
+                        connection, context['cursor'].cursor, vendor,
+                        remaining,
+                    )
+                    if local:
+                        state['local'] = remaining
+                        state['mark'] = _TimeoutMark()
+                        connection.on_commit(state['mark'])
+                    else:
+                        state['session'] = remaining
+            try:
+                return execute(sql, params, many, context)
+            except DatabaseError as e:
+                if self.expired:
+                    raise DeadlineExceeded(alias) from e
+                raise
+        return wrapper
+
+    @contextmanager
+    def apply(self, alias):
+        """Bounds the queries run on the alias inside the block."""
+        if self.expired:
+            raise DeadlineExceeded(alias)
+        connection = connections[alias]
+        vendor = connection.vendor
+        # statement timeouts sent with SET and SET LOCAL, the on_commit()
+        # mark of the transaction of the latter
+        state = {'session': None, 'local': None, 'mark': None}
+        if vendor == 'sqlite':
+            connection.ensure_connection()
+            connection.connection.set_progress_handler(
+                self._interrupt, SQLITE_PROGRESS_STEPS
+            )
+        try:
+            with connection.execute_wrapper(
+                    self._execute_wrapper(alias, vendor, state)
+            ):
+                yield self
+        finally:
+            if connection.connection is not None:
+                if vendor == 'sqlite':
+                    connection.connection.set_progress_handler(None, 0)
+                elif state['session'] is not None:
+                    _reset_statement_timeout(connection, vendor)
+                elif _in_transaction(connection, state['mark']):
+                    # the rest of the caller's transaction is not bounded
+                    _reset_statement_timeout(connection, vendor, local=True)
+
+
+class _TimeoutMark(object):
+    """on_commit() callback marking the transaction of a SET LOCAL"""
+
+    def __call__(self):
+        pass
+
+
+def _in_transaction(connection, mark):
+    """
+    :return: whether the transaction ``mark`` was registered in is still
+        open and the savepoint it was registered in not rolled back, i.e.
+        whether the SET LOCAL sent with it still holds
+    """
+    if mark is None or not connection.in_atomic_block:
+        return False
+    return any(func is mark for _, func in connection.run_on_commit)
+
+
+def _set_statement_timeout(connection, cursor, vendor, seconds):
+    # at least 1 ms, 0 disables the timeout
+    milliseconds = max(1, int(seconds * 1000))
+    if vendor == 'postgresql':
+        cursor.execute('SET {}statement_timeout = {:d}'.format(
+            'LOCAL ' if connection.in_atomic_block else '', milliseconds
+        ))
+    else:
+        cursor.execute(
+            'SET SESSION max_execution_time = {:d}'.format(milliseconds)
+        )
+
+
+def _reset_statement_timeout(connection, vendor, local=False):
+    with connection.cursor() as cursor:
+        if local:
+            cursor.execute('SET LOCAL statement_timeout TO DEFAULT')
+        elif vendor == 'postgresql':
+            cursor.execute('RESET statement_timeout')
+        else:
+            cursor.execute('SET SESSION max_execution_time = DEFAULT')
+
+
+_local = threading.local()
+
+
+def get_current_deadline():
+    """:return: the Deadline of the innermost deadline() block or None"""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(timeout):
+    """
+    Makes a Deadline current for the thread; fan-outs started inside the
+    block use it and pass it on to their workers. A nested block can only
+    shorten the budget.
+
+    :param timeout: seconds
+    """
+    outer = get_current_deadline()
+    current = Deadline(timeout)
+    if outer is not None and outer.end < current.end:
+        current = outer
+    _local.deadline = current
+    try:
+        yield current
+    finally:
+        _local.deadline = outer
@@ -0,0 +1,214 @@
+# coding=utf-8
+"""Per tenant dumps of sharded models to gzipped JSON lines"""
+import datetime
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+
+
+SUFFIX = '.jsonl.gz'
+
+
+def sharded_models(labels=None):
+    """
+    :param labels: app_label.ModelName labels, all the sharded models by
+        default
+    :return: concrete sharded models, the targets of foreign keys first
+    """
+    from .models import ShardedPerTenantModel
+
+    if labels:
+        models = [apps.get_model(label) for label in labels]
+    else:
+        models = [
+            model for model in apps.get_models()
+            if issubclass(model, ShardedPerTenantModel) and
+            not model._meta.proxy and model._meta.managed
+        ]
+    valid = []
+    for model in models:
+        try:
+            model._meta.get_field(model.sharded_field or '')
+        except FieldDoesNotExist:
+            continue
+        valid.append(model)
+    return _sort_dependencies(valid)
+
+
+def _sort_dependencies(models):
+    ordered = []
+    remaining = list(models)
+    while remaining:
+        for model in remaining:
+            targets = {
+                field.related_model for field in model._meta.concrete_fields
+                if field.is_relation and field.related_model is not model
+            }
+            if not targets & set(remaining):
+                break
+        else:
+            # a cycle, constraint checks are deferred anyway
+            model = remaining[0]
+        remaining.remove(model)
+        ordered.append(model)
+    return ordered
+
+
+class DumpEncoder(DjangoJSONEncoder):
+    """Keeps the microseconds DjangoJSONEncoder drops"""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(DumpEncoder, self).default(o)
+
+
+def dump_path(directory, tenant, model):
+    return os.path.join(
+        directory, str(tenant), model._meta.label_lower + SUFFIX
+    )
+
+
+def _tenant_value(model, tenant):
+    """Tenant ids given on the command line are strings"""
+    return model._meta.get_field(model.sharded_field).to_python(tenant)
+
+
+def _tenant_rows(model, tenant):
+    return model._default_manager.all().filter(
+        **{model.sharded_field: _tenant_value(model, tenant)}
+    )
+
+
+def dump_tenant(tenant, directory, models, chunk_size=2000):
+    """
+    Writes every row of the tenant, one file per model. Rows are streamed
+    ``chunk_size`` at a time as dicts of column values, a file appears
+    under its final name once complete.
+
+    :return: dict model label -> number of rows
+    """
+    counts = {}
+    os.makedirs(os.path.join(directory, str(tenant)), exist_ok=True)
+    for model in models:
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        rows = _tenant_rows(model, tenant).order_by('pk').values_list(
+            *attnames
+        )
+        path = dump_path(directory, tenant, model)
+        count = 0
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as dump:
+            for row in rows.iterator(chunk_size=chunk_size):
+                dump.write(json.dumps(
+                    dict(zip(attnames, row)), cls=DumpEncoder
+                ))
+                dump.write('\n')
+                count += 1
+        os.replace(path + '.tmp', path)
+        counts[model._meta.label] = count
+    return counts
+
+
+def _read_objects(model, path):
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    with gzip.open(path, 'rt', encoding='utf-8') as dump:
+        for line in dump:
+            values = json.loads(line)
+            yield model(**{
+                attname: fields[attname].to_python(value)
+                for attname, value in values.items()
+            })
+
+
+def _batches(objects, batch_size):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_tenant(tenant, directory, models, batch_size=1000, clear=False):
+    """
+    Inserts the dumped rows of the tenant with batched bulk_create, in one
+    transaction per shard. Constraint checks are disabled during the load
+    and run at the end where the backend allows it (like loaddata),
+    sequences are reset past the loaded pks.
+
+    :param clear: deletes the rows the tenant has first
+    :return: dict model label -> number of rows
+    """
+    shards = {}
+    for model in models:
+        if os.path.exists(dump_path(directory, tenant, model)):
+            alias = router.db_for_write(
+                model,
+                exact_lookups={
+                    model.sharded_field: _tenant_value(model, tenant)
+                },
+            )
+            shards.setdefault(alias, []).append(model)
+
+    counts = {}
+    for alias, shard_models in shards.items():
+        connection = connections[alias]
+        with transaction.atomic(using=alias):
+            with connection.constraint_checks_disabled():
+                if clear:
+                    for model in reversed(shard_models):
+                        _tenant_rows(model, tenant)._raw_delete(alias)
+                for model in shard_models:
+                    counts[model._meta.label] = _load_model(
+                        model, dump_path(directory, tenant, model),
+                        batch_size,
+                    )
+            connection.check_constraints(
+                table_names=[model._meta.db_table for model in shard_models]
+            )
+            sequence_sql = connection.ops.sequence_reset_sql(
+                no_style(), shard_models
+            )
+            if sequence_sql:
+                with connection.cursor() as cursor:
+                    for sql in sequence_sql:
+                        cursor.execute(sql)
+    return counts
+
+
+def _load_model(model, path, batch_size):
+    count = 0
+    for batch in _batches(_read_objects(model, path), batch_size):
+        model._default_manager.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def run_per_tenant(func, tenants, workers=1):
+    """
+    Calls ``func(tenant)`` for every tenant, in ``workers`` threads.
+
+    :return: list of (tenant, result or exception)
+    """
+    def run(tenant):
+        try:
+            return tenant, func(tenant)
+        except Exception as e:
+            return tenant, e
+        finally:
+            if workers > 1:
+                connections.close_all()
+
+    if workers <= 1:
+        return [run(tenant) for tenant in tenants]
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(run, tenants))
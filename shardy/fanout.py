@@ -0,0 +1,322 @@
+# coding=utf-8
+"""Running a query on every shard of a sharded model"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.db import connections
+from django.db.models import QuerySet
+
+from .deadlines import Deadline, DeadlineExceeded, get_current_deadline
+from .health import FAILURE_ERRORS, get_shard_health
+from .querysets import ShardRawPerTenantQuerySet
+from .tenants import get_tenant_registry
+
+# seconds a streaming worker waits on a full buffer before checking whether
+# the consumer is gone
+PUT_INTERVAL = 0.1
+
+
+class FanOutResult(object):
+    """
+    Results of a fan-out by db alias. Shards that failed, missed the
+    deadline or were skipped because of an open circuit make the result
+    partial.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+        self.timed_out = []
+
+    @property
+    def partial(self):
+        return bool(self.errors or self.skipped or self.timed_out)
+
+    def values(self):
+        """:return: list of the results of the answered shards"""
+        return list(self.results.values())
+
+
+def group_tenants_by_alias(model, tenant_ids=None, using=None):
+    """
+    :param tenant_ids: sharded values, all the tenants of the registry by
+        default
+    :return: dict db alias -> list of tenant ids
+    """
+    if tenant_ids is None:
+        return get_tenant_registry().get_tenants_by_alias(model, using=using)
+    tenants = {}
+    for tenant_id in tenant_ids:
+        tenants.setdefault(
+            model.get_db_alias(tenant_id, using=using), []
+        ).append(tenant_id)
+    return tenants
+
+
+def _resolve_deadline(timeout, deadline):
+    if timeout is not None:
+        return Deadline(timeout)
+    if deadline is None:
+        return get_current_deadline()
+    return deadline
+
+
+def _select_shards(model, tenant_ids, using, health, skip_unavailable):
+    """
+    :return: list of (alias, tenant ids) to query, list of the aliases
+        skipped because of an open circuit
+    """
+    shards, skipped = [], []
+    for alias, ids in group_tenants_by_alias(model, tenant_ids, using).items():
+        if skip_unavailable and health.is_open(alias):
+            skipped.append(alias)
+        else:
+            shards.append((alias, ids))
+    return shards, skipped
+
+
+def fan_out(model, func, tenant_ids=None, using=None, parallel=True,
+            max_workers=None, skip_unavailable=True, health=None,
+            timeout=None, deadline=None):
+    """
+    Calls ``func(queryset)`` once per shard, the queryset selecting the rows
+    of the shard's tenants (see ShardPerTenantQuerySet.for_tenants).
+
+    Every call runs in the health guard of its alias: connection and query
+    errors are recorded and reported in ``errors`` instead of raised,
+    shards with an open circuit are skipped (``skipped``) unless
+    ``skip_unavailable`` is False, then they are reported in ``errors``
+    without being tried.
+
+    With a deadline, the queries of every shard get the remaining budget as
+    their statement timeout (see Deadline). Shards that miss it are listed
+    in ``timed_out`` and their results dropped; in parallel mode the
+    fan-out returns at the deadline without waiting for them.
+
+    :param model: sharded model, or a queryset of it to narrow per shard
+    :param tenant_ids: sharded values, all the tenants of the registry by
+        default
+    :param using: replica suffix
+    :param parallel: one thread per shard (up to ``max_workers``),
+        connections opened by the threads are closed when they finish
+    :param timeout: budget in seconds
+    :param deadline: Deadline shared with other calls, the one of the
+        enclosing deadline() block by default
+    :return: FanOutResult
+    """
+    if isinstance(model, QuerySet):
+        base, model = model, model.model
+    else:
+        base = None
+    health = health or get_shard_health()
+    deadline = _resolve_deadline(timeout, deadline)
+    result = FanOutResult()
+    shards, result.skipped = _select_shards(
+        model, tenant_ids, using, health, skip_unavailable
+    )
+
+    def run(alias, ids):
+        queryset = (
+            model.objects.all() if base is None else base._chain()
+        ).for_tenants(ids)
+        if using:
+            queryset = queryset.using(using)
+        with health.guard(alias):
+            if deadline is None:
+                return func(queryset)
+            with deadline.apply(alias):
+                return func(queryset)
+
+    def collect(alias, call):
+        try:
+            result.results[alias] = call()
+        except DeadlineExceeded:
+            result.timed_out.append(alias)
+        except FAILURE_ERRORS as e:
+            result.errors[alias] = e
+
+    def run_in_thread(alias, ids):
+        try:
+            return run(alias, ids)
+        finally:
+            connections.close_all()
+
+    if parallel and len(shards) > 1:
+        executor = ThreadPoolExecutor(max_workers or len(shards))
+        try:
+            futures = [
+                (alias, executor.submit(run_in_thread, alias, ids))
+                for alias, ids in shards
+            ]
+            if deadline is not None:
+                wait(
+                    [future for _, future in futures],
+                    timeout=deadline.remaining(),
+                )
+            for alias, future in futures:
+                if deadline is not None and not future.done():
+                    # interrupted by its statement timeout soon
+                    future.cancel()
+                    result.timed_out.append(alias)
+                else:
+                    collect(alias, future.result)
+        finally:
+            executor.shutdown(wait=deadline is None)
+    else:
+        for alias, ids in shards:
+            if deadline is not None and deadline.expired:
+                result.timed_out.append(alias)
+            else:
+                collect(alias, lambda: run(alias, ids))
+    return result
+
+
+class RawFanOut(FanOutResult):
+    """
+    Rows of a raw query run on every shard, streamed as the shards answer
+    (interleaved in parallel mode). Iterate it once; ``results`` counts the
+    rows streamed by alias, ``errors``, ``skipped`` and ``timed_out`` are
+    complete when the iteration is over.
+    """
+
+    def __init__(self, shards, rows, parallel, max_workers, deadline,
+                 buffer_size):
+        super(RawFanOut, self).__init__()
+        self._shards = shards
+        self._rows = rows
+        self._parallel = parallel
+        self._max_workers = max_workers
+        self._deadline = deadline
+        self._buffer_size = buffer_size
+
+    def __iter__(self):
+        if self._parallel and len(self._shards) > 1:
+            return self._stream_parallel()
+        return self._stream()
+
+    def _failed(self, alias, error):
+        if isinstance(error, DeadlineExceeded):
+            self.timed_out.append(alias)
+        elif isinstance(error, FAILURE_ERRORS):
+            self.errors[alias] = error
+        else:
+            raise error
+
+    def _stream(self):
+        for alias, ids in self._shards:
+            if self._deadline is not None and self._deadline.expired:
+                self.timed_out.append(alias)
+                continue
+            self.results[alias] = 0
+            try:
+                for row in self._rows(alias, ids):
+                    self.results[alias] += 1
+                    yield row
+            except (DeadlineExceeded,) + FAILURE_ERRORS as e:
+                self._failed(alias, e)
+
+    def _stream_parallel(self):
+        buffer = queue.Queue(self._buffer_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=PUT_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(alias, ids):
+            try:
+                for row in self._rows(alias, ids):
+                    if not put((alias, row)):
+                        return
+                put((alias, None))
+            except Exception as e:
+                put((alias, e))
+            finally:
+                connections.close_all()
+
+        pending = set()
+        executor = ThreadPoolExecutor(self._max_workers or len(self._shards))
+        try:
+            for alias, ids in self._shards:
+                pending.add(alias)
+                self.results[alias] = 0
+                executor.submit(produce, alias, ids)
+            while pending:
+                try:
+                    alias, item = buffer.get(
+                        timeout=None if self._deadline is None
+                        else self._deadline.remaining()
+                    )
+                except queue.Empty:
+                    self.timed_out.extend(
+                        alias for alias, _ in self._shards if alias in pending
+                    )
+                    break
+                if item is None:
+                    pending.discard(alias)
+                elif isinstance(item, Exception):
+                    pending.discard(alias)
+                    self._failed(alias, item)
+                else:
+                    self.results[alias] += 1
+                    yield item
+        finally:
+            # workers blocked on a full buffer give up
+            stop.set()
+            executor.shutdown(wait=self._deadline is None)
+
+
+def fan_out_raw(model, raw_query, params=None, translations=None,
+                tenant_ids=None, using=None, parallel=True, max_workers=None,
+                skip_unavailable=True, health=None, timeout=None,
+                deadline=None, buffer_size=1000):
+    """
+    Runs the same raw SQL on every shard and streams the model instances,
+    shard failures and deadlines are handled like in fan_out().
+
+        report = Order.objects.raw_fan_out(
+            'SELECT * FROM orders WHERE partner_id IN %s',
+            params=lambda ids: [tuple(ids)],
+        )
+        for order in report:
+            ...
+        if report.partial:
+            ...
+
+    :param params: query params, or a callable taking the tenant ids of a
+        shard and returning its params
+    :param buffer_size: rows fetched ahead of the consumer in parallel
+        mode, workers wait while the buffer is full
+    :return: RawFanOut
+    """
+    health = health or get_shard_health()
+    deadline = _resolve_deadline(timeout, deadline)
+
+    def rows(alias, ids):
+        queryset = ShardRawPerTenantQuerySet(
+            raw_query, model=model,
+            params=params(ids) if callable(params) else params,
+            translations=translations, using=using, shared_value=ids[0],
+        )
+        with health.guard(alias):
+            if deadline is None:
+                yield from queryset.iterator()
+            else:
+                with deadline.apply(alias):
+                    yield from queryset.iterator()
+
+    shards, skipped = _select_shards(
+        model, tenant_ids, using, health, skip_unavailable
+    )
+    result = RawFanOut(
+        shards, rows, parallel, max_workers, deadline, buffer_size
+    )
+    result.skipped = skipped
+    return result
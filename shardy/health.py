@@ -0,0 +1,237 @@
+# coding=utf-8
+"""Per-alias health tracking with circuit breakers"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import InterfaceError, OperationalError, connections
+
+
+app = apps.get_app_config('shardy')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# errors of an unreachable or broken database, not of the query itself
+FAILURE_ERRORS = (OperationalError, InterfaceError)
+
+
+class ShardUnavailable(OperationalError):
+    """The circuit of the alias is open, the call was not attempted."""
+
+    def __init__(self, alias):
+        super(ShardUnavailable, self).__init__(
+            'Shard {} is unavailable (circuit open)'.format(alias)
+        )
+        self.alias = alias
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``threshold`` consecutive failures. Once open, calls are
+    rejected for ``reset_timeout`` seconds, then one trial call is let
+    through (half-open): its success closes the circuit, its failure opens
+    it again. The thread of the trial keeps being allowed until then, a
+    trial that reports nothing for ``reset_timeout`` seconds is handed to
+    another caller.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._trial_thread = None
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """:return: True if a call may be attempted now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == HALF_OPEN:
+                if self._trial_thread == threading.get_ident():
+                    return True
+                if now - self._trial_started_at < self.reset_timeout:
+                    return False
+            elif now - self.opened_at < self.reset_timeout:
+                return False
+            # this caller runs the trial
+            self.state = HALF_OPEN
+            self._trial_thread = threading.get_ident()
+            self._trial_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial_thread = None
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+                self._trial_thread = None
+
+
+class ShardHealth(object):
+    """Circuit breakers by db alias"""
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        """
+        :param threshold: failures to open a circuit,
+            SHARD_HEALTH_FAILURE_THRESHOLD by default
+        :param reset_timeout: seconds before a probe,
+            SHARD_HEALTH_RESET_TIMEOUT by default
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get_breaker(self, alias):
+        breaker = self._breakers.get(alias)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(alias)
+                if breaker is None:
+                    breaker = self._breakers[alias] = CircuitBreaker(
+                        self.threshold or
+                        app.settings.SHARD_HEALTH_FAILURE_THRESHOLD,
+                        self.reset_timeout or
+                        app.settings.SHARD_HEALTH_RESET_TIMEOUT,
+                    )
+        return breaker
+
+    def is_open(self, alias):
+        """:return: True if calls to the alias are rejected now"""
+        breaker = self._breakers.get(alias)
+        return breaker is not None and breaker.state != CLOSED and not (
+            breaker.state == OPEN and
+            time.time() - breaker.opened_at >= breaker.reset_timeout
+        )
+
+    def check(self, alias):
+        """:raises ShardUnavailable: if the circuit of the alias is open"""
+        breaker = self._breakers.get(alias)
+        if breaker is not None and not breaker.allow():
+            raise ShardUnavailable(alias)
+
+    def record_success(self, alias):
+        breaker = self._breakers.get(alias)
+        if breaker is not None and (breaker.state != CLOSED or breaker.failures):
+            breaker.record_success()
+
+    def record_failure(self, alias, error=None):
+        self.get_breaker(alias).record_failure(error)
+
+    @contextmanager
+    def guard(self, alias):
+        """
+        Fails fast with ShardUnavailable when the circuit is open, records
+        connection and query errors of the block as failures of the alias
+        and a clean exit as a success.
+        """
+        self.check(alias)
+        try:
+            yield
+        except ShardUnavailable:
+            raise
+        except FAILURE_ERRORS as e:
+            if not getattr(e, '_shardy_recorded', False):
+                self.record_failure(alias, e)
+            raise
+        self.record_success(alias)
+
+    def _record_error(self, alias, error):
+        # counted once when a tracked query fails inside a guard
+        error._shardy_recorded = True
+        self.record_failure(alias, error)
+
+    def track(self, alias):
+        """
+        Feeds the breaker of the alias from every query of its connection
+        in the current thread: failures to connect and failed queries are
+        failures, executed queries successes.
+        """
+        connection = connections[alias]
+        if getattr(connection, '_shardy_health', None) is self:
+            return
+        connection._shardy_health = self
+
+        def execute_wrapper(execute, sql, params, many, context):
+            try:
+                result = execute(sql, params, many, context)
+            except FAILURE_ERRORS as e:
+                self._record_error(alias, e)
+                raise
+            self.record_success(alias)
+            return result
+
+        # first, outermost: execute_wrapper() blocks pop the last wrapper
+        connection.execute_wrappers.insert(0, execute_wrapper)
+        ensure_connection = connection.ensure_connection
+
+        def ensure_tracked_connection():
+            if connection.connection is not None:
+                return ensure_connection()
+            try:
+                ensure_connection()
+            except FAILURE_ERRORS as e:
+                self._record_error(alias, e)
+                raise
+
+        # connection errors are raised before any execute wrapper runs
+        connection.ensure_connection = ensure_tracked_connection
+
+    def probe(self, alias):
+        """
+        Runs ``SELECT 1`` on the alias (unless its circuit is open).
+
+        :return: True if the shard answered
+        """
+        try:
+            with self.guard(alias):
+                connection = connections[alias]
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        except FAILURE_ERRORS:
+            connections[alias].close()
+            return False
+        return True
+
+    def status(self):
+        """:return: dict alias -> (state, consecutive failures, last error)"""
+        return {
+            alias: (breaker.state, breaker.failures, breaker.last_error)
+            for alias, breaker in list(self._breakers.items())
+        }
+
+    def reset(self):
+        with self._lock:
+            self._breakers = {}
+
+
+_shard_health = None
+_shard_health_lock = threading.Lock()
+
+
+def get_shard_health():
+    """:return: the process wide ShardHealth"""
+    global _shard_health
+    if _shard_health is None:
+        with _shard_health_lock:
+            if _shard_health is None:
+                _shard_health = ShardHealth()
+    return _shard_health
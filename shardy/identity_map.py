@@ -0,0 +1,92 @@
+# coding=utf-8
+"""Request scoped identity map for sharded models"""
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """
+    Instances loaded by primary key, keyed by (db alias, concrete model, pk).
+
+    Proxy models share the entry of their concrete model, an entry is only
+    returned for the exact class it was loaded as.
+    """
+
+    def __init__(self):
+        self._objects = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    @staticmethod
+    def _key(alias, model, pk):
+        return alias, model._meta.concrete_model._meta.label, pk
+
+    def get(self, alias, model, pk):
+        instance = self._objects.get(self._key(alias, model, pk))
+        if instance is not None and instance.__class__ is model:
+            return instance
+        return None
+
+    def add(self, instance):
+        if instance.pk is None or not instance._state.db:
+            return
+        key = self._key(instance._state.db, instance.__class__, instance.pk)
+        if instance.get_deferred_fields():
+            # partially loaded instance can't answer get()
+            self._objects.pop(key, None)
+        else:
+            self._objects[key] = instance
+
+    def evict(self, instance):
+        if instance.pk is None:
+            return
+        if instance._state.db:
+            aliases = [instance._state.db]
+        else:
+            aliases = self._aliases()
+        for alias in aliases:
+            self._objects.pop(
+                self._key(alias, instance.__class__, instance.pk), None
+            )
+
+    def evict_model(self, model, alias=None):
+        label = model._meta.concrete_model._meta.label
+        for key in [
+            key for key in self._objects
+            if key[1] == label and alias in (None, key[0])
+        ]:
+            del self._objects[key]
+
+    def clear(self):
+        self._objects.clear()
+
+    def _aliases(self):
+        return {key[0] for key in self._objects}
+
+
+def get_identity_map():
+    """:return: the active IdentityMap of the current thread or None"""
+    return getattr(_local, 'identity_map', None)
+
+
+@contextmanager
+def identity_map():
+    """
+    Activates an identity map for the block, an already active one is
+    reused. The map is dropped when the outermost block exits.
+    """
+    current = get_identity_map()
+    if current is not None:
+        yield current
+        return
+
+    _local.identity_map = IdentityMap()
+    try:
+        yield _local.identity_map
+    finally:
+        _local.identity_map.clear()
+        _local.identity_map = None
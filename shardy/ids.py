@@ -0,0 +1,163 @@
+# coding=utf-8
+"""Cluster wide unique 64-bit ids generated in-process"""
+import os
+import threading
+import time
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+
+
+app = apps.get_app_config('shardy')
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+NODE_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = NODE_BITS + SEQUENCE_BITS
+
+
+class SnowflakeGenerator(object):
+    """
+    Snowflake ids: milliseconds since ``epoch`` (41 bits, ~69 years), the
+    node id of the generating process (10 bits) and a per millisecond
+    sequence (12 bits). Ids of one generator are strictly increasing, ids of
+    generators with different node ids never collide, no coordination is
+    needed.
+
+    When the sequence of a millisecond is exhausted the generator sleeps
+    until the clock reaches the next one, and after the clock went
+    backwards it keeps the millisecond it was at until then. It never runs
+    ahead of the clock: a process restarted with the same node id would
+    issue the ids of those future milliseconds again.
+    """
+
+    def __init__(self, node_id, epoch=None, clock=time.time,
+                 sleep=time.sleep):
+        """
+        :param node_id: 0..1023, unique among the processes writing ids
+        :param epoch: unix time in milliseconds, SHARD_SNOWFLAKE_EPOCH by
+            default
+        :param clock: returns the unix time in seconds
+        :param sleep: waits for the given seconds
+        """
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(
+                'node_id must be in 0..{}, got {}'.format(MAX_NODE_ID, node_id)
+            )
+        self.node_id = node_id
+        if epoch is None:
+            epoch = app.settings.SHARD_SNOWFLAKE_EPOCH
+        self.epoch = epoch
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._last = -1
+        self._sequence = MAX_SEQUENCE
+
+    def _now(self):
+        return int(self._clock() * 1000) - self.epoch
+
+    def _wait_after(self, millisecond):
+        """:return: the first time read from the clock after ``millisecond``"""
+        while True:
+            now = self._now()
+            if now > millisecond:
+                return now
+            self._sleep((millisecond - now + 1) / 1000.0)
+
+    def _reserve(self, count):
+        """:return: list of (millisecond, first sequence, last sequence)"""
+        blocks = []
+        with self._lock:
+            now = self._now()
+            while count:
+                if now > self._last:
+                    self._last = now
+                    self._sequence = -1
+                elif self._sequence == MAX_SEQUENCE:
+                    now = self._wait_after(self._last)
+                    continue
+                first = self._sequence + 1
+                last = min(MAX_SEQUENCE, first + count - 1)
+                blocks.append((self._last, first, last))
+                count -= last - first + 1
+                self._sequence = last
+        return blocks
+
+    def next_id(self):
+        ((timestamp, sequence, _),) = self._reserve(1)
+        return (
+            timestamp << TIMESTAMP_SHIFT |
+            self.node_id << NODE_SHIFT |
+            sequence
+        )
+
+    def next_ids(self, count):
+        """:return: list of ``count`` increasing ids, one lock acquisition"""
+        node = self.node_id << NODE_SHIFT
+        ids = []
+        for timestamp, first, last in self._reserve(count):
+            prefix = timestamp << TIMESTAMP_SHIFT | node
+            ids.extend(
+                prefix | sequence for sequence in range(first, last + 1)
+            )
+        return ids
+
+
+def parse_id(value, epoch=None):
+    """:return: (unix time in milliseconds, node id, sequence) of an id"""
+    if epoch is None:
+        epoch = app.settings.SHARD_SNOWFLAKE_EPOCH
+    return (
+        (value >> TIMESTAMP_SHIFT) + epoch,
+        (value >> NODE_SHIFT) & MAX_NODE_ID,
+        value & MAX_SEQUENCE,
+    )
+
+
+def get_node_id():
+    """
+    :return: SHARD_SNOWFLAKE_NODE_ID, an int or a callable returning it
+        (e.g. a lease taken from a shared cache or database). Use a
+        callable with prefork servers: a forked worker calls it again.
+    :raise ImproperlyConfigured: the setting is missing or out of range,
+        there is no safe default: processes sharing a node id generate
+        the same ids
+    """
+    node_id = app.settings.SHARD_SNOWFLAKE_NODE_ID
+    if node_id is None:
+        raise ImproperlyConfigured(
+            'SHARD_SNOWFLAKE_NODE_ID is required to generate Snowflake ids, '
+            'every process writing ids needs its own node id'
+        )
+    if callable(node_id):
+        node_id = node_id()
+    if not isinstance(node_id, int) or not 0 <= node_id <= MAX_NODE_ID:
+        raise ImproperlyConfigured(
+            'SHARD_SNOWFLAKE_NODE_ID must be in 0..{}'.format(MAX_NODE_ID)
+        )
+    return node_id
+
+
+_id_generator = None
+_id_generator_pid = None
+_id_generator_lock = threading.Lock()
+
+
+def get_id_generator():
+    """
+    :return: the process wide SnowflakeGenerator, built again in a forked
+        child so that workers don't share a sequence
+    """
+    global _id_generator, _id_generator_pid
+    pid = os.getpid()
+    if _id_generator is None or _id_generator_pid != pid:
+        with _id_generator_lock:
+            if _id_generator is None or _id_generator_pid != pid:
+                _id_generator = SnowflakeGenerator(get_node_id())
+                _id_generator_pid = pid
+    return _id_generator
@@ -0,0 +1,205 @@
+# coding=utf-8
+"""Per tenant load tracking for hot tenant detection"""
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.cache import caches
+from django.db import connections
+
+from .sketches import SpaceSaving
+
+
+app = apps.get_app_config('shardy')
+
+LOAD_REPORT_CACHE_KEY = 'shardy:tenant_load'
+
+TenantLoad = namedtuple(
+    'TenantLoad', ['tenant', 'queries', 'queries_error', 'qps', 'time']
+)
+
+
+class TenantLoadTracker(object):
+    """
+    Counts queries and query time per (db alias, tenant).
+
+    Both counters are Space-Saving summaries, so memory depends on
+    ``capacity`` only, not on the number of tenants. Both are fed by the
+    execute wrapper installed with :meth:`track_queries`: every executed
+    statement and its time are charged to the tenant the router resolved
+    last in the current thread for that alias.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queries = SpaceSaving(capacity)
+        self._time = SpaceSaving(capacity)
+        self._started_at = time.time()
+        self._published_at = self._started_at
+
+    def record_resolved(self, alias, sharded_value):
+        """The next queries of the thread on ``alias`` are the tenant's"""
+        self._local.current = (alias, sharded_value)
+
+    def record_query(self, alias, duration):
+        key = getattr(self._local, 'current', None)
+        if key is None or key[0] != alias:
+            return
+        with self._lock:
+            self._queries.add(key)
+            self._time.add(key, duration)
+
+    def execute_wrapper(self, alias):
+        def wrapper(execute, sql, params, many, context):
+            started_at = time.time()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.record_query(alias, time.time() - started_at)
+        return wrapper
+
+    @contextmanager
+    def track_queries(self, aliases=None):
+        """
+        Counts and measures every query executed inside the block on the
+        given aliases (all configured aliases by default).
+        """
+        if aliases is None:
+            aliases = list(app.settings.DATABASES)
+        wrappers = []
+        try:
+            for alias in aliases:
+                wrapper = connections[alias].execute_wrapper(
+                    self.execute_wrapper(alias)
+                )
+                wrapper.__enter__()
+                wrappers.append(wrapper)
+            yield self
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+
+    def snapshot(self):
+        """
+        :return: copies of the summaries with the time they cover
+        """
+        with self._lock:
+            queries = SpaceSaving(self.capacity).merge(self._queries)
+            spent = SpaceSaving(self.capacity).merge(self._time)
+            return {
+                'queries': queries,
+                'time': spent,
+                'seconds': time.time() - self._started_at,
+            }
+
+    def report(self, limit=None):
+        return build_report(self.snapshot(), limit=limit)
+
+    def publish(self, interval=None):
+        """
+        Merges what was counted since the last publish into the shared
+        summary in the cache, so the report covers every worker.
+
+        Concurrent publishes may overwrite each other; the report is an
+        estimate anyway.
+
+        :param interval: do nothing if the last publish is more recent
+        """
+        now = time.time()
+        if interval and now - self._published_at < interval:
+            return False
+
+        with self._lock:
+            queries, spent = self._queries, self._time
+            started_at = self._published_at
+            self._queries = SpaceSaving(self.capacity)
+            self._time = SpaceSaving(self.capacity)
+            self._published_at = now
+
+        cache = caches[app.settings.SHARD_LOAD_CACHE_ALIAS]
+        stored = cache.get(LOAD_REPORT_CACHE_KEY)
+        if stored:
+            queries = stored['queries'].merge(queries)
+            spent = stored['time'].merge(spent)
+            started_at = stored['started_at']
+        published = {
+            'queries': queries,
+            'time': spent,
+            'started_at': started_at,
+            'seconds': now - started_at,
+        }
+        cache.set(LOAD_REPORT_CACHE_KEY, published, None)
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._time.clear()
+            self._started_at = self._published_at = time.time()
+
+
+def build_report(snapshot, limit=None):
+    """
+    Ranks tenants of every shard by time spent, then by query count.
+
+    :param snapshot: dict with ``queries`` and ``time`` summaries and the
+        ``seconds`` they cover
+    :param limit: max tenants per shard
+    :return: {alias: [TenantLoad, ...]}
+    """
+    queries, spent = snapshot['queries'], snapshot['time']
+    seconds = max(snapshot['seconds'], 1e-9)
+
+    keys = {key for key, _, _ in queries.top()}
+    keys.update(key for key, _, _ in spent.top())
+
+    report = {}
+    for key in keys:
+        alias, tenant = key
+        count, error = queries.get(key)
+        report.setdefault(alias, []).append(TenantLoad(
+            tenant=tenant,
+            queries=count,
+            queries_error=error,
+            qps=count / seconds,
+            time=spent.get(key)[0],
+        ))
+
+    for alias, loads in report.items():
+        loads.sort(key=lambda load: (load.time, load.queries), reverse=True)
+        if limit is not None:
+            del loads[limit:]
+    return report
+
+
+def get_published_report(limit=None):
+    """:return: the report built from the summary shared via the cache"""
+    snapshot = caches[app.settings.SHARD_LOAD_CACHE_ALIAS].get(
+        LOAD_REPORT_CACHE_KEY
+    )
+    if not snapshot:
+        return {}
+    return build_report(snapshot, limit=limit)
+
+
+def clear_published_report():
+    caches[app.settings.SHARD_LOAD_CACHE_ALIAS].delete(LOAD_REPORT_CACHE_KEY)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_load_tracker():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = TenantLoadTracker(
+                    app.settings.SHARD_LOAD_TRACKER_CAPACITY
+                )
+    return _tracker
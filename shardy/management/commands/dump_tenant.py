@@ -0,0 +1,57 @@
+# coding=utf-8
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shardy.dumps import dump_tenant, run_per_tenant, sharded_models
+from shardy.tenants import get_tenant_registry
+
+
+class Command(BaseCommand):
+    help = (
+        'Dumps the rows of sharded models to gzipped JSON lines, one '
+        'directory per tenant and one file per model'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Output directory')
+        parser.add_argument(
+            'tenants', nargs='*',
+            help='Tenant ids, all the tenants of the registry by default',
+        )
+        parser.add_argument(
+            '--models', nargs='+', default=None,
+            help='Sharded models as app_label.ModelName, all by default',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Tenants dumped in parallel',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Rows fetched from the database at a time',
+        )
+
+    def handle(self, *args, **options):
+        tenants = options['tenants'] or get_tenant_registry().get_tenant_ids()
+        dump = partial(
+            dump_tenant,
+            directory=options['directory'],
+            models=sharded_models(options['models']),
+            chunk_size=options['chunk_size'],
+        )
+        failed = 0
+        for tenant, result in run_per_tenant(
+                dump, tenants, workers=options['workers']
+        ):
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write('{}\tfailed\t{}'.format(tenant, result))
+            else:
+                self.stdout.write('{}\t{} rows'.format(
+                    tenant, sum(result.values())
+                ))
+        if failed:
+            raise CommandError('{} of {} tenants failed'.format(
+                failed, len(tenants)
+            ))
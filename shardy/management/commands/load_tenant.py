@@ -0,0 +1,63 @@
+# coding=utf-8
+import os
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shardy.dumps import load_tenant, run_per_tenant, sharded_models
+
+
+class Command(BaseCommand):
+    help = 'Loads the tenant dumps written by dump_tenant'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory of the dumps')
+        parser.add_argument(
+            'tenants', nargs='*',
+            help='Tenant ids, every tenant directory by default',
+        )
+        parser.add_argument(
+            '--models', nargs='+', default=None,
+            help='Sharded models as app_label.ModelName, all by default',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Tenants loaded in parallel',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows inserted at a time',
+        )
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Delete the rows the tenants have before loading',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        tenants = options['tenants'] or sorted(
+            name for name in os.listdir(directory)
+            if os.path.isdir(os.path.join(directory, name))
+        )
+        load = partial(
+            load_tenant,
+            directory=directory,
+            models=sharded_models(options['models']),
+            batch_size=options['batch_size'],
+            clear=options['clear'],
+        )
+        failed = 0
+        for tenant, result in run_per_tenant(
+                load, tenants, workers=options['workers']
+        ):
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write('{}\tfailed\t{}'.format(tenant, result))
+            else:
+                self.stdout.write('{}\t{} rows'.format(
+                    tenant, sum(result.values())
+                ))
+        if failed:
+            raise CommandError('{} of {} tenants failed'.format(
+                failed, len(tenants)
+            ))
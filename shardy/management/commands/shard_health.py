@@ -0,0 +1,41 @@
+# coding=utf-8
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from shardy.health import ShardHealth
+from shardy.tenants import get_tenant_registry
+
+
+class Command(BaseCommand):
+    help = 'Probes every shard of a sharded model with SELECT 1'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model', help='Sharded model as app_label.ModelName',
+        )
+        parser.add_argument(
+            '--using', default=None,
+            help='Replica suffix of the aliases to probe',
+        )
+
+    def handle(self, *args, **options):
+        model = apps.get_model(options['model'])
+        tenants = get_tenant_registry().get_tenants_by_alias(
+            model, using=options['using']
+        )
+        # a fresh tracker: the circuits of this process are not relevant
+        health = ShardHealth(threshold=1)
+        failed = 0
+        for alias in sorted(tenants):
+            if health.probe(alias):
+                self.stdout.write('{}\tok\t{} tenants'.format(
+                    alias, len(tenants[alias])
+                ))
+            else:
+                failed += 1
+                error = health.status()[alias][2]
+                self.stdout.write('{}\tunavailable\t{}'.format(alias, error))
+        if failed:
+            self.stderr.write('{} of {} shards unavailable'.format(
+                failed, len(tenants)
+            ))
@@ -0,0 +1,40 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+
+from shardy.load import clear_published_report, get_published_report
+
+
+class Command(BaseCommand):
+    help = 'Ranks tenants by load (query time and query count) per shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=10,
+            help='Max tenants shown per shard',
+        )
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Drop the collected counters after printing them',
+        )
+
+    def handle(self, *args, **options):
+        report = get_published_report(limit=options['limit'])
+        if not report:
+            self.stdout.write('No load data collected yet.')
+
+        for alias in sorted(report):
+            self.stdout.write(alias)
+            for load in report[alias]:
+                self.stdout.write(
+                    '  {tenant}\t{time:.3f}s\t{queries} queries '
+                    '(+/-{error})\t{qps:.2f} q/s'.format(
+                        tenant=load.tenant,
+                        time=load.time,
+                        queries=load.queries,
+                        error=load.queries_error,
+                        qps=load.qps,
+                    )
+                )
+
+        if options['reset']:
+            clear_published_report()
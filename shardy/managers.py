@@ -12,8 +12,22 @@ class ShardedPerTenantManager(models.Manager):
         return ShardPerTenantQuerySet(model=self.model, using=self._db)
 
     def raw(self, raw_query, model=None, query=None, params=None,
-            translations=None, using=None):
+            translations=None, using=None, shared_value=None):
+        """
+        :param shared_value: routes the query to the shard of this tenant,
+            the current tenant (shardy.tenants.tenant) by default
+        :param using: replica suffix
+        """
         return ShardRawPerTenantQuerySet(
             raw_query=raw_query, model=self.model,
-            params=params, using=using
+            params=params, translations=translations, using=using,
+            shared_value=shared_value,
         )
+
+    def raw_fan_out(self, raw_query, params=None, **kwargs):
+        """
+        Runs the raw query on every shard and streams the rows, see
+        shardy.fanout.fan_out_raw.
+        """
+        from .fanout import fan_out_raw
+        return fan_out_raw(self.model, raw_query, params=params, **kwargs)
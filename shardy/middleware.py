@@ -0,0 +1,59 @@
+# coding=utf-8
+from django.apps import apps
+
+from .identity_map import identity_map
+from .load import get_load_tracker
+from .unit_of_work import unit_of_work
+
+
+app = apps.get_app_config('shardy')
+
+
+class TenantLoadMiddleware(object):
+    """
+    Counts and measures the queries of every request per tenant and
+    periodically publishes the counters for ``manage.py shard_load_report``.
+    Does nothing unless SHARD_LOAD_TRACKING is enabled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not app.settings.SHARD_LOAD_TRACKING:
+            return self.get_response(request)
+
+        tracker = get_load_tracker()
+        with tracker.track_queries():
+            response = self.get_response(request)
+        tracker.publish(interval=app.settings.SHARD_LOAD_PUBLISH_INTERVAL)
+        return response
+
+
+class IdentityMapMiddleware(object):
+    """
+    Serves repeated get-by-pk lookups on sharded models from memory for the
+    duration of a request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_map():
+            return self.get_response(request)
+
+
+class UnitOfWorkMiddleware(object):
+    """
+    Buffers the writes of sharded models made by the view and flushes them
+    per shard once the response is built, see shardy.unit_of_work. Writes
+    are dropped when the view raises.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with unit_of_work():
+            return self.get_response(request)
@@ -1,6 +1,7 @@
 # coding=utf-8
 
 from .common import *
+from .fields import SnowflakeField
 
 try:
     from typedmodels.models import TypedModelMetaclass
@@ -1,7 +1,10 @@
 from django.db import models
 
+from ..identity_map import get_identity_map
+from ..unit_of_work import get_unit_of_work
+from .fields import SnowflakeField
 from ..managers import ShardedPerTenantManager
-from ..querysets import ReplicaAlias
+from ..querysets import ReplicaAlias, ShardedTypedQuerySet
 
 
 class ShardedPerTenantModel(models.Model):
@@ -12,6 +15,10 @@ class ShardedPerTenantModel(models.Model):
     """
     sharded_field = None
 
+    # save() and delete() are buffered inside a unit of work, buffered saves
+    # send no pre_save/post_save signals
+    buffer_writes = True
+
     objects = ShardedPerTenantManager()
 
     class Meta:
@@ -45,10 +52,64 @@ class ShardedPerTenantModel(models.Model):
 
         super(ShardedPerTenantModel, self).__init__(*args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        if self.buffer_writes and self._buffer_save(*args, **kwargs):
+            return
+        super(ShardedPerTenantModel, self).save(*args, **kwargs)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.add(self)
+
+    def _save_table(self, raw=False, cls=None, force_insert=False,
+                    force_update=False, using=None, update_fields=None):
+        meta = cls._meta
+        if (
+                self._state.adding and not force_update and
+                not update_fields and isinstance(meta.pk, SnowflakeField) and
+                self._get_pk_val(meta) is None
+        ):
+            # a fresh id can't exist yet, skip the UPDATE attempt
+            force_insert = True
+        return super(ShardedPerTenantModel, self)._save_table(
+            raw=raw, cls=cls, force_insert=force_insert,
+            force_update=force_update, using=using,
+            update_fields=update_fields,
+        )
+
+    def delete(self, *args, **kwargs):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.evict(self)
+        if self.buffer_writes and not args and not kwargs:
+            unit = get_unit_of_work()
+            if unit is not None and (
+                    self.pk is not None or self._state.adding
+            ):
+                unit.add_delete(self)
+                return None
+        return super(ShardedPerTenantModel, self).delete(*args, **kwargs)
+
+    def _buffer_save(self, force_insert=False, force_update=False,
+                     using=None, update_fields=None):
+        """
+        Registers the save in the active unit of work (see
+        shardy.unit_of_work), plain saves only.
+
+        :return: True if the save was buffered
+        """
+        unit = get_unit_of_work()
+        if (
+                unit is None or force_insert or force_update or using or
+                (update_fields is not None and self._state.adding)
+        ):
+            return False
+        unit.add_save(self, update_fields)
+        return True
+
 
-class ShardedTypedModelManager(models.Manager):
+class ShardedTypedModelManager(ShardedPerTenantManager):
     def get_queryset(self):
-        qs = super(ShardedTypedModelManager, self).get_queryset()
+        qs = ShardedTypedQuerySet(model=self.model, using=self._db)
         if hasattr(self.model, '_typedmodels_type'):
             if len(self.model._typedmodels_subtypes) > 1:
                 qs = qs.filter(type__in=self.model._typedmodels_subtypes)
@@ -0,0 +1,55 @@
+# coding=utf-8
+from django.db import models
+
+
+class SnowflakeField(models.BigIntegerField):
+    """
+    64-bit id generated in the process (see shardy.ids), unique across
+    shards without a sequence: tenants can be moved or merged between
+    shards and bulk inserts know their primary keys up front.
+
+        id = SnowflakeField(primary_key=True)
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        super(SnowflakeField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(SnowflakeField, self).deconstruct()
+        if kwargs.get('editable') is False:
+            del kwargs['editable']
+        return name, path, args, kwargs
+
+    @staticmethod
+    def generate(count=None):
+        """:return: a new id, or a list of ``count`` ids"""
+        from ..ids import get_id_generator
+        generator = get_id_generator()
+        if count is None:
+            return generator.next_id()
+        return generator.next_ids(count)
+
+    def get_pk_value_on_save(self, instance):
+        return self.generate()
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        if value is None and add:
+            value = self.generate()
+            setattr(model_instance, self.attname, value)
+        return value
+
+
+def assign_ids(model, objs):
+    """
+    Generates the primary keys of the objects that have none, with one
+    call to the generator, when the pk of the model is a SnowflakeField.
+    """
+    pk = model._meta.pk
+    if not isinstance(pk, SnowflakeField):
+        return
+    missing = [obj for obj in objs if getattr(obj, pk.attname) is None]
+    if missing:
+        for obj, value in zip(missing, pk.generate(len(missing))):
+            setattr(obj, pk.attname, value)
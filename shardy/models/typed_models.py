@@ -3,13 +3,11 @@ import types
 import django
 from django.db import models
 from django.db.models import Field
+from django.db.models.base import DEFERRED
 from django.utils.six import with_metaclass
 from typedmodels.models import TypedModelMetaclass
 
-from models import (
-    ShardedTypedModel,
-)
-from models.common import ShardedPerTenantModel, ShardedTypedModelManager
+from .common import ShardedPerTenantModel, ShardedTypedModelManager
 
 
 class SharedTypedModelMetaclass(TypedModelMetaclass):
@@ -79,9 +77,14 @@ class SharedTypedModelMetaclass(TypedModelMetaclass):
                         old_do_related_class(other, cls)
                         cls._meta.model_name = base_class_name.lower()
                     field.do_related_class = types.MethodType(do_related_class, field)
-                if isinstance(field, models.fields.related.RelatedField) and isinstance(field.rel.to, ShardedTypedModel) and field.rel.to.base_class:
-                    field.rel.limit_choices_to['type__in'] = field.rel.to._typedmodels_subtypes
-                    field.rel.to = field.rel.to.base_class
+                if isinstance(field, models.fields.related.RelatedField):
+                    remote_field = field.remote_field
+                    to = remote_field.model
+                    # lazy references ('app.Model') are strings here
+                    if isinstance(to, type) and issubclass(to, ShardedTypedModel) and to.base_class:
+                        remote_field.limit_choices_to['type__in'] = to._typedmodels_subtypes
+                        # typed subclasses are proxies, point at the table
+                        remote_field.model = to.base_class
                 field.contribute_to_class(base_class, field_name)
                 classdict.pop(field_name)
             base_class._meta.fields_from_subclasses.update(declared_fields)
@@ -96,6 +99,9 @@ class SharedTypedModelMetaclass(TypedModelMetaclass):
             })
 
         classdict['base_class'] = base_class
+        # the class holding _typedmodels_registry, recast() and from_db()
+        # look it up without walking the mro
+        classdict['_typedmodels_registry_base'] = base_class
 
         cls = super(TypedModelMetaclass, meta).__new__(meta, classname, bases, classdict)
 
@@ -140,6 +146,7 @@ class SharedTypedModelMetaclass(TypedModelMetaclass):
         else:
             # this is the base class
             cls._typedmodels_registry = {}
+            cls._typedmodels_registry_base = cls
 
             # Since fields may be added by subclasses, save original fields.
             cls._meta._typedmodels_original_fields = cls._meta.fields
@@ -179,6 +186,9 @@ class ShardedTypedModel(with_metaclass(SharedTypedModelMetaclass, ShardedPerTena
     # Class variable indicating if model should be automatically recasted after initialization
     _auto_recast = True
 
+    # set by the metaclass on the base class and its typed subclasses
+    _typedmodels_registry_base = None
+
     class Meta:
         abstract = True
 
@@ -186,14 +196,15 @@ class ShardedTypedModel(with_metaclass(SharedTypedModelMetaclass, ShardedPerTena
         # Calling __init__ on base class because some functions (e.g. save()) need access to field values from base
         # class.
 
-        # Move args to kwargs since base_class may have more fields defined with different ordering
-        args = list(args)
-        if len(args) > len(self._meta.fields):
-            # Daft, but matches old exception sans the err msg.
-            raise IndexError("Number of args exceeds number of fields")
-        for field_value, field in zip(args, self._meta.fields):
-            kwargs[field.attname] = field_value
-        args = []  # args were all converted to kwargs
+        if args:
+            # Move args to kwargs since base_class may have more fields defined with different ordering
+            fields = self._meta.fields
+            if len(args) > len(fields):
+                # Daft, but matches old exception sans the err msg.
+                raise IndexError("Number of args exceeds number of fields")
+            for field_value, field in zip(args, fields):
+                kwargs[field.attname] = field_value
+            args = ()  # args were all converted to kwargs
 
         if self.base_class:
             before_class = self.__class__
@@ -206,6 +217,57 @@ class ShardedTypedModel(with_metaclass(SharedTypedModelMetaclass, ShardedPerTena
         if self._auto_recast:
             self.recast()
 
+    @classmethod
+    def _get_typed_init_fields(cls, base):
+        """
+        :returns: (concrete fields of the registry base, their attnames,
+            position of ``type``), cached until subclasses add fields
+        """
+        fields = base._meta.concrete_fields
+        cached = base.__dict__.get('_typedmodels_init_fields')
+        if cached is None or cached[0] is not fields:
+            attnames = [field.attname for field in fields]
+            cached = (fields, attnames, attnames.index('type'))
+            base._typedmodels_init_fields = cached
+        return cached
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Builds the instance of the registered subclass for the ``type`` of
+        the row directly: no args to kwargs conversion, class swapping or
+        recast(). Models with their own __init__ take the regular path.
+        """
+        base = cls._typedmodels_registry_base
+        if (
+                base is None or not cls._auto_recast or
+                base.__init__ is not ShardedTypedModel.__init__
+        ):
+            return super(ShardedTypedModel, cls).from_db(db, field_names, values)
+
+        fields, attnames, type_index = cls._get_typed_init_fields(base)
+        row = values
+        if len(row) != len(fields) or field_names != attnames:
+            loaded = dict(zip(field_names, values))
+            row = [loaded.get(attname, DEFERRED) for attname in attnames]
+
+        typ = row[type_index]
+        if typ is DEFERRED:
+            # e.g. refresh_from_db() of deferred fields, trust the queryset
+            correct_cls = cls
+        else:
+            correct_cls = base._typedmodels_registry.get(typ)
+        if correct_cls is None or correct_cls.__init__ is not ShardedTypedModel.__init__:
+            # untyped or unknown type: recast() reports it
+            return super(ShardedTypedModel, cls).from_db(db, field_names, values)
+
+        new = base.__new__(base)
+        models.Model.__init__(new, *row)
+        new.__class__ = correct_cls
+        new._state.adding = False
+        new._state.db = db
+        return new
+
     def recast(self, typ=None):
         if not self.type:
             if not hasattr(self, '_typedmodels_type'):
@@ -215,10 +277,8 @@ class ShardedTypedModel(with_metaclass(SharedTypedModelMetaclass, ShardedPerTena
                 return
             self.type = self._typedmodels_type
 
-        for base in self.__class__.mro():
-            if issubclass(base, ShardedTypedModel) and hasattr(base, '_typedmodels_registry'):
-                break
-        else:
+        base = self._typedmodels_registry_base
+        if base is None:
             raise ValueError("No suitable base class found to recast!")
 
         if typ is None:
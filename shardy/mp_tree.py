@@ -0,0 +1,633 @@
+# coding=utf-8
+"""Materialized Path"""
+import operator
+from collections import Counter
+from functools import reduce
+
+from django.core import serializers
+from django.db import models, router, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat, Length, Substr
+from django.utils.translation import ugettext_noop as _
+from treebeard.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
+from treebeard.mp_tree import MP_Node
+
+from .managers import ShardedPerTenantManager
+from .models import ShardedPerTenantModel
+from .querysets import ShardPerTenantQuerySet
+
+
+def get_result_class(cls):
+    """
+    For the given model class, determine what class we should use for the
+    nodes returned by its tree methods (such as get_children).
+
+    See shardy.al_tree.get_result_class
+    """
+    base_class = cls._meta.get_field('path').model
+    if cls._meta.proxy_for_model == base_class:
+        return cls
+    else:
+        return base_class
+
+
+class MP_ShardedNodeQuerySet(ShardPerTenantQuerySet):
+    """Queryset for nodes in a Materialized Path tree."""
+
+    def delete(self):
+        """
+        Removes the nodes with all their descendants and updates numchild of
+        their parents, tenant by tenant.
+        """
+        removed = {}
+        for node in self.order_by('depth', 'path'):
+            subtrees = removed.setdefault(node.sharded_value, {})
+            # paths have a fixed step length, a prefix is an ancestor
+            if not any(node.path.startswith(path) for path in subtrees):
+                subtrees[node.path] = node
+
+        deleted = 0
+        counts = {}
+        for subtrees in removed.values():
+            tenant_deleted, tenant_counts = self._delete_subtrees(subtrees)
+            deleted += tenant_deleted
+            for label, count in tenant_counts.items():
+                counts[label] = counts.get(label, 0) + count
+        return deleted, counts
+
+    def _delete_subtrees(self, removed):
+        """
+        :param removed: dict path -> node of the subtree roots of a tenant
+        """
+        model = get_result_class(self.model)
+        node = next(iter(removed.values()))
+        nodes = model._get_tenant_nodes(node.sharded_value)
+
+        numchild = {}
+        for path, node in removed.items():
+            if node.depth > 1:
+                parent_path = model._get_basepath(path, node.depth - 1)
+                numchild[parent_path] = numchild.get(parent_path, 0) + 1
+
+        alias = router.db_for_write(model, instance=node)
+        with transaction.atomic(using=alias):
+            for parent_path, count in numchild.items():
+                nodes.filter(path=parent_path).update(
+                    numchild=F('numchild') - count
+                )
+            subtrees = nodes.filter(reduce(operator.or_, [
+                Q(path__startswith=path) for path in removed
+            ]))
+            return super(MP_ShardedNodeQuerySet, subtrees).delete()
+
+
+class MP_ShardedNodeManager(ShardedPerTenantManager):
+    """Custom manager for nodes in a Materialized Path tree."""
+
+    def get_queryset(self):
+        """Sets the custom queryset as the default."""
+        return MP_ShardedNodeQuerySet(
+            model=self.model, using=self._db
+        ).order_by('path')
+
+
+class MP_ShardedPerTenantNode(MP_Node, ShardedPerTenantModel):
+    """
+    Abstract model to create your own Materialized Path Trees.
+
+    Subtrees and ancestors are answered with a single indexed range or
+    ``IN`` lookup on ``path``. Paths are unique per tenant only, declare
+    ``unique_together = ((<sharded_field>, 'path'),)`` on the concrete
+    model. Moves and inserts between siblings rewrite every shifted branch
+    with one ``UPDATE`` of its path prefix, inside the tenant.
+    """
+
+    path = models.CharField(max_length=255, db_index=True)
+
+    # tree operations read what the previous ones wrote
+    buffer_writes = False
+
+    objects = MP_ShardedNodeManager()
+
+    class Meta:
+        """Abstract model."""
+        abstract = True
+
+    @classmethod
+    def _get_tenant_nodes(cls, shared_value):
+        lookup = {cls.sharded_field: shared_value}
+        return get_result_class(cls).objects.filter(**lookup)
+
+    @classmethod
+    def _new_node(cls, kwargs, shared_value=None):
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            # adding the passed (unsaved) instance to the tree
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attempted to add a tree node that is "
+                                       "already in the database")
+        else:
+            newobj = get_result_class(cls)(**kwargs)
+        if shared_value is not None and not newobj.sharded_value:
+            setattr(newobj, cls.sharded_field, shared_value)
+        return newobj
+
+    @classmethod
+    def add_root(cls, **kwargs):
+        """Adds a root node to the tree of the tenant of the new node."""
+        newobj = cls._new_node(kwargs)
+        last_root = cls.get_last_root_node(newobj.sharded_value)
+        if last_root and last_root.node_order_by:
+            # sorted insertion is delegated to add_sibling
+            return last_root.add_sibling('sorted-sibling', instance=newobj)
+
+        newobj.depth = 1
+        if last_root:
+            newobj.path = last_root._inc_path()
+        else:
+            newobj.path = cls._get_path(None, 1, 1)
+        newobj.save()
+        newobj._cached_parent_obj = None
+        return newobj
+
+    def add_child(self, **kwargs):
+        """Adds a child to the node."""
+        newobj = self._new_node(kwargs, self.sharded_value)
+        if self.node_order_by and not self.is_leaf():
+            # sorted insertion is delegated to add_sibling
+            last_child = self.get_last_child()
+            last_child._cached_parent_obj = self
+            newobj = last_child.add_sibling('sorted-sibling', instance=newobj)
+            self.numchild += 1
+            return newobj
+        nodes = self._get_tenant_nodes(self.sharded_value)
+
+        newobj.depth = self.depth + 1
+        last_child = nodes.filter(
+            depth=newobj.depth,
+            path__range=self._get_children_path_interval(self.path)
+        ).order_by('-path').first()
+        if last_child:
+            newobj.path = last_child._inc_path()
+        else:
+            newobj.path = self._get_path(self.path, newobj.depth, 1)
+
+        alias = router.db_for_write(newobj.__class__, instance=newobj)
+        with transaction.atomic(using=alias):
+            newobj.save()
+            nodes.filter(pk=self.pk).update(numchild=F('numchild') + 1)
+        self.numchild += 1
+        newobj._cached_parent_obj = self
+        return newobj
+
+    @classmethod
+    def get_root_nodes(cls, shared_value):
+        """:returns: A queryset containing the root nodes in the tree."""
+        return cls._get_tenant_nodes(shared_value).filter(depth=1)
+
+    @classmethod
+    def get_first_root_node(cls, shared_value):
+        """:returns: The first root node in the tree or ``None``"""
+        return cls.get_root_nodes(shared_value).first()
+
+    @classmethod
+    def get_last_root_node(cls, shared_value):
+        """:returns: The last root node in the tree or ``None``"""
+        return cls.get_root_nodes(shared_value).order_by('-path').first()
+
+    @classmethod
+    def get_tree(cls, shared_value, parent=None):
+        """
+        :returns: A *queryset* of nodes ordered as DFS, including the parent.
+            If no parent is given, the entire tree is returned.
+        """
+        nodes = cls._get_tenant_nodes(shared_value)
+        if parent is None:
+            return nodes
+        if parent.is_leaf():
+            return nodes.filter(pk=parent.pk)
+        return nodes.filter(
+            path__startswith=parent.path, depth__gte=parent.depth
+        )
+
+    def get_siblings(self):
+        """
+        :returns: A queryset of all the node's siblings, including the node
+            itself.
+        """
+        nodes = self._get_tenant_nodes(self.sharded_value).filter(
+            depth=self.depth
+        )
+        if self.depth > 1:
+            # making sure the non-root nodes share a parent
+            parentpath = self._get_basepath(self.path, self.depth - 1)
+            nodes = nodes.filter(
+                path__range=self._get_children_path_interval(parentpath)
+            )
+        return nodes
+
+    def get_children(self):
+        """:returns: A queryset of all the node's children"""
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        if self.is_leaf():
+            return nodes.none()
+        return nodes.filter(
+            depth=self.depth + 1,
+            path__range=self._get_children_path_interval(self.path)
+        )
+
+    def get_descendants(self):
+        """
+        :returns: A queryset of all the node's descendants as DFS, doesn't
+            include the node itself
+        """
+        if self.is_leaf():
+            return self._get_tenant_nodes(self.sharded_value).none()
+        return self.__class__.get_tree(
+            self.sharded_value, self
+        ).exclude(pk=self.pk)
+
+    def get_ancestors(self):
+        """
+        :returns: A queryset containing the current node object's ancestors,
+            starting by the root node and descending to the parent.
+        """
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        if self.is_root():
+            return nodes.none()
+
+        paths = [
+            self.path[0:pos]
+            for pos in range(0, len(self.path), self.steplen)[1:]
+        ]
+        return nodes.filter(path__in=paths).order_by('depth')
+
+    def get_root(self):
+        """:returns: the root node for the current node object."""
+        return self._get_tenant_nodes(self.sharded_value).get(
+            path=self.path[0:self.steplen]
+        )
+
+    def get_parent(self, update=False):
+        """
+        :returns: the parent node of the current node object.
+            Caches the result in the object itself to help in loops.
+        """
+        depth = int(len(self.path) / self.steplen)
+        if depth <= 1:
+            return
+        try:
+            if update:
+                del self._cached_parent_obj
+            else:
+                return self._cached_parent_obj
+        except AttributeError:
+            pass
+        parentpath = self._get_basepath(self.path, depth - 1)
+        self._cached_parent_obj = self._get_tenant_nodes(
+            self.sharded_value
+        ).get(path=parentpath)
+        return self._cached_parent_obj
+
+    def delete(self):
+        """Removes a node and all it's descendants."""
+        return self._get_tenant_nodes(self.sharded_value).filter(
+            pk=self.pk
+        ).delete()
+
+    def add_sibling(self, pos=None, **kwargs):
+        """Adds a new node as a sibling to the current node object."""
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+        newobj = self._new_node(kwargs, self.sharded_value)
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        newobj.depth = self.depth
+
+        newpos, siblings = None, []
+        if pos == 'sorted-sibling':
+            siblings = list(self.get_sorted_pos_queryset(
+                self.get_siblings(), newobj
+            ))
+            if siblings:
+                newpos = siblings[0]._get_lastpos_in_path()
+            else:
+                pos = 'last-sibling'
+
+        alias = router.db_for_write(newobj.__class__, instance=newobj)
+        with transaction.atomic(using=alias):
+            _, newpath = self._reorder_nodes_before_add_or_move(
+                nodes, pos, newpos, self.depth, self, siblings
+            )
+            parentpath = self._get_basepath(newpath, self.depth - 1)
+            if parentpath:
+                nodes.filter(path=parentpath).update(
+                    numchild=F('numchild') + 1
+                )
+            newobj.path = newpath
+            newobj.save()
+        return newobj
+
+    def move(self, target, pos=None):
+        """
+        Moves the current node and all it's descendants to a new position
+        relative to another node of the same tenant.
+        """
+        if target.sharded_value != self.sharded_value:
+            raise ValueError("Can't move a node to another tenant's tree.")
+        pos = self._prepare_pos_var_for_move(pos)
+        cls = get_result_class(self.__class__)
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        oldpath = self.path
+
+        if target.is_descendant_of(self) or (
+                target.pk == self.pk and pos.endswith('-child')
+        ):
+            raise InvalidMoveToDescendant(
+                _("Can't move node to a descendant."))
+
+        # moving to a child is moving next to the last child, or adding the
+        # first child
+        newdepth, newpos, siblings = target.depth, None, []
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            parent = target
+            newdepth += 1
+            if target.is_leaf():
+                newpos = 1
+                pos = 'first-sibling'
+            else:
+                target = target.get_last_child()
+                pos = {'first-child': 'first-sibling',
+                       'last-child': 'last-sibling',
+                       'sorted-child': 'sorted-sibling'}[pos]
+            parent.numchild += 1
+
+        if oldpath == target.path and (
+                pos == 'left' or
+                (pos in ('right', 'last-sibling') and
+                 target.path == target.get_last_sibling().path) or
+                (pos == 'first-sibling' and
+                 target.path == target.get_first_sibling().path)
+        ):
+            # not actually moving the node
+            return
+
+        if pos == 'sorted-sibling':
+            siblings = list(self.get_sorted_pos_queryset(
+                target.get_siblings(), self
+            ))
+            if siblings:
+                newpos = siblings[0]._get_lastpos_in_path()
+            else:
+                pos = 'last-sibling'
+
+        alias = router.db_for_write(cls, instance=self)
+        with transaction.atomic(using=alias):
+            oldpath, newpath = self._reorder_nodes_before_add_or_move(
+                nodes, pos, newpos, newdepth, target, siblings, oldpath, True
+            )
+            oldparentpath = self._get_parent_path_from_path(oldpath)
+            newparentpath = self._get_parent_path_from_path(newpath)
+            if oldparentpath != newparentpath:
+                if oldparentpath:
+                    nodes.filter(path=oldparentpath).update(
+                        numchild=F('numchild') - 1
+                    )
+                if newparentpath:
+                    nodes.filter(path=newparentpath).update(
+                        numchild=F('numchild') + 1
+                    )
+        self.path = newpath
+        self.depth = newdepth
+
+    @classmethod
+    def _reorder_nodes_before_add_or_move(cls, nodes, pos, newpos, newdepth,
+                                          target, siblings, oldpath=None,
+                                          movebranch=False):
+        """
+        Makes room for a node next to ``target``: the siblings right of the
+        new position are shifted one step, the branch at ``oldpath`` is moved
+        when ``movebranch``. See treebeard's MP_ComplexAddMoveHandler.
+
+        :returns: A tuple containing the old path and the new path.
+        """
+        if (
+                pos == 'last-sibling' or
+                (pos == 'right' and target == target.get_last_sibling())
+        ):
+            newpath = target.get_last_sibling()._inc_path()
+            if movebranch:
+                cls._move_branch(nodes, oldpath, newpath)
+            return oldpath, newpath
+
+        if newpos is None:
+            siblings = target.get_siblings()
+            siblings = {'left': siblings.filter(path__gte=target.path),
+                        'right': siblings.filter(path__gt=target.path),
+                        'first-sibling': siblings}[pos]
+            basenum = target._get_lastpos_in_path()
+            newpos = {'first-sibling': 1,
+                      'left': basenum,
+                      'right': basenum + 1}[pos]
+        # the paths before any branch is moved
+        siblings = list(siblings)
+        newpath = cls._get_path(target.path, newdepth, newpos)
+
+        # a branch moving left among its siblings is parked after the last
+        # one, out of the way of the shifted siblings
+        tempnewpath = None
+        if movebranch and len(oldpath) == len(newpath):
+            parentoldpath = cls._get_basepath(
+                oldpath, len(oldpath) // cls.steplen - 1
+            )
+            parentnewpath = cls._get_basepath(newpath, newdepth - 1)
+            if (
+                    parentoldpath == parentnewpath and
+                    siblings and
+                    newpath < oldpath
+            ):
+                last = target.get_last_sibling()
+                tempnewpath = cls._get_path(
+                    newpath, newdepth, last._get_lastpos_in_path() + 2
+                )
+                cls._move_branch(nodes, oldpath, tempnewpath)
+
+        # only the siblings up to the first hole need shifting
+        movesiblings = []
+        priorpath = newpath
+        for node in siblings:
+            if node.path > priorpath:
+                break
+            movesiblings.append(node)
+            priorpath = node._inc_path()
+
+        # the rightmost first, the next path is always free
+        for node in reversed(movesiblings):
+            nodepath = node._inc_path()
+            cls._move_branch(nodes, node.path, nodepath)
+            if movebranch and oldpath.startswith(node.path):
+                oldpath = nodepath + oldpath[len(nodepath):]
+            if target.path.startswith(node.path):
+                target.path = nodepath + target.path[len(nodepath):]
+
+        if movebranch:
+            cls._move_branch(nodes, tempnewpath or oldpath, newpath)
+        return oldpath, newpath
+
+    @classmethod
+    def _move_branch(cls, nodes, oldpath, newpath):
+        """Moves the branch at ``oldpath`` to ``newpath`` with one UPDATE."""
+        values = {'path': Concat(
+            Value(newpath, output_field=models.CharField()),
+            Substr('path', len(oldpath) + 1),
+        )}
+        if len(oldpath) != len(newpath):
+            values['depth'] = (
+                F('depth') + (len(newpath) - len(oldpath)) // cls.steplen
+            )
+        nodes.filter(path__startswith=oldpath).update(**values)
+
+    @classmethod
+    def dump_bulk(cls, shared_value, parent=None, keep_ids=True):
+        """
+        Dumps a tree branch to a python data structure. The sharded field is
+        left out of ``data`` so the dump can be loaded into any tenant.
+        """
+        cls = get_result_class(cls)
+
+        # fix_tree dumps trees whose depth and numchild may be wrong, the
+        # structure comes from the paths only
+        lookup = {cls.sharded_field: shared_value}
+        objs = cls._get_serializable_model().objects.filter(**lookup)
+        if parent:
+            objs = objs.filter(path__startswith=parent.path)
+
+        ret, lnk = [], {}
+        for pyobj in serializers.serialize('python', objs):
+            # django's serializer stores the attributes in 'fields'
+            fields = pyobj['fields']
+            path = fields['path']
+            depth = len(path) // cls.steplen
+            for name in ('depth', 'path', 'numchild', 'id', cls.sharded_field):
+                fields.pop(name, None)
+
+            newobj = {'data': fields}
+            if keep_ids:
+                newobj['id'] = pyobj['pk']
+
+            if (not parent and depth == 1) or (
+                    parent and len(path) == len(parent.path)
+            ):
+                ret.append(newobj)
+            else:
+                parentpath = cls._get_basepath(path, depth - 1)
+                lnk[parentpath].setdefault('children', []).append(newobj)
+            lnk[path] = newobj
+        return ret
+
+    @classmethod
+    def load_bulk(cls, shared_value, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure (see dump_bulk) to the tenant
+        tree, under ``parent`` or as new root nodes, in one transaction.
+
+        :returns: a list of the pks of the added nodes
+        """
+        cls = get_result_class(cls)
+        foreign_keys = [
+            field for field in cls._meta.fields if field.is_relation
+        ]
+        alias = router.db_for_write(
+            cls, exact_lookups={cls.sharded_field: shared_value}
+        )
+
+        added = []
+        stack = [(parent, node_struct) for node_struct in bulk_data[::-1]]
+        with transaction.atomic(using=alias):
+            while stack:
+                parent, node_struct = stack.pop()
+                data = dict(node_struct['data'])
+                for field in foreign_keys:
+                    # dumps store related pks, no need to fetch objects
+                    if field.name in data:
+                        data[field.attname] = data.pop(field.name)
+                data[cls.sharded_field] = shared_value
+                if keep_ids:
+                    data[cls._meta.pk.attname] = node_struct['id']
+
+                if parent:
+                    node = parent.add_child(**data)
+                else:
+                    node = cls.add_root(**data)
+                added.append(node.pk)
+                stack.extend(
+                    (node, child)
+                    for child in node_struct.get('children', [])[::-1]
+                )
+        return added
+
+    @classmethod
+    def find_problems(cls, shared_value):
+        """
+        Checks for problems in the tree of the tenant, with one query.
+
+        :returns: A tuple of five lists: the ids of the nodes with
+            characters not found in the ``alphabet``, with a wrong ``path``
+            length according to ``steplen``, of the orphaned nodes, of the
+            nodes with the wrong depth value for their path and of the nodes
+            that report a wrong number of children
+        """
+        cls = get_result_class(cls)
+        rows = list(cls._get_tenant_nodes(shared_value).values_list(
+            'pk', 'path', 'depth', 'numchild'
+        ))
+        paths = {path for _, path, _, _ in rows}
+        children = Counter(path[:-cls.steplen] for _, path, _, _ in rows)
+
+        evil_chars, bad_steplen, orphans = [], [], []
+        wrong_depth, wrong_numchild = [], []
+        for pk, path, depth, numchild in rows:
+            if any(char not in cls.alphabet for char in path):
+                evil_chars.append(pk)
+            elif len(path) % cls.steplen:
+                bad_steplen.append(pk)
+            elif (
+                    len(path) > cls.steplen and
+                    path[:-cls.steplen] not in paths
+            ):
+                orphans.append(pk)
+            elif depth != len(path) // cls.steplen:
+                wrong_depth.append(pk)
+            elif numchild != children[path]:
+                wrong_numchild.append(pk)
+        return evil_chars, bad_steplen, orphans, wrong_depth, wrong_numchild
+
+    @classmethod
+    def fix_tree(cls, shared_value, destructive=False):
+        """
+        Fixes the ``depth`` and ``numchild`` values of the tree of the
+        tenant.
+
+        :param destructive: dumps the tree, removes it and loads it back,
+            which also closes the holes in the paths and restores the
+            ordering of sorted trees. The primary keys are kept, but the
+            removal cascades to the models that refer to the nodes.
+        """
+        cls = get_result_class(cls)
+        nodes = cls._get_tenant_nodes(shared_value)
+        alias = router.db_for_write(
+            cls, exact_lookups={cls.sharded_field: shared_value}
+        )
+        with transaction.atomic(using=alias):
+            if destructive:
+                dump = cls.dump_bulk(shared_value, None, True)
+                nodes.delete()
+                cls.load_bulk(shared_value, dump, None, True)
+                return
+
+            depth = Length('path') / cls.steplen
+            nodes.exclude(depth=depth).update(depth=depth)
+
+            rows = list(nodes.values_list('pk', 'path', 'numchild'))
+            children = Counter(path[:-cls.steplen] for _, path, _ in rows)
+            for pk, path, numchild in rows:
+                if numchild != children[path]:
+                    nodes.filter(pk=pk).update(numchild=children[path])
@@ -0,0 +1,551 @@
+# coding=utf-8
+"""Nested Sets"""
+import operator
+from functools import reduce
+
+from django.core import serializers
+from django.db import router, transaction
+from django.db.models import Case, F, Max, Q, When
+from django.utils.translation import ugettext_noop as _
+from treebeard.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
+from treebeard.ns_tree import NS_Node
+
+from .managers import ShardedPerTenantManager
+from .models import ShardedPerTenantModel
+from .querysets import ShardPerTenantQuerySet
+
+
+def get_result_class(cls):
+    """
+    For the given model class, determine what class we should use for the
+    nodes returned by its tree methods (such as get_children).
+
+    See shardy.al_tree.get_result_class
+    """
+    base_class = cls._meta.get_field('lft').model
+    if cls._meta.proxy_for_model == base_class:
+        return cls
+    else:
+        return base_class
+
+
+class NS_ShardedNodeQuerySet(ShardPerTenantQuerySet):
+    """Queryset for nodes in a Nested Sets tree."""
+
+    def delete(self):
+        """
+        Removes the nodes with all their descendants and closes the gaps
+        they leave in their trees, tenant by tenant.
+        """
+        removed = {}
+        for node in self.order_by('tree_id', 'lft'):
+            subtrees = removed.setdefault(node.sharded_value, [])
+            if not any(node.is_descendant_of(other) for other in subtrees):
+                subtrees.append(node)
+
+        deleted = 0
+        counts = {}
+        for subtrees in removed.values():
+            tenant_deleted, tenant_counts = self._delete_subtrees(subtrees)
+            deleted += tenant_deleted
+            for label, count in tenant_counts.items():
+                counts[label] = counts.get(label, 0) + count
+        return deleted, counts
+
+    def _delete_subtrees(self, removed):
+        """:param removed: the subtree roots of a tenant"""
+        model = get_result_class(self.model)
+        nodes = model._get_tenant_nodes(removed[0].sharded_value)
+
+        alias = router.db_for_write(model, instance=removed[0])
+        with transaction.atomic(using=alias):
+            result = super(NS_ShardedNodeQuerySet, nodes.filter(
+                reduce(operator.or_, [
+                    Q(tree_id=node.tree_id, lft__range=(node.lft, node.rgt))
+                    for node in removed
+                ])
+            )).delete()
+            # the rightmost gap first, the bounds of the others stay valid
+            for node in reversed(removed):
+                model._close_gap(nodes, node.lft, node.rgt, node.tree_id)
+        return result
+
+
+class NS_ShardedNodeManager(ShardedPerTenantManager):
+    """Custom manager for nodes in a Nested Sets tree."""
+
+    def get_queryset(self):
+        """Sets the custom queryset as the default."""
+        return NS_ShardedNodeQuerySet(
+            model=self.model, using=self._db
+        ).order_by('tree_id', 'lft')
+
+
+class NS_ShardedPerTenantNode(NS_Node, ShardedPerTenantModel):
+    """
+    Abstract model to create your own Nested Sets Trees.
+
+    Every root starts its own ``tree_id`` inside the tenant, so adding a
+    node renumbers one tree only. Subtrees and ancestors are answered with
+    a single range query on ``lft``/``rgt``. Gaps are opened and closed
+    with one ``UPDATE`` of a tree, inside the tenant.
+    """
+
+    # tree operations read what the previous ones wrote
+    buffer_writes = False
+
+    objects = NS_ShardedNodeManager()
+
+    class Meta:
+        """Abstract model."""
+        abstract = True
+
+    @classmethod
+    def _get_tenant_nodes(cls, shared_value):
+        lookup = {cls.sharded_field: shared_value}
+        return get_result_class(cls).objects.filter(**lookup)
+
+    @classmethod
+    def _new_node(cls, kwargs, shared_value=None):
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            # adding the passed (unsaved) instance to the tree
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attempted to add a tree node that is "
+                                       "already in the database")
+        else:
+            newobj = get_result_class(cls)(**kwargs)
+        if shared_value is not None and not newobj.sharded_value:
+            setattr(newobj, cls.sharded_field, shared_value)
+        return newobj
+
+    @classmethod
+    def add_root(cls, **kwargs):
+        """Adds a root node to the tree of the tenant of the new node."""
+        newobj = cls._new_node(kwargs)
+        if cls.node_order_by:
+            last_root = cls.get_last_root_node(newobj.sharded_value)
+            if last_root:
+                # sorted insertion is delegated to add_sibling
+                return last_root.add_sibling(
+                    'sorted-sibling', instance=newobj
+                )
+        last_tree_id = cls._get_tenant_nodes(
+            newobj.sharded_value
+        ).aggregate(last=Max('tree_id'))['last']
+
+        newobj.tree_id = (last_tree_id or 0) + 1
+        newobj.depth = 1
+        newobj.lft = 1
+        newobj.rgt = 2
+        newobj.save()
+        return newobj
+
+    def add_child(self, **kwargs):
+        """Adds a child to the node, as the last one."""
+        newobj = self._new_node(kwargs, self.sharded_value)
+        if self.node_order_by and not self.is_leaf():
+            # sorted insertion is delegated to add_sibling
+            last_child = self.get_last_child()
+            last_child._cached_parent_obj = self
+            newobj = last_child.add_sibling('sorted-sibling', instance=newobj)
+            self.rgt += 2
+            return newobj
+        nodes = self._get_tenant_nodes(self.sharded_value)
+
+        alias = router.db_for_write(newobj.__class__, instance=newobj)
+        with transaction.atomic(using=alias):
+            # the in-memory bounds may be stale after other inserts
+            rgt = nodes.filter(pk=self.pk).values_list('rgt', flat=True)[0]
+            tree = nodes.filter(tree_id=self.tree_id)
+            tree.filter(rgt__gte=rgt).update(rgt=F('rgt') + 2)
+            tree.filter(lft__gt=rgt).update(lft=F('lft') + 2)
+
+            newobj.tree_id = self.tree_id
+            newobj.depth = self.depth + 1
+            newobj.lft = rgt
+            newobj.rgt = rgt + 1
+            newobj.save()
+        self.rgt = rgt + 2
+        return newobj
+
+    @classmethod
+    def get_root_nodes(cls, shared_value):
+        """:returns: A queryset containing the root nodes in the tree."""
+        return cls._get_tenant_nodes(shared_value).filter(lft=1)
+
+    @classmethod
+    def get_first_root_node(cls, shared_value):
+        """:returns: The first root node in the tree or ``None``"""
+        return cls.get_root_nodes(shared_value).first()
+
+    @classmethod
+    def get_last_root_node(cls, shared_value):
+        """:returns: The last root node in the tree or ``None``"""
+        return cls.get_root_nodes(shared_value).order_by('-tree_id').first()
+
+    @classmethod
+    def get_tree(cls, shared_value, parent=None):
+        """
+        :returns: A *queryset* of nodes ordered as DFS, including the parent.
+            If no parent is given, all trees are returned.
+        """
+        nodes = cls._get_tenant_nodes(shared_value)
+        if parent is None:
+            return nodes
+        if parent.is_leaf():
+            return nodes.filter(pk=parent.pk)
+        return nodes.filter(
+            tree_id=parent.tree_id, lft__range=(parent.lft, parent.rgt - 1)
+        )
+
+    def get_siblings(self):
+        """
+        :returns: A queryset of all the node's siblings, including the node
+            itself.
+        """
+        if self.lft == 1:
+            return self.get_root_nodes(self.sharded_value)
+        return self.get_parent(True).get_children()
+
+    def get_children(self):
+        """:returns: A queryset of all the node's children"""
+        return self.get_descendants().filter(depth=self.depth + 1)
+
+    def get_descendants(self):
+        """
+        :returns: A queryset of all the node's descendants as DFS, doesn't
+            include the node itself
+        """
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        if self.is_leaf():
+            return nodes.none()
+        return nodes.filter(
+            tree_id=self.tree_id, lft__range=(self.lft + 1, self.rgt - 1)
+        )
+
+    def get_ancestors(self):
+        """
+        :returns: A queryset containing the current node object's ancestors,
+            starting by the root node and descending to the parent.
+        """
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        if self.is_root():
+            return nodes.none()
+        return nodes.filter(
+            tree_id=self.tree_id, lft__lt=self.lft, rgt__gt=self.rgt
+        )
+
+    def get_root(self):
+        """:returns: the root node for the current node object."""
+        if self.lft == 1:
+            return self
+        return self._get_tenant_nodes(self.sharded_value).get(
+            tree_id=self.tree_id, lft=1
+        )
+
+    def get_parent(self, update=False):
+        """
+        :returns: the parent node of the current node object.
+            Caches the result in the object itself to help in loops.
+        """
+        if self.is_root():
+            return
+        try:
+            if update:
+                del self._cached_parent_obj
+            else:
+                return self._cached_parent_obj
+        except AttributeError:
+            pass
+        self._cached_parent_obj = self.get_ancestors().get(
+            depth=self.depth - 1
+        )
+        return self._cached_parent_obj
+
+    def delete(self):
+        """Removes a node and all it's descendants."""
+        return self._get_tenant_nodes(self.sharded_value).filter(
+            pk=self.pk
+        ).delete()
+
+    def add_sibling(self, pos=None, **kwargs):
+        """Adds a new node as a sibling to the current node object."""
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+        newobj = self._new_node(kwargs, self.sharded_value)
+        nodes = self._get_tenant_nodes(self.sharded_value)
+        newobj.depth = self.depth
+
+        target = self
+        if pos == 'sorted-sibling':
+            siblings = list(self.get_sorted_pos_queryset(
+                self.get_siblings(), newobj
+            ))
+            if siblings:
+                pos, target = 'left', siblings[0]
+            else:
+                pos = 'last-sibling'
+
+        alias = router.db_for_write(newobj.__class__, instance=newobj)
+        with transaction.atomic(using=alias):
+            if pos != 'last-sibling':
+                pos, target = self._get_sibling_target(pos, target)
+
+            if target.is_root():
+                newobj.lft = 1
+                newobj.rgt = 2
+                if pos == 'last-sibling':
+                    last_root = self.get_last_root_node(self.sharded_value)
+                    newobj.tree_id = last_root.tree_id + 1
+                else:
+                    newobj.tree_id = 1 if pos == 'first-sibling' else (
+                        target.tree_id
+                    )
+                    self._move_tree_right(nodes, newobj.tree_id)
+            else:
+                newobj.tree_id = target.tree_id
+                if pos == 'last-sibling':
+                    newpos = target.get_parent(True).rgt
+                    self._move_right(nodes, target.tree_id, newpos)
+                elif pos == 'first-sibling':
+                    newpos = target.lft
+                    self._move_right(nodes, target.tree_id, newpos - 1)
+                else:
+                    newpos = target.lft
+                    self._move_right(nodes, target.tree_id, newpos, True)
+                newobj.lft = newpos
+                newobj.rgt = newpos + 1
+            newobj.save()
+        return newobj
+
+    def move(self, target, pos=None):
+        """
+        Moves the current node and all it's descendants to a new position
+        relative to another node of the same tenant.
+        """
+        if target.sharded_value != self.sharded_value:
+            raise ValueError("Can't move a node to another tenant's tree.")
+        pos = self._prepare_pos_var_for_move(pos)
+        nodes = self._get_tenant_nodes(self.sharded_value)
+
+        if target.is_descendant_of(self) or (
+                target.pk == self.pk and pos.endswith('-child')
+        ):
+            raise InvalidMoveToDescendant(
+                _("Can't move node to a descendant."))
+
+        parent = None
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            if target.is_leaf():
+                parent = target
+                pos = 'last-child'
+            else:
+                target = target.get_last_child()
+                pos = {'first-child': 'first-sibling',
+                       'last-child': 'last-sibling',
+                       'sorted-child': 'sorted-sibling'}[pos]
+
+        if self == target and (
+                (pos == 'left') or
+                (pos in ('right', 'last-sibling') and
+                 target == target.get_last_sibling()) or
+                (pos == 'first-sibling' and
+                 target == target.get_first_sibling())
+        ):
+            # not actually moving the node
+            return
+
+        if pos == 'sorted-sibling':
+            siblings = list(self.get_sorted_pos_queryset(
+                target.get_siblings(), self
+            ))
+            if siblings:
+                pos, target = 'left', siblings[0]
+            else:
+                pos = 'last-sibling'
+
+        alias = router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=alias):
+            if pos in ('left', 'right', 'first-sibling'):
+                pos, target = self._get_sibling_target(pos, target)
+
+            # the in-memory bounds may be stale after other changes
+            fromobj = nodes.get(pk=self.pk)
+            gap = fromobj.rgt - fromobj.lft + 1
+            target_tree = target.tree_id
+
+            # first make a hole
+            if pos == 'last-child':
+                parent = nodes.get(pk=parent.pk)
+                newpos = parent.rgt
+                target_tree = parent.tree_id
+                self._move_right(nodes, parent.tree_id, newpos, False, gap)
+            elif target.is_root():
+                newpos = 1
+                if pos == 'last-sibling':
+                    target_tree = self.get_last_root_node(
+                        self.sharded_value
+                    ).tree_id + 1
+                elif pos == 'first-sibling':
+                    target_tree = 1
+                    self._move_tree_right(nodes, 1)
+                else:
+                    self._move_tree_right(nodes, target.tree_id)
+            else:
+                if pos == 'last-sibling':
+                    newpos = target.get_parent(True).rgt
+                    self._move_right(nodes, target.tree_id, newpos, False, gap)
+                elif pos == 'first-sibling':
+                    newpos = target.lft
+                    self._move_right(
+                        nodes, target.tree_id, newpos - 1, False, gap
+                    )
+                else:
+                    newpos = target.lft
+                    self._move_right(nodes, target.tree_id, newpos, True, gap)
+
+            # the hole may have shifted the moved branch
+            fromobj = nodes.get(pk=self.pk)
+            depthdiff = target.depth - fromobj.depth
+            if parent:
+                depthdiff += 1
+            jump = newpos - fromobj.lft
+
+            # move the branch to the hole and close the gap it leaves
+            nodes.filter(
+                tree_id=fromobj.tree_id,
+                lft__range=(fromobj.lft, fromobj.rgt)
+            ).update(
+                tree_id=target_tree,
+                lft=F('lft') + jump,
+                rgt=F('rgt') + jump,
+                depth=F('depth') + depthdiff,
+            )
+            self._close_gap(nodes, fromobj.lft, fromobj.rgt, fromobj.tree_id)
+
+    @staticmethod
+    def _get_sibling_target(pos, target):
+        """
+        Turns ``right`` into ``left`` of the next sibling (or into
+        ``last-sibling``) and ``left`` of the first sibling into
+        ``first-sibling``, the bounds of the returned target are read from
+        the database.
+
+        :returns: (pos, target)
+        """
+        siblings = list(target.get_siblings())
+        index = [node.pk for node in siblings].index(target.pk)
+        if pos == 'right':
+            if index == len(siblings) - 1:
+                return 'last-sibling', siblings[index]
+            pos, index = 'left', index + 1
+        if pos == 'left' and index == 0:
+            pos = 'first-sibling'
+        if pos == 'first-sibling':
+            index = 0
+        return pos, siblings[index]
+
+    @staticmethod
+    def _move_right(nodes, tree_id, rgt, lftmove=False, incdec=2):
+        """Opens a gap of ``incdec`` after ``rgt`` in one tree."""
+        lft = {'lft__gte' if lftmove else 'lft__gt': rgt}
+        nodes.filter(tree_id=tree_id, rgt__gte=rgt).update(
+            lft=Case(When(then=F('lft') + incdec, **lft), default=F('lft')),
+            rgt=F('rgt') + incdec,
+        )
+
+    @staticmethod
+    def _move_tree_right(nodes, tree_id):
+        nodes.filter(tree_id__gte=tree_id).update(tree_id=F('tree_id') + 1)
+
+    @staticmethod
+    def _close_gap(nodes, drop_lft, drop_rgt, tree_id):
+        """Closes the gap left by a removed or moved branch in one tree."""
+        gap = drop_rgt - drop_lft + 1
+        nodes.filter(
+            Q(lft__gt=drop_lft) | Q(rgt__gt=drop_lft), tree_id=tree_id
+        ).update(
+            lft=Case(
+                When(lft__gt=drop_lft, then=F('lft') - gap),
+                default=F('lft'),
+            ),
+            rgt=Case(
+                When(rgt__gt=drop_lft, then=F('rgt') - gap),
+                default=F('rgt'),
+            ),
+        )
+
+    @classmethod
+    def dump_bulk(cls, shared_value, parent=None, keep_ids=True):
+        """
+        Dumps a tree branch to a python data structure (one query, see
+        get_tree). The sharded field is left out of ``data`` so the dump
+        can be loaded into any tenant.
+        """
+        objs = cls._get_serializable_model().get_tree(shared_value, parent)
+
+        # the open ancestors of the current node, with their dumps
+        ret, stack = [], []
+        for node, pyobj in zip(objs, serializers.serialize('python', objs)):
+            # django's serializer stores the attributes in 'fields'
+            fields = pyobj['fields']
+            for name in ('lft', 'rgt', 'depth', 'tree_id', 'id',
+                         cls.sharded_field):
+                fields.pop(name, None)
+
+            newobj = {'data': fields}
+            if keep_ids:
+                newobj['id'] = pyobj['pk']
+
+            while stack and (
+                    stack[-1][0].tree_id != node.tree_id or
+                    stack[-1][0].rgt < node.lft
+            ):
+                stack.pop()
+            if stack:
+                stack[-1][1].setdefault('children', []).append(newobj)
+            else:
+                ret.append(newobj)
+            stack.append((node, newobj))
+        return ret
+
+    @classmethod
+    def load_bulk(cls, shared_value, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure (see dump_bulk) to the tenant
+        tree, under ``parent`` or as new root nodes, in one transaction.
+
+        :returns: a list of the pks of the added nodes
+        """
+        cls = get_result_class(cls)
+        foreign_keys = [
+            field for field in cls._meta.fields if field.is_relation
+        ]
+        alias = router.db_for_write(
+            cls, exact_lookups={cls.sharded_field: shared_value}
+        )
+
+        added = []
+        stack = [(parent, node_struct) for node_struct in bulk_data[::-1]]
+        with transaction.atomic(using=alias):
+            while stack:
+                parent, node_struct = stack.pop()
+                data = dict(node_struct['data'])
+                for field in foreign_keys:
+                    # dumps store related pks, no need to fetch objects
+                    if field.name in data:
+                        data[field.attname] = data.pop(field.name)
+                data[cls.sharded_field] = shared_value
+                if keep_ids:
+                    data[cls._meta.pk.attname] = node_struct['id']
+
+                if parent:
+                    node = parent.add_child(**data)
+                else:
+                    node = cls.add_root(**data)
+                added.append(node.pk)
+                stack.extend(
+                    (node, child)
+                    for child in node_struct.get('children', [])[::-1]
+                )
+        return added
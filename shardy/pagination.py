@@ -0,0 +1,199 @@
+# coding=utf-8
+"""Keyset (cursor) pagination of querysets spanning several shards"""
+import heapq
+
+from django.core import signing
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+
+CURSOR_SALT = 'shardy.pagination'
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class CursorPage(object):
+    """
+    Rows of one page, ``next_cursor`` is None on the last page. ``fan_out``
+    is the FanOutResult of the page: a partial page misses the rows of the
+    shards it lists as failed, timed out or skipped.
+    """
+
+    def __init__(self, object_list, next_cursor, fan_out):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.fan_out = fan_out
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def partial(self):
+        return self.fan_out.partial
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class ShardCursorPaginator(object):
+    """
+    Pages through a sharded queryset ordered by ``(ordering, pk)`` across
+    the shards of its tenants. Every page asks each shard for the
+    ``page_size`` rows after its own position, ``WHERE (key, pk) > (last
+    key, last pk)``, and merges them with a heap, so a page costs the same
+    at any depth. The positions of the shards travel in the opaque, signed
+    cursor of the next page.
+
+        paginator = ShardCursorPaginator(
+            Order.objects.filter(paid=True), '-created', page_size=50
+        )
+        page = paginator.page(request.GET.get('cursor'))
+
+    Rows are ordered by their key, then pk; rows of different shards with
+    the same key and pk come in any order. The ordering field should not
+    be nullable.
+    """
+
+    def __init__(self, queryset, ordering='pk', page_size=50, **kwargs):
+        """
+        :param queryset: queryset of a sharded model, narrowed per shard
+        :param ordering: field name, prefixed with '-' for descending order
+        :param kwargs: passed on to fan_out (tenant_ids, using, parallel,
+            timeout...)
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+        self.queryset = queryset
+        self.ordering = ordering
+        self.page_size = page_size
+        self.fan_out_kwargs = kwargs
+        self.descending = ordering.startswith('-')
+        name = ordering.lstrip('-')
+        opts = queryset.model._meta
+        self.field = opts.pk if name == 'pk' else opts.get_field(name)
+
+    def _key(self, obj):
+        """:return: (sort key, pk) of an instance"""
+        pk = obj.pk
+        if self.field.primary_key:
+            return pk, pk
+        return getattr(obj, self.field.attname), pk
+
+    def _after(self, key, pk):
+        """:return: filter of the rows after ``(key, pk)`` in the ordering"""
+        op = '__lt' if self.descending else '__gt'
+        if self.field.primary_key:
+            return Q(**{'pk' + op: pk})
+        name = self.field.attname
+        return Q(**{name + op: key}) | Q(**{name: key, 'pk' + op: pk})
+
+    def _order_by(self):
+        prefix = '-' if self.descending else ''
+        if self.field.primary_key:
+            return [prefix + 'pk']
+        return [prefix + self.field.attname, prefix + 'pk']
+
+    def encode_cursor(self, positions, exhausted):
+        """
+        :param positions: dict db alias -> (key, pk) of its last row read
+        :param exhausted: db aliases without rows left
+        """
+        return signing.dumps({
+            'o': self.ordering,
+            'p': {
+                alias: [_to_string(key), _to_string(pk)]
+                for alias, (key, pk) in positions.items()
+            },
+            'e': sorted(exhausted),
+        }, salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        """:return: (positions, exhausted), see encode_cursor"""
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            if data['o'] != self.ordering:
+                raise InvalidCursor('The cursor is of another ordering')
+            pk_field = self.queryset.model._meta.pk
+            positions = {
+                alias: (
+                    self.field.to_python(key), pk_field.to_python(pk)
+                )
+                for alias, (key, pk) in data['p'].items()
+            }
+            return positions, set(data['e'])
+        except InvalidCursor:
+            raise
+        except Exception:
+            raise InvalidCursor('Invalid cursor')
+
+    def page(self, cursor=None):
+        """
+        :param cursor: next_cursor of the previous page, None for the first
+        :return: CursorPage
+        """
+        from .fanout import fan_out
+
+        if cursor:
+            positions, exhausted = self.decode_cursor(cursor)
+        else:
+            positions, exhausted = {}, set()
+        limit = self.page_size
+        order_by = self._order_by()
+
+        def read(queryset):
+            alias = queryset.db
+            if alias in exhausted:
+                return []
+            if alias in positions:
+                queryset = queryset.filter(self._after(*positions[alias]))
+            # one more row tells whether the shard has rows left
+            return list(queryset.order_by(*order_by)[:limit + 1])
+
+        result = fan_out(self.queryset, read, **self.fan_out_kwargs)
+        rows = [
+            [self._key(obj) + (alias, obj) for obj in objs]
+            for alias, objs in result.results.items()
+        ]
+        merged = heapq.merge(
+            *rows, key=lambda row: row[:2], reverse=self.descending
+        )
+
+        object_list = []
+        positions = dict(positions)
+        for key, pk, alias, obj in merged:
+            if len(object_list) == limit:
+                break
+            object_list.append(obj)
+            positions[alias] = (key, pk)
+
+        exhausted = set(exhausted)
+        for alias, objs in result.results.items():
+            if len(objs) <= limit and (
+                    not objs or positions.get(alias) == self._key(objs[-1])
+            ):
+                exhausted.add(alias)
+                positions.pop(alias, None)
+
+        pending = set(result.results) - exhausted
+        pending.update(result.errors, result.skipped, result.timed_out)
+        next_cursor = None
+        if pending:
+            next_cursor = self.encode_cursor(positions, exhausted)
+        return CursorPage(object_list, next_cursor, result)
+
+
+def _to_string(value):
+    """Keys are decoded with the to_python() of their field"""
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
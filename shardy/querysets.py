@@ -1,10 +1,13 @@
 from django import apps
-from django.db import router
-from django.db.models import QuerySet
-from django.db.models.query import RawQuerySet
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections, router
+from django.db.models import Count, Model, QuerySet
+from django.db.models.query import ModelIterable, RawQuerySet
+from django.db.models.sql import Query
 
 from django.apps import apps
 
+from .identity_map import get_identity_map
 
 app = apps.get_app_config('shardy')
 
@@ -51,12 +54,65 @@ class ShardPerTenantQuerySet(QuerySet):
         )
         self._hints = hints or {}
         self._exact_lookups = {}
+        self._use_result_cache = False
+        self._result_cache_timeout = None
+        self._pinned_db = None
+        self._replica_first = None
 
     def _clone(self, **kwargs):
         clone = super(ShardPerTenantQuerySet, self)._clone(**kwargs)
         clone._exact_lookups = self._exact_lookups.copy()
+        clone._use_result_cache = self._use_result_cache
+        clone._result_cache_timeout = self._result_cache_timeout
+        clone._pinned_db = self._pinned_db
+        clone._replica_first = self._replica_first
         return clone
 
+    def cached(self, timeout=None):
+        """
+        Serves the results of this queryset from the tenant result cache.
+
+        Entries are keyed by shard alias, sql and params and are dropped as
+        soon as anything is written for the same tenant through the router.
+        Only evaluation (iteration, len, list) is cached, not count() or
+        exists(). Cached instances are shared between hits with the
+        local memory backend, don't modify them.
+
+        :param timeout: seconds to keep the entry, the configured TIMEOUT
+            by default
+        """
+        clone = self._chain()
+        clone._use_result_cache = True
+        clone._result_cache_timeout = timeout
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is None and self._use_result_cache:
+            self._result_cache = self._fetch_from_result_cache()
+        super(ShardPerTenantQuerySet, self)._fetch_all()
+
+    def _fetch_from_result_cache(self):
+        tenant = self._exact_lookups.get(self.model.sharded_field)
+        if tenant is None:
+            return None
+
+        from .cache import get_result_cache
+        alias = self.db
+        try:
+            sql, params = self.query.get_compiler(using=alias).as_sql()
+        except EmptyResultSet:
+            return None
+
+        cache = get_result_cache()
+        key = cache.make_key(
+            alias, tenant, sql, params, kind=self._iterable_class.__name__
+        )
+        results = cache.get(key)
+        if results is None:
+            results = list(self._iterable_class(self))
+            cache.set(key, results, self._result_cache_timeout)
+        return list(results)
+
     def _filter_or_exclude(self, *args, **kwargs):
         """
         Update our lookups when we get a filter or an exclude
@@ -72,10 +128,76 @@ class ShardPerTenantQuerySet(QuerySet):
         clone._exact_lookups.update(
             dict([(k, v) for k, v in kwargs.items() if '__' not in k])
         )
+        negate = args[0] if args else False
+        if (
+                not negate and
+                self.model.sharded_field not in clone._exact_lookups
+        ):
+            clone._infer_shard(kwargs)
         return clone
 
+    def _infer_shard(self, lookups):
+        """
+        Routes filters on related instances, the way related managers are
+        routed: filter(customer=customer) or filter(customer__in=[...])
+        takes the sharded value of the customers, or the shard a customer
+        was read from when it has none.
+        """
+        from .models import ShardedPerTenantModel
+
+        opts = self.model._meta
+        sharded_field = self.model.sharded_field
+        for lookup, value in lookups.items():
+            name, _, lookup_type = lookup.partition('__')
+            if lookup_type not in ('', 'exact', 'in'):
+                continue
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not field.many_to_one and not field.one_to_one:
+                continue
+            if lookup_type != 'in':
+                instances = [value]
+            elif isinstance(value, (QuerySet, Query)) or not isinstance(
+                    value, (list, tuple, set, frozenset)
+            ):
+                # listing a subquery would run it, expressions are not
+                # iterable
+                continue
+            else:
+                instances = list(value)
+            if not instances or not all(
+                    isinstance(instance, Model) for instance in instances
+            ):
+                continue
+
+            attname = getattr(field, 'attname', None)
+            if sharded_field in (field.name, attname):
+                # the related model is the tenant itself
+                target = field.target_field.attname
+                tenants = {
+                    getattr(instance, target) for instance in instances
+                }
+            elif all(
+                    isinstance(instance, ShardedPerTenantModel)
+                    for instance in instances
+            ):
+                tenants = {instance.sharded_value for instance in instances}
+            else:
+                continue
+
+            if len(tenants) == 1 and None not in tenants:
+                self._exact_lookups[sharded_field] = tenants.pop()
+                return
+            if len(instances) == 1 and instances[0]._state.db:
+                self._hints = dict(self._hints, instance=instances[0])
+                return
+
     @property
     def db(self):
+        if self._pinned_db is not None:
+            return self._pinned_db
         self._hints['exact_lookups'] = self._exact_lookups
         if not self._hints.get('instance') and getattr(self, '_instance', None):
             self._hints['instance'] = getattr(self, '_instance')
@@ -100,6 +222,141 @@ class ShardPerTenantQuerySet(QuerySet):
         self._exact_lookups = kwargs.copy()
         return super(ShardPerTenantQuerySet, self).create(**kwargs)
 
+    def get(self, *args, **kwargs):
+        """
+        Lookups by sharded field and pk are served from the active identity
+        map (see shardy.identity_map) after the first fetch.
+        """
+        if self._reads_replica_first():
+            return self._read_replica_first(
+                lambda queryset: queryset.get(*args, **kwargs),
+                self.filter(*args, **kwargs),
+            )
+        identity_map = get_identity_map()
+        if identity_map is None or args:
+            return super(ShardPerTenantQuerySet, self).get(*args, **kwargs)
+
+        pk = self._get_identity_map_pk(kwargs)
+        if pk is None:
+            return super(ShardPerTenantQuerySet, self).get(**kwargs)
+
+        clone = self.filter(**kwargs)
+        instance = identity_map.get(clone.db, self.model, pk)
+        if instance is None:
+            instance = super(ShardPerTenantQuerySet, clone).get()
+            identity_map.add(instance)
+        return instance
+
+    def exists(self):
+        if self._reads_replica_first():
+            return self._read_replica_first(
+                lambda queryset: queryset.exists(), self
+            )
+        return super(ShardPerTenantQuerySet, self).exists()
+
+    def replica_first(self, using=None):
+        """
+        get() and exists() read the replica of the shard first and go to
+        the primary only when the replica has no row, usually because it
+        lags, or can't be reached. Fallbacks are counted per shard, see
+        shardy.replicas.get_replica_stats. Shards without the replica alias
+        are read on the primary, other evaluations are not affected.
+
+        :param using: replica suffix, SHARD_REPLICA_SUFFIX by default
+        """
+        clone = self._chain()
+        clone._replica_first = using or app.settings.SHARD_REPLICA_SUFFIX
+        return clone
+
+    def _reads_replica_first(self):
+        return bool(
+            self._replica_first and not self._for_write and
+            self._pinned_db is None and self._result_cache is None
+        )
+
+    def _read_replica_first(self, read, routed):
+        """
+        :param read: called with the replica queryset, then with the
+            primary one if it raised DoesNotExist or returned False
+        :param routed: this queryset with the lookups of the read, routes
+            it to its shard
+        """
+        from .health import FAILURE_ERRORS
+        from .replicas import get_replica_stats
+
+        primary = self._chain()
+        primary._replica_first = None
+        primary._db = None
+        routed = routed._chain()
+        routed._replica_first = None
+        routed._db = None
+        alias = routed.db
+        suffix = self._replica_first
+        if ReplicaAlias(alias).get(suffix) not in connections.databases:
+            return read(primary)
+
+        replica = primary._chain()
+        replica._db = suffix
+        stats = get_replica_stats()
+        stats.record_read(alias)
+        try:
+            result = read(replica)
+        except self.model.DoesNotExist:
+            stats.record_miss(alias)
+        except FAILURE_ERRORS:
+            stats.record_error(alias)
+        else:
+            if result is not False:
+                return result
+            stats.record_miss(alias)
+        return read(primary)
+
+    def _get_identity_map_pk(self, lookups):
+        """
+        :return: the pk if the queryset is a plain get by pk, None otherwise
+        """
+        query = self.query
+        if (
+            query.where or query.select_related or query.annotations or
+            query.extra or query.select_for_update or
+            query.deferred_loading != (frozenset(), True) or
+            self._iterable_class is not ModelIterable or
+            self._prefetch_related_lookups
+        ):
+            return None
+
+        opts = self.model._meta
+        pk_names = {'pk', opts.pk.name, opts.pk.attname}
+        sharded_names = {self.model.sharded_field}
+        pk = None
+        for lookup, value in lookups.items():
+            name = lookup
+            if name.endswith('__exact'):
+                name = name[:-len('__exact')]
+            if name in pk_names:
+                pk = value
+            elif name not in sharded_names:
+                return None
+
+        if pk is None or not sharded_names & set(lookups):
+            return None
+        return opts.pk.to_python(pk)
+
+    def update(self, **kwargs):
+        rows = super(ShardPerTenantQuerySet, self).update(**kwargs)
+        self._evict_identity_map()
+        return rows
+
+    def delete(self):
+        result = super(ShardPerTenantQuerySet, self).delete()
+        self._evict_identity_map()
+        return result
+
+    def _evict_identity_map(self):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.evict_model(self.model)
+
     def get_or_create(self, defaults=None, **kwargs):
         """
         Look up an object with the given kwargs, creating one if necessary.
@@ -117,6 +374,11 @@ class ShardPerTenantQuerySet(QuerySet):
 
 
     def bulk_create(self, objs, batch_size=None):
+        """
+        Inserts objects of one tenant. Snowflake primary keys are generated
+        here, so no ids have to be returned by the database, and the shard
+        is routed once, not once per object.
+        """
         if objs:
             sharded_field = objs[0].__class__.sharded_field
             shared_values = {
@@ -127,10 +389,116 @@ class ShardPerTenantQuerySet(QuerySet):
                 raise ShardPerTenantQuerySetBulkCreate
 
             self._exact_lookups[sharded_field] = shared_values.pop()
-        return (
-            super(ShardPerTenantQuerySet, self)
-            .bulk_create(objs=objs, batch_size=batch_size)
+
+            from .models.fields import assign_ids
+            assign_ids(self.model, objs)
+        self._for_write = True
+        pinned_db, self._pinned_db = self._pinned_db, self.db
+        try:
+            return (
+                super(ShardPerTenantQuerySet, self)
+                .bulk_create(objs=objs, batch_size=batch_size)
+            )
+        finally:
+            self._pinned_db = pinned_db
+
+    def for_tenants(self, tenant_ids):
+        """
+        Filters the rows of several tenants living on the same shard and
+        routes the query to the shard of the first one.
+
+        :param tenant_ids: sharded values, all on one db alias
+        """
+        tenant_ids = list(tenant_ids)
+        sharded_field = self.model.sharded_field
+        clone = self.filter(**{sharded_field + '__in': tenant_ids})
+        clone._exact_lookups[sharded_field] = tenant_ids[0]
+        return clone
+
+    def fan_out(self, func=list, **kwargs):
+        """
+        Runs this queryset on every shard, see shardy.fanout.fan_out for
+        the arguments (tenant_ids, timeout, parallel...).
+
+            Order.objects.filter(paid=True).fan_out(len, timeout=0.5)
+
+        :param func: called with the queryset narrowed to each shard
+        :return: FanOutResult
+        """
+        from .fanout import fan_out
+        return fan_out(self, func, **kwargs)
+
+    def to_arrays(self, fields=None, across_shards=False,
+                  shard_column='shard', dtypes=None, chunk_size=2000,
+                  **kwargs):
+        """
+        Reads the rows into one NumPy array per field (see shardy.arrays),
+        a chunk of rows at a time, without model instances or row tuples.
+
+            columns = Order.objects.filter(paid=True).to_arrays(
+                ['id', 'total', 'created'], across_shards=True
+            )
+            columns['total'].sum()
+
+        :param fields: field names, all the concrete fields by default
+        :param across_shards: reads every shard (see fan_out for the
+            extra arguments: tenant_ids, timeout, parallel...) and adds the
+            sharded field as the tenant column
+        :param shard_column: name of the column with the db alias of every
+            row when reading across shards, None to leave it out
+        :param dtypes: dict field name -> numpy dtype, see field_dtype
+        :return: Columns, dict field name -> array
+        """
+        from .arrays import concatenate, read_arrays
+
+        if fields is None:
+            fields = [
+                field.attname for field in self.model._meta.concrete_fields
+            ]
+        fields = list(fields)
+        if not across_shards:
+            return read_arrays(self, fields, dtypes, chunk_size)
+
+        if self.model.sharded_field not in fields:
+            fields.append(self.model.sharded_field)
+        result = self.fan_out(
+            lambda queryset: read_arrays(
+                queryset, fields, dtypes, chunk_size
+            ),
+            **kwargs
+        )
+        columns = concatenate(
+            self.model, sorted(result.results.items()), fields, dtypes,
+            shard_column,
         )
+        columns.fan_out = result
+        return columns
+
+    def top_k(self, k, ordering, **kwargs):
+        """
+        The first ``k`` rows across shards, each shard returns its first
+        ``k`` and they are merged (see shardy.aggregates.top_k).
+
+            Order.objects.values('partner_id', 'customer_id').annotate(
+                revenue=Sum('total')
+            ).top_k(100, ['-revenue'])
+
+        :param ordering: list of field or annotation names
+        :return: TopRows
+        """
+        from .aggregates import top_k
+        return top_k(self, k, ordering, **kwargs)
+
+    def count_distinct(self, field, precision=14, **kwargs):
+        """
+        Approximate number of distinct values of a field across shards,
+        from merged HyperLogLog sketches: 0.81% relative standard error at
+        the default precision (see shardy.aggregates.count_distinct).
+
+        :return: ApproximateCount
+        """
+        from .aggregates import count_distinct
+        return count_distinct(self, field, precision=precision, **kwargs)
 
     def only(self, *fields):
         if fields == (None,):
@@ -144,7 +512,152 @@ class ShardPerTenantQuerySet(QuerySet):
         return super(ShardPerTenantQuerySet, self).only(*fields)
 
 
-class ShardRawPerTenantQuerySet(ShardPerTenantQuerySet, RawQuerySet):
+class ShardedTypedQuerySet(ShardPerTenantQuerySet):
+    """
+    Queryset of ShardedTypedModel: bulk writes of mixed subtypes and
+    counts per subtype.
+    """
 
-    def __init__(self, *args, **kwargs):
-        super(ShardRawPerTenantQuerySet, self).__init__(*args, **kwargs)
+    def _typed_objs(self, objs):
+        """
+        Validates the subtype of every object and fills the ``type`` column
+        (what save() enforces one object at a time).
+        """
+        allowed = getattr(self.model, '_typedmodels_subtypes', None)
+        for obj in objs:
+            typ = getattr(obj, '_typedmodels_type', None)
+            if not typ:
+                raise RuntimeError(
+                    "Untyped %s cannot be saved." % obj.__class__.__name__
+                )
+            if allowed is not None and typ not in allowed:
+                raise ValueError("%s is not a %s type" % (
+                    obj.__class__.__name__, self.model.__name__
+                ))
+            obj.type = typ
+        return objs
+
+    def _group_by_shard(self, objs):
+        """:returns: dict write alias -> objs of the shard"""
+        base = self.model._typedmodels_registry_base or self.model
+        aliases = {}
+        shards = {}
+        for obj in objs:
+            value = obj.sharded_value
+            if value not in aliases:
+                # the write group can map tenants unlike the read group
+                aliases[value] = router.db_for_write(
+                    base, exact_lookups={base.sharded_field: value}
+                )
+            shards.setdefault(aliases[value], []).append(obj)
+        return shards
+
+    def _base_queryset(self, alias):
+        """
+        :returns: queryset of the registry base class (all the subtype
+            fields) pinned to the write alias of a shard
+        """
+        base = self.model._typedmodels_registry_base or self.model
+        queryset = ShardedTypedQuerySet(model=base)
+        queryset._for_write = True
+        # routed once for the whole batch
+        queryset._pinned_db = alias
+        return queryset
+
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Inserts instances of any subtypes and tenants with one bulk insert
+        per shard (split by ``batch_size``).
+        """
+        from .models.fields import assign_ids
+        objs = self._typed_objs(list(objs))
+        assign_ids(self.model, objs)
+        for alias, shard_objs in self._group_by_shard(objs).items():
+            queryset = self._base_queryset(alias)
+            super(ShardPerTenantQuerySet, queryset).bulk_create(
+                shard_objs, batch_size=batch_size
+            )
+        return objs
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Updates ``fields`` (and ``type``) of instances of any subtypes and
+        tenants with one bulk update per shard (split by ``batch_size``).
+        """
+        objs = self._typed_objs(list(objs))
+        fields = list(fields)
+        if 'type' not in fields:
+            fields.append('type')
+        for alias, shard_objs in self._group_by_shard(objs).items():
+            queryset = self._base_queryset(alias)
+            super(ShardPerTenantQuerySet, queryset).bulk_update(
+                shard_objs, fields, batch_size=batch_size
+            )
+
+    def count_by_type(self):
+        """
+        :returns: dict subtype class -> number of rows, with one
+            ``GROUP BY type`` query
+        """
+        registry = self.model._typedmodels_registry
+        counts = self.order_by().values_list('type').annotate(
+            count=Count('pk')
+        )
+        return {
+            registry.get(typ, typ): count for typ, count in counts
+        }
+
+
+class ShardRawPerTenantQuerySet(RawQuerySet):
+    """
+    Raw query routed to the shard of ``shared_value``, the current tenant
+    (see shardy.tenants.tenant) by default, or to the db group of the model
+    when there is neither. The shard is resolved when the queryset is
+    created.
+    """
+
+    def __init__(self, raw_query, model=None, query=None, params=None,
+                 translations=None, using=None, hints=None,
+                 shared_value=None):
+        if shared_value is None:
+            from .tenants import get_current_tenant
+            shared_value = get_current_tenant()
+        self.shared_value = shared_value
+        self._alias = None
+        super(ShardRawPerTenantQuerySet, self).__init__(
+            raw_query, model=model, query=query, params=params,
+            translations=translations, using=using, hints=hints,
+        )
+
+    @property
+    def db(self):
+        if self._alias is None:
+            self._hints['exact_lookups'] = {
+                self.model.sharded_field: self.shared_value
+            }
+            alias = router.db_for_read(self.model, **self._hints)
+            if self._db and self._db != alias:
+                alias = ReplicaAlias(alias).get(self._db)
+            self._alias = alias
+        return self._alias
+
+    def _clone(self):
+        clone = self.__class__(
+            self.raw_query, model=self.model, query=self.query,
+            params=self.params, translations=self.translations,
+            using=self._db, hints=self._hints,
+            shared_value=self.shared_value,
+        )
+        clone._prefetch_related_lookups = self._prefetch_related_lookups[:]
+        return clone
+
+    def using(self, alias):
+        """
+        :param alias: replica suffix, the query stays on the shard
+        """
+        clone = self.__class__(
+            self.raw_query, model=self.model, params=self.params,
+            translations=self.translations, using=alias,
+            shared_value=self.shared_value,
+        )
+        return clone
@@ -0,0 +1,71 @@
+# coding=utf-8
+"""Replica-first reads and the counters of their primary fallbacks"""
+import threading
+from collections import Counter, namedtuple
+
+from django.apps import apps
+
+
+app = apps.get_app_config('shardy')
+
+ReplicaReads = namedtuple(
+    'ReplicaReads', ['reads', 'misses', 'errors', 'fallback_rate']
+)
+
+
+class ReplicaReadStats(object):
+    """
+    Counts the replica-first reads of every shard (by primary alias) and
+    how many of them went to the primary: ``misses`` found nothing on the
+    replica, usually because it lags, ``errors`` couldn't reach it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reads = Counter()
+        self._misses = Counter()
+        self._errors = Counter()
+
+    def record_read(self, alias):
+        with self._lock:
+            self._reads[alias] += 1
+
+    def record_miss(self, alias):
+        with self._lock:
+            self._misses[alias] += 1
+
+    def record_error(self, alias):
+        with self._lock:
+            self._errors[alias] += 1
+
+    def status(self):
+        """:return: dict alias -> ReplicaReads"""
+        with self._lock:
+            result = {}
+            for alias, reads in self._reads.items():
+                misses = self._misses[alias]
+                errors = self._errors[alias]
+                result[alias] = ReplicaReads(
+                    reads, misses, errors, (misses + errors) / reads
+                )
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._reads.clear()
+            self._misses.clear()
+            self._errors.clear()
+
+
+_replica_stats = None
+_replica_stats_lock = threading.Lock()
+
+
+def get_replica_stats():
+    """:return: the process wide ReplicaReadStats"""
+    global _replica_stats
+    if _replica_stats is None:
+        with _replica_stats_lock:
+            if _replica_stats is None:
+                _replica_stats = ReplicaReadStats()
+    return _replica_stats
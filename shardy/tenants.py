@@ -0,0 +1,160 @@
+# coding=utf-8
+"""Registry of the tenants (sharded values) known to the project"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+app = apps.get_app_config('shardy')
+
+
+def load_tenant_ids(config):
+    """
+    Enumerates the tenant ids described by the SHARD_TENANT_REGISTRY
+    setting, one of:
+
+    * a callable or its dotted path, returning an iterable of ids;
+    * a model with an optional filter: {'MODEL': 'stores.Store',
+      'FILTER': {'enabled': True}, 'FIELD': 'id'};
+    * a static list or tuple of ids.
+
+    :return: list of unique ids, in the order of the source
+    """
+    if config is None:
+        raise ImproperlyConfigured(
+            'SHARD_TENANT_REGISTRY setting is required to enumerate tenants'
+        )
+    if isinstance(config, str):
+        config = import_string(config)
+
+    if callable(config):
+        ids = config()
+    elif isinstance(config, dict):
+        model = apps.get_model(config['MODEL'])
+        ids = model._default_manager.filter(
+            **config.get('FILTER', {})
+        ).values_list(config.get('FIELD', 'pk'), flat=True)
+    elif isinstance(config, (list, tuple, set, frozenset)):
+        ids = config
+    else:
+        raise ImproperlyConfigured(
+            'Unsupported SHARD_TENANT_REGISTRY {!r}'.format(config)
+        )
+    # dict keeps the order
+    return list(dict.fromkeys(ids))
+
+
+class TenantRegistry(object):
+    """
+    Tenant ids and their db aliases, enumerated from the source once per
+    ``ttl`` seconds (SHARD_TENANT_REGISTRY_TTL) or on refresh().
+    """
+
+    def __init__(self, config=None, ttl=None):
+        """
+        :param config: tenant source (see load_tenant_ids), the
+            SHARD_TENANT_REGISTRY setting by default
+        :param ttl: seconds to keep the ids, SHARD_TENANT_REGISTRY_TTL by
+            default; 0 or None in the setting keeps them until refresh()
+        """
+        self._config = config
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._tenant_ids = None
+        self._aliases = {}
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return app.settings.SHARD_TENANT_REGISTRY_TTL
+
+    def _is_expired(self):
+        if self._loaded_at is None:
+            return True
+        ttl = self.ttl
+        return bool(ttl) and time.time() - self._loaded_at > ttl
+
+    def refresh(self):
+        """Enumerates the tenants again and drops the computed aliases."""
+        config = self._config
+        if config is None:
+            config = app.settings.SHARD_TENANT_REGISTRY
+        tenant_ids = load_tenant_ids(config)
+        with self._lock:
+            self._tenant_ids = tenant_ids
+            self._aliases = {}
+            self._loaded_at = time.time()
+        return tenant_ids
+
+    def get_tenant_ids(self):
+        """:return: list of the tenant ids"""
+        if self._is_expired():
+            return self.refresh()
+        return self._tenant_ids
+
+    def get_tenants_by_alias(self, model, using=None):
+        """
+        :param model: sharded model
+        :param using: replica suffix, see ShardedPerTenantModel.get_db_alias
+        :return: dict db alias -> list of the tenant ids on it
+        """
+        tenant_ids = self.get_tenant_ids()
+        key = (model._meta.label, using)
+        aliases = self._aliases.get(key)
+        if aliases is None:
+            aliases = {}
+            for tenant_id in tenant_ids:
+                aliases.setdefault(
+                    model.get_db_alias(tenant_id, using=using), []
+                ).append(tenant_id)
+            with self._lock:
+                # a concurrent refresh() wins
+                if self._tenant_ids is tenant_ids:
+                    self._aliases[key] = aliases
+        return aliases
+
+    def get_db_aliases(self, model, using=None):
+        """:return: set of the db aliases of all the tenants of the model"""
+        return set(self.get_tenants_by_alias(model, using=using))
+
+
+_tenant_registry = None
+_tenant_registry_lock = threading.Lock()
+
+
+def get_tenant_registry():
+    """:return: the process wide TenantRegistry"""
+    global _tenant_registry
+    if _tenant_registry is None:
+        with _tenant_registry_lock:
+            if _tenant_registry is None:
+                _tenant_registry = TenantRegistry()
+    return _tenant_registry
+
+
+_local = threading.local()
+
+
+def get_current_tenant():
+    """:return: the sharded value of the innermost tenant() block or None"""
+    return getattr(_local, 'tenant', None)
+
+
+@contextmanager
+def tenant(shared_value):
+    """
+    Makes ``shared_value`` the current tenant of the thread, queries that
+    can't carry a lookup (raw SQL) are routed to its shard.
+    """
+    outer = get_current_tenant()
+    _local.tenant = shared_value
+    try:
+        yield shared_value
+    finally:
+        _local.tenant = outer
@@ -1,6 +1,11 @@
 from django.db import models
 
-from shardy.models import ShardedPerTenantModel
+from shardy.al_tree import AL_ShardedPerTenantNode
+from shardy.models import (
+    ShardedPerTenantModel, ShardedTypedModel, SnowflakeField,
+)
+from shardy.mp_tree import MP_ShardedPerTenantNode
+from shardy.ns_tree import NS_ShardedPerTenantNode
 
 
 class TShardedModel(ShardedPerTenantModel):
@@ -27,3 +32,144 @@ class TNoneShardedModel(models.Model):
 
     class Meta:
         app_label = 'sharding_utils'
+
+
+class TShardedNode(AL_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    parent = models.ForeignKey(
+        'self', related_name='children_set', null=True, db_index=True,
+        on_delete=models.CASCADE
+    )
+    sib_order = models.PositiveIntegerField()
+    desc = models.CharField(max_length=255)
+
+    sharded_field = 'partner_id'
+
+
+class TShardedSortedNode(AL_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    parent = models.ForeignKey(
+        'self', related_name='children_set', null=True, db_index=True,
+        on_delete=models.CASCADE
+    )
+    val = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    node_order_by = ['val', 'desc']
+    sharded_field = 'partner_id'
+
+
+class TShardedMPNode(MP_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    sharded_field = 'partner_id'
+
+    class Meta:
+        unique_together = (('partner_id', 'path'),)
+
+
+class TShardedSortedMPNode(MP_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    val = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    node_order_by = ['val', 'desc']
+    sharded_field = 'partner_id'
+
+    class Meta:
+        unique_together = (('partner_id', 'path'),)
+
+
+class TShardedNSNode(NS_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    sharded_field = 'partner_id'
+
+
+class TShardedSortedNSNode(NS_ShardedPerTenantNode):
+    partner_id = models.IntegerField()
+    val = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    node_order_by = ['val', 'desc']
+    sharded_field = 'partner_id'
+
+
+class TShardedCachedNode(TShardedNode):
+    use_tree_cache = True
+
+    class Meta:
+        proxy = True
+
+
+class TShardedTypedModel(ShardedTypedModel):
+    partner_id = models.IntegerField()
+    name = models.CharField(max_length=10, null=True, blank=True)
+
+    sharded_field = 'partner_id'
+
+
+class TShardedTypedA(TShardedTypedModel):
+    a_value = models.IntegerField()
+
+
+class TShardedTypedB(TShardedTypedModel):
+    b_value = models.CharField(max_length=10)
+
+
+class TShardedTypedC(TShardedTypedModel):
+    a = models.ForeignKey(
+        TShardedTypedA, related_name='c_set', on_delete=models.CASCADE
+    )
+
+
+class TSnowflakeModel(ShardedPerTenantModel):
+    id = SnowflakeField(primary_key=True)
+    partner_id = models.IntegerField()
+    name = models.CharField(max_length=10, null=True, blank=True)
+
+    sharded_field = 'partner_id'
+
+
+class TStampedModel(ShardedPerTenantModel):
+    id = SnowflakeField(primary_key=True)
+    partner_id = models.IntegerField()
+    name = models.CharField(max_length=10, null=True, blank=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    sharded_field = 'partner_id'
+
+
+class TSnowflakeItem(ShardedPerTenantModel):
+    id = SnowflakeField(primary_key=True)
+    partner_id = models.IntegerField()
+    owner = models.ForeignKey(TSnowflakeModel, on_delete=models.CASCADE)
+    qty = models.IntegerField(default=0)
+
+    sharded_field = 'partner_id'
+
+
+class TShardedMetric(ShardedPerTenantModel):
+    partner_id = models.IntegerField()
+    value = models.FloatField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    flag = models.BooleanField(default=False)
+    created = models.DateTimeField()
+    day = models.DateField()
+    visits = models.IntegerField(null=True)
+    label = models.CharField(max_length=10)
+
+    sharded_field = 'partner_id'
+
+
+class TPartner(models.Model):
+    name = models.CharField(max_length=10)
+
+
+class TPartnerOrder(ShardedPerTenantModel):
+    partner = models.ForeignKey(TPartner, on_delete=models.CASCADE)
+    total = models.IntegerField(default=0)
+
+    sharded_field = 'partner_id'
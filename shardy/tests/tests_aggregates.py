@@ -0,0 +1,212 @@
+from decimal import Decimal
+
+from django.db import OperationalError
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from shardy.aggregates import ApproximateCount
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.sketches import HyperLogLog
+from .models import TShardedMetric
+from .tests_health import BROKEN, add_broken_alias
+from .tests_managers import SHARD, add_shard_alias
+
+
+def create_metrics(partner_id, values, label='x'):
+    now = timezone.now()
+    TShardedMetric.objects.bulk_create([
+        TShardedMetric(
+            partner_id=partner_id, value=value, amount=Decimal(value),
+            created=now, day=now.date(), label=label, visits=visits,
+        )
+        for value, visits in values
+    ])
+
+
+class HyperLogLogTestCase(TestCase):
+
+    def test_small_counts_are_exact(self):
+        hll = HyperLogLog()
+        hll.update([1, 2, 3, 2, 1, 'a'])
+        self.assertEqual(hll.count(), 4)
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_error_bounds(self):
+        for precision in (10, 12, 14):
+            hll = HyperLogLog(precision)
+            hll.update(range(50000))
+            hll.update(range(25000))
+            error = abs(hll.count() - 50000) / 50000
+            # three standard errors
+            self.assertLess(error, 3 * hll.relative_error)
+        self.assertAlmostEqual(HyperLogLog(14).relative_error, 0.0081, 4)
+
+    def test_merge_counts_the_union(self):
+        first, second, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+        first.update(range(0, 30000))
+        second.update(range(20000, 50000))
+        union.update(range(0, 50000))
+        self.assertEqual(first.merge(second).count(), union.count())
+
+    def test_hash_is_stable(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        first.update(['a', 'b', 1])
+        second.update(['b', 1, 'a'])
+        self.assertEqual(first._registers, second._registers)
+
+    def test_precision(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(3)
+        with self.assertRaises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(12))
+
+
+class ApproximateCountTestCase(TestCase):
+
+    def test_bounds(self):
+        count = ApproximateCount(1000, 0.01, None)
+        low, high = count.bounds()
+        self.assertTrue(low <= 1000 <= high, count)
+        self.assertEqual(count.bounds(), (980, 1020))
+        self.assertEqual(count.bounds(deviations=1), (990, 1010))
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class TopKTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        create_metrics(1, [(1, 5), (9, None), (4, 7)], label='a')
+        create_metrics(2, [(7, 1), (3, 2), (8, 3)], label='b')
+
+    def queryset(self):
+        return TShardedMetric.objects.all()
+
+    def test_instances(self):
+        rows = self.queryset().top_k(
+            3, ['-value'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual([row.value for row in rows], [9, 8, 7])
+        self.assertFalse(rows.partial)
+
+    def test_values_and_ascending(self):
+        rows = self.queryset().values('partner_id', 'value').top_k(
+            2, ['value'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual(
+            rows, [{'partner_id': 1, 'value': 1}, {'partner_id': 2,
+                                                   'value': 3}]
+        )
+        rows = self.queryset().values_list('value', flat=True).top_k(
+            4, ['-value'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual(rows, [9, 8, 7, 4])
+
+    def test_nulls_sort_last(self):
+        rows = self.queryset().values_list('visits', 'value').top_k(
+            6, ['-visits'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual(
+            [visits for visits, _ in rows], [7, 5, 3, 2, 1, None]
+        )
+
+    def test_several_fields(self):
+        rows = self.queryset().values_list('label', 'value').top_k(
+            4, ['-label', 'value'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual(
+            list(rows), [('b', 3), ('b', 7), ('b', 8), ('a', 1)]
+        )
+
+    def test_annotations(self):
+        create_metrics(1, [(10, 0)], label='b')
+        rows = self.queryset().values('partner_id', 'label').annotate(
+            total=Sum('value')
+        ).top_k(2, ['-total'], tenant_ids=[1, 2], parallel=False)
+        self.assertEqual(
+            [(row['partner_id'], row['label'], row['total']) for row in rows],
+            [(2, 'b', 18), (1, 'a', 14)],
+        )
+
+    def test_values_list_needs_the_ordering_field(self):
+        with self.assertRaises(ValueError):
+            self.queryset().values_list('label').top_k(
+                1, ['value'], tenant_ids=[1]
+            )
+        with self.assertRaises(ValueError):
+            self.queryset().top_k(0, ['value'], tenant_ids=[1])
+
+    def test_failed_shard_is_reported(self):
+        add_broken_alias(self)
+        rows = self.queryset().top_k(
+            2, ['-value'], tenant_ids=[1, 2], parallel=False
+        )
+        self.assertEqual([row.value for row in rows], [9, 4])
+        self.assertTrue(rows.partial)
+        self.assertIsInstance(rows.fan_out.errors[BROKEN], OperationalError)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class CrossShardAggregatesTestCase(TransactionTestCase):
+    """Tenant 1 on the default shard, tenant 3 on SHARD"""
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        add_shard_alias(self)
+        # visits 0..2999 on one shard, 2000..5999 on the other
+        create_metrics(1, [(i % 100, i) for i in range(3000)])
+        create_metrics(3, [(i % 100, i) for i in range(2000, 6000)])
+
+    def test_top_k_merges_the_shards(self):
+        for parallel in (False, True):
+            rows = TShardedMetric.objects.all().top_k(
+                5, ['-visits'], tenant_ids=[1, 3], parallel=parallel
+            )
+            self.assertEqual(
+                [(row.partner_id, row.visits) for row in rows],
+                [(3, 5999), (3, 5998), (3, 5997), (3, 5996), (3, 5995)],
+            )
+            self.assertEqual(
+                {row._state.db for row in rows}, {SHARD}
+            )
+        rows = TShardedMetric.objects.filter(visits__lt=2500).top_k(
+            3, ['-visits', 'partner_id'], tenant_ids=[1, 3]
+        )
+        self.assertEqual(
+            [(row.partner_id, row.visits) for row in rows],
+            [(1, 2499), (3, 2499), (1, 2498)],
+        )
+
+    def test_count_distinct_against_exact_counts(self):
+        queryset = TShardedMetric.objects.all()
+        exact = len(
+            set(queryset.filter(partner_id=1).values_list('visits', flat=True))
+            |
+            set(queryset.filter(partner_id=3).values_list('visits', flat=True))
+        )
+        self.assertEqual(exact, 6000)
+        for precision in (10, 14):
+            count = queryset.count_distinct(
+                'visits', precision=precision, tenant_ids=[1, 3]
+            )
+            self.assertFalse(count.partial)
+            low, high = count.bounds(deviations=3)
+            self.assertTrue(low <= exact <= high, count)
+
+        count = queryset.count_distinct('value', tenant_ids=[1, 3])
+        self.assertEqual(int(count), 100)
+        count = queryset.filter(visits__gte=5000).count_distinct(
+            'visits', tenant_ids=[1, 3], parallel=False
+        )
+        low, high = count.bounds()
+        self.assertTrue(low <= 1000 <= high, count)
@@ -0,0 +1,475 @@
+from unittest import mock
+
+from django.db import connections
+from django.db.models.signals import post_delete
+from django.test import TestCase
+from treebeard.exceptions import InvalidMoveToDescendant
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from .models import TShardedNode, TShardedSortedNode
+from .tests_typed_models import add_write_shards
+
+PID = 1
+OTHER_PID = 2
+
+
+def build_tree(partner_id):
+    """
+    1
+      11
+        111
+      12
+    2
+      21
+    """
+    root1 = TShardedNode.objects.create(
+        partner_id=partner_id, desc='1', sib_order=1
+    )
+    root2 = TShardedNode.objects.create(
+        partner_id=partner_id, desc='2', sib_order=2
+    )
+    node11 = root1.add_child(partner_id=partner_id, desc='11')
+    root1.add_child(partner_id=partner_id, desc='12')
+    node11.add_child(partner_id=partner_id, desc='111')
+    root2.add_child(partner_id=partner_id, desc='21')
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ALShardedPerTenantNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        build_tree(PID)
+        build_tree(OTHER_PID)
+
+    def get_node(self, desc):
+        return TShardedNode.objects.get(partner_id=PID, desc=desc)
+
+    def test_get_tree_single_query(self):
+        with self.assertNumQueries(1):
+            tree = TShardedNode.get_tree(PID)
+
+        self.assertEqual(
+            [(node.desc, node._cached_depth) for node in tree],
+            [('1', 1), ('11', 2), ('111', 3), ('12', 2), ('2', 1), ('21', 2)]
+        )
+
+    def test_get_tree_with_parent(self):
+        parent = self.get_node('1')
+
+        with self.assertNumQueries(1):
+            tree = TShardedNode.get_tree(PID, parent=parent)
+
+        self.assertEqual(
+            [(node.desc, node.get_depth()) for node in tree],
+            [('1', 1), ('11', 2), ('111', 3), ('12', 2)]
+        )
+
+    def test_get_ancestors(self):
+        node = self.get_node('111')
+
+        with self.assertNumQueries(1):
+            ancestors = list(node.get_ancestors())
+
+        self.assertEqual([n.desc for n in ancestors], ['1', '11'])
+        self.assertEqual([n.ancestor_distance for n in ancestors], [2, 1])
+        self.assertEqual(node.get_root().desc, '1')
+
+    def test_get_ancestors_of_root(self):
+        self.assertEqual(list(self.get_node('1').get_ancestors()), [])
+
+    def test_get_ancestors_is_filterable(self):
+        ancestors = self.get_node('111').get_ancestors().filter(desc='11')
+        self.assertEqual([n.desc for n in ancestors], ['11'])
+        self.assertEqual(ancestors.db, 'default')
+
+    def test_get_descendants(self):
+        node = self.get_node('1')
+
+        with self.assertNumQueries(1):
+            descendants = sorted(n.desc for n in node.get_descendants())
+
+        self.assertEqual(descendants, ['11', '111', '12'])
+        self.assertEqual(node.get_descendant_count(), 3)
+        self.assertTrue(self.get_node('111').is_descendant_of(node))
+        self.assertFalse(self.get_node('21').is_descendant_of(node))
+
+    def test_fallback_without_recursive_cte(self):
+        with mock.patch('shardy.al_tree.RECURSIVE_CTE_VENDORS', ()):
+            ancestors = list(self.get_node('111').get_ancestors())
+            descendants = self.get_node('1').get_descendants()
+
+            self.assertEqual([n.desc for n in ancestors], ['1', '11'])
+            self.assertEqual(
+                sorted(n.desc for n in descendants), ['11', '111', '12']
+            )
+
+    def test_dump_bulk(self):
+        with self.assertNumQueries(1):
+            dump = TShardedNode.dump_bulk(PID, keep_ids=False)
+
+        self.assertEqual(dump, [
+            {'data': {'desc': '1'}, 'children': [
+                {'data': {'desc': '11'}, 'children': [
+                    {'data': {'desc': '111'}},
+                ]},
+                {'data': {'desc': '12'}},
+            ]},
+            {'data': {'desc': '2'}, 'children': [
+                {'data': {'desc': '21'}},
+            ]},
+        ])
+
+    def test_dump_bulk_branch(self):
+        node = self.get_node('11')
+
+        dump = TShardedNode.dump_bulk(PID, parent=node)
+
+        self.assertEqual(dump[0]['id'], node.pk)
+        self.assertEqual(dump[0]['children'][0]['data'], {'desc': '111'})
+
+    def test_load_bulk_into_other_tenant(self):
+        new_pid = 3
+        dump = TShardedNode.dump_bulk(PID, keep_ids=False)
+
+        added = TShardedNode.load_bulk(new_pid, dump)
+
+        self.assertEqual(len(added), 6)
+        self.assertEqual(TShardedNode.dump_bulk(new_pid, keep_ids=False), dump)
+        self.assertEqual(
+            [n._cached_depth for n in TShardedNode.get_tree(new_pid)],
+            [1, 2, 3, 2, 1, 2]
+        )
+
+    def test_load_bulk_under_parent(self):
+        parent = self.get_node('1')
+
+        TShardedNode.load_bulk(PID, [{'data': {'desc': '13'}}], parent=parent)
+
+        self.assertEqual(
+            [(n.desc, n.sib_order) for n in parent.get_children()],
+            [('11', 1), ('12', 2), ('13', 3)]
+        )
+
+    def test_load_bulk_keep_ids_inserts_per_level(self):
+        dump = TShardedNode.dump_bulk(PID)
+        TShardedNode.objects.filter(partner_id=PID).delete()
+
+        # max(sib_order) + savepoint + one insert per level + release
+        with self.assertNumQueries(6):
+            added = TShardedNode.load_bulk(PID, dump, keep_ids=True)
+
+        self.assertEqual(sorted(added), sorted(
+            node['id'] for node in self._walk(dump)
+        ))
+        self.assertEqual(TShardedNode.dump_bulk(PID), dump)
+
+    def _walk(self, dump):
+        for node in dump:
+            yield node
+            for child in self._walk(node.get('children', [])):
+                yield child
+
+    def tree(self):
+        return [
+            (node.desc, node._cached_depth)
+            for node in TShardedNode.get_tree(PID)
+        ]
+
+    def test_move_first_child(self):
+        self.get_node('2').move(self.get_node('11'), 'first-child')
+
+        self.assertEqual(self.tree(), [
+            ('1', 1), ('11', 2), ('2', 3), ('21', 4), ('111', 3), ('12', 2)
+        ])
+
+    def test_move_last_child(self):
+        self.get_node('111').move(self.get_node('1'), 'last-child')
+
+        self.assertEqual(self.tree(), [
+            ('1', 1), ('11', 2), ('12', 2), ('111', 2), ('2', 1), ('21', 2)
+        ])
+
+    def test_move_left_and_right(self):
+        self.get_node('12').move(self.get_node('11'), 'left')
+        self.assertEqual(
+            [n.desc for n in self.get_node('1').get_children()], ['12', '11']
+        )
+
+        self.get_node('21').move(self.get_node('12'), 'right')
+        self.assertEqual(
+            [n.desc for n in self.get_node('1').get_children()],
+            ['12', '21', '11']
+        )
+
+    def test_move_to_roots(self):
+        self.get_node('11').move(self.get_node('1'), 'first-sibling')
+        self.get_node('21').move(self.get_node('2'), 'last-sibling')
+
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_root_nodes(PID)],
+            ['11', '1', '2', '21']
+        )
+        self.assertEqual(self.get_node('111').get_depth(update=True), 2)
+
+    def test_move_query_count_does_not_depend_on_subtree(self):
+        node = self.get_node('1')
+        target = self.get_node('21')
+        for i in range(20):
+            node.add_child(partner_id=PID, desc='x{}'.format(i))
+
+        # descendant check, savepoint, target sib_order, hole, node, release
+        with self.assertNumQueries(6):
+            node.move(target, 'left')
+
+    def test_delete_subtree(self):
+        self.get_node('12').move(self.get_node('2'), 'left')
+        deleted = []
+
+        def on_delete(instance, **kwargs):
+            deleted.append(instance.desc)
+
+        post_delete.connect(on_delete, sender=TShardedNode)
+        try:
+            result = self.get_node('1').delete()
+        finally:
+            post_delete.disconnect(on_delete, sender=TShardedNode)
+
+        self.assertEqual(result, (3, {'shardy.TShardedNode': 3}))
+        self.assertEqual(sorted(deleted), ['1', '11', '111'])
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(PID)], ['12', '2', '21']
+        )
+        self.assertEqual(
+            TShardedNode.objects.filter(partner_id=OTHER_PID).count(), 6
+        )
+
+    def test_delete_subtree_without_signals(self):
+        node = self.get_node('1')
+        deleted = []
+
+        def on_delete(instance, **kwargs):
+            deleted.append(instance.desc)
+
+        post_delete.connect(on_delete, sender=TShardedNode)
+        try:
+            # savepoint, subtree ids, one chunk, release
+            with self.assertNumQueries(4):
+                result = node.delete(send_signals=False)
+        finally:
+            post_delete.disconnect(on_delete, sender=TShardedNode)
+
+        self.assertEqual(result, (4, {'shardy.TShardedNode': 4}))
+        self.assertEqual(deleted, [])
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(PID)], ['2', '21']
+        )
+
+    def test_delete_subtree_in_chunks_without_cte(self):
+        node = self.get_node('1')
+
+        with mock.patch('shardy.al_tree.RECURSIVE_CTE_VENDORS', ()), \
+                mock.patch('shardy.al_tree.IN_BATCH_SIZE', 2):
+            result = node.delete(send_signals=False)
+
+        self.assertEqual(result[0], 4)
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(PID)], ['2', '21']
+        )
+        self.assertEqual(
+            TShardedNode.objects.filter(partner_id=OTHER_PID).count(), 6
+        )
+
+    def test_add_children(self):
+        node = self.get_node('11')
+
+        # depth, max sib_order, savepoint, inserts, release
+        with self.assertNumQueries(7):
+            children = node.add_children([
+                {'desc': '112'},
+                TShardedNode(desc='113'),
+                {'partner_id': PID, 'desc': '114'},
+            ])
+
+        self.assertEqual(
+            [(n.desc, n.sib_order, n._cached_depth) for n in children],
+            [('112', 2, 3), ('113', 3, 3), ('114', 4, 3)]
+        )
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(PID, self.get_node('11'))],
+            ['11', '111', '112', '113', '114']
+        )
+        self.assertFalse(TShardedNode.objects.filter(
+            partner_id=OTHER_PID, desc='112').exists())
+
+    def test_add_children_bulk_create(self):
+        node = self.get_node('12')
+        node._cached_depth = 2
+
+        # max sib_order, one insert
+        with self.assertNumQueries(2):
+            node.add_children([
+                TShardedNode(pk=1000 + i, desc='x{}'.format(i))
+                for i in range(100)
+            ])
+
+        self.assertEqual(node.get_children().count(), 100)
+        self.assertEqual(
+            node.get_children().last().sib_order, 100
+        )
+
+    def test_move_to_descendant(self):
+        with self.assertRaises(InvalidMoveToDescendant):
+            self.get_node('1').move(self.get_node('111'), 'first-child')
+        with self.assertRaises(InvalidMoveToDescendant):
+            self.get_node('1').move(self.get_node('1'), 'last-child')
+
+    def test_move_to_other_tenant(self):
+        other = TShardedNode.objects.get(partner_id=OTHER_PID, desc='2')
+        with self.assertRaises(ValueError):
+            self.get_node('11').move(other, 'last-child')
+        with self.assertRaises(ValueError):
+            self.get_node('11').move(other, 'left')
+
+        self.assertEqual(self.get_node('11').parent, self.get_node('1'))
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(OTHER_PID)],
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_move_keeps_other_tenant(self):
+        self.get_node('12').move(self.get_node('11'), 'left')
+
+        self.assertEqual(
+            [n.desc for n in TShardedNode.get_tree(OTHER_PID)],
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_get_tree_keeps_sib_order(self):
+        TShardedNode.objects.filter(partner_id=PID, desc='11').update(
+            sib_order=3
+        )
+
+        tree = TShardedNode.get_tree(PID)
+
+        self.assertEqual(
+            [node.desc for node in tree], ['1', '12', '11', '111', '2', '21']
+        )
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ALShardedPerTenantSortedNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def test_move_sorted(self):
+        root = TShardedSortedNode.objects.create(
+            partner_id=PID, val=1, desc='root'
+        )
+        other = TShardedSortedNode.objects.create(
+            partner_id=PID, val=2, desc='other'
+        )
+        child = root.add_child(partner_id=PID, val=1, desc='child')
+        other.add_child(partner_id=PID, val=0, desc='first')
+
+        child.move(other, 'sorted-child')
+
+        self.assertEqual(
+            [node.desc for node in TShardedSortedNode.get_tree(PID)],
+            ['root', 'other', 'first', 'child']
+        )
+
+    def test_get_tree_keeps_node_order_by(self):
+        root = TShardedSortedNode.objects.create(
+            partner_id=PID, val=1, desc='root'
+        )
+        root.add_child(partner_id=PID, val=3, desc='c')
+        root.add_child(partner_id=PID, val=1, desc='b')
+        root.add_child(partner_id=PID, val=1, desc='a')
+
+        tree = TShardedSortedNode.get_tree(PID)
+
+        self.assertEqual(
+            [node.desc for node in tree], ['root', 'a', 'b', 'c']
+        )
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {
+        'shardy.tshardednode': {'read': 'default', 'write': 'writes'},
+    }},
+)
+class ALShardedPerTenantWriteGroupTestCase(TestCase):
+    """The tenant reads from ``default`` and writes to a shard of its own"""
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.addCleanup(setattr, ShardedPerTenantRouter, '_lookup_cache', {})
+        self.write_alias = 'writes__{}'.format(PID)
+        add_write_shards(self, [self.write_alias], [TShardedNode])
+
+    def descs(self, alias):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT "desc" FROM {}'.format(
+                TShardedNode._meta.db_table
+            ))
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def load(self):
+        ids = TShardedNode.load_bulk(PID, [
+            {'data': {'desc': '1'}, 'children': [{'data': {'desc': '11'}}]},
+        ])
+        root = TShardedNode(pk=ids[0], partner_id=PID, desc='1')
+        root._state.adding = False
+        return root
+
+    def test_load_bulk_writes_to_the_write_alias(self):
+        self.load()
+
+        self.assertEqual(self.descs(self.write_alias), ['1', '11'])
+        self.assertEqual(self.descs('default'), [])
+
+    def test_load_bulk_under_another_tenant(self):
+        root = self.load()
+        with self.assertRaises(ValueError):
+            TShardedNode.load_bulk(OTHER_PID, [{'data': {'desc': '12'}}],
+                                   parent=root)
+
+        self.assertEqual(self.descs(self.write_alias), ['1', '11'])
+
+    def test_add_children_writes_to_the_write_alias(self):
+        root = self.load()
+        root.add_children([{'desc': '12'}, TShardedNode(desc='13')])
+
+        self.assertEqual(
+            self.descs(self.write_alias), ['1', '11', '12', '13']
+        )
+        self.assertEqual(self.descs('default'), [])
+
+    def test_add_children_of_another_tenant(self):
+        root = self.load()
+        with self.assertRaises(ValueError):
+            root.add_children([{'partner_id': OTHER_PID, 'desc': '12'}])
+
+        self.assertEqual(self.descs(self.write_alias), ['1', '11'])
+
+    def test_delete_on_the_write_alias(self):
+        root = self.load()
+        root.delete(send_signals=False)
+        self.assertEqual(self.descs(self.write_alias), [])
+
+        root = self.load()
+        root.delete()
+        self.assertEqual(self.descs(self.write_alias), [])
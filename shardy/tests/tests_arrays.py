@@ -0,0 +1,112 @@
+import datetime
+from decimal import Decimal
+
+import numpy
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from shardy.arrays import ArrayBuilder, Columns
+from shardy.db_routers import ShardedPerTenantRouter
+from .models import TShardedMetric, TShardedModel
+from .tests_health import BROKEN, add_broken_alias
+
+CREATED = datetime.datetime(2020, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+
+class ArrayBuilderTestCase(TestCase):
+
+    def test_grows_and_trims(self):
+        builder = ArrayBuilder(['a', 'b'], ['int64', 'object'], capacity=2)
+        for start in range(0, 9, 3):
+            builder.extend(
+                [range(start, start + 3), ['x'] * 3], 3
+            )
+
+        columns = builder.finish()
+
+        self.assertIsInstance(columns, Columns)
+        self.assertEqual(len(columns), 9)
+        self.assertEqual(columns['a'].tolist(), list(range(9)))
+        self.assertEqual(columns['a'].dtype, numpy.int64)
+        self.assertEqual(columns['b'].tolist(), ['x'] * 9)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ToArraysTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        TShardedMetric.objects.bulk_create([
+            TShardedMetric(
+                partner_id=1, value=i / 2.0, amount=Decimal('1.25') * i,
+                flag=bool(i % 2), created=CREATED, day=CREATED.date(),
+                visits=None if i == 3 else i, label='l{}'.format(i),
+            )
+            for i in range(5)
+        ])
+
+    def test_typed_columns(self):
+        columns = TShardedMetric.objects.filter(partner_id=1).order_by(
+            'id'
+        ).to_arrays(
+            ['id', 'value', 'amount', 'flag', 'created', 'day', 'visits',
+             'label'],
+            chunk_size=2,
+        )
+
+        self.assertEqual(len(columns), 5)
+        self.assertEqual(columns['id'].dtype, numpy.int64)
+        self.assertEqual(columns['value'].tolist(), [0, 0.5, 1, 1.5, 2])
+        self.assertEqual(columns['amount'].sum(), 12.5)
+        self.assertEqual(
+            columns['flag'].tolist(), [False, True, False, True, False]
+        )
+        self.assertEqual(
+            columns['created'][0],
+            numpy.datetime64('2020-05-01T12:30:00', 'us')
+        )
+        self.assertEqual(columns['day'][0], numpy.datetime64('2020-05-01'))
+        # nullable integers are floats with NaN
+        self.assertTrue(numpy.isnan(columns['visits'][3]))
+        self.assertEqual(numpy.nansum(columns['visits']), 7)
+        self.assertEqual(columns['label'][4], 'l4')
+
+    def test_default_fields_and_dtypes(self):
+        columns = TShardedMetric.objects.filter(partner_id=1).to_arrays(
+            dtypes={'label': 'U3'}
+        )
+
+        self.assertEqual(
+            list(columns),
+            [field.attname for field in TShardedMetric._meta.concrete_fields]
+        )
+        self.assertEqual(columns['label'].dtype, numpy.dtype('U3'))
+
+    def test_empty(self):
+        columns = TShardedMetric.objects.filter(partner_id=2).to_arrays(
+            ['id', 'value']
+        )
+        self.assertEqual(len(columns), 0)
+        self.assertEqual(columns['value'].dtype, numpy.float64)
+
+    def test_across_shards(self):
+        add_broken_alias(self)
+        TShardedModel.objects.create(partner_id=1, name='a')
+        TShardedModel.objects.create(partner_id=3, name='c')
+
+        columns = TShardedModel.objects.all().to_arrays(
+            ['name'], across_shards=True, tenant_ids=[1, 2, 3],
+            parallel=False,
+        )
+
+        self.assertEqual(sorted(columns['name'].tolist()), ['a', 'c'])
+        # tenant and shard columns
+        self.assertEqual(sorted(columns['partner_id'].tolist()), [1, 3])
+        self.assertEqual(columns['shard'].tolist(), ['default', 'default'])
+        self.assertTrue(columns.partial)
+        self.assertIn(BROKEN, columns.fan_out.errors)
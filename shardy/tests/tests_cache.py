@@ -0,0 +1,180 @@
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from app.models import AppTShardedModel
+from shardy import cache as result_cache
+from shardy.cache import (
+    DjangoCacheBackend,
+    LocalMemoryBackend,
+    TenantResultCache,
+    build_result_cache,
+)
+from shardy.db_routers import ShardedPerTenantRouter
+
+PID = 1
+
+
+class LocalMemoryBackendTestCase(TestCase):
+
+    def test_lru_eviction(self):
+        backend = LocalMemoryBackend(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), 3)
+
+    def test_generation_changes_keys(self):
+        cache = TenantResultCache(LocalMemoryBackend())
+        key = cache.make_key('default', PID, 'SELECT 1', [])
+        cache.set(key, [1])
+
+        cache.invalidate(PID)
+
+        new_key = cache.make_key('default', PID, 'SELECT 1', [])
+        self.assertNotEqual(key, new_key)
+        self.assertIsNone(cache.get(new_key))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_generations_are_bounded(self):
+        backend = LocalMemoryBackend(max_entries=2)
+        cache = TenantResultCache(backend)
+        key = cache.make_key('default', PID, 'SELECT 1', [])
+        cache.set(key, [1])
+        cache.invalidate(PID)
+        stale_key = cache.make_key('default', PID, 'SELECT 1', [])
+        cache.set(stale_key, [2])
+
+        cache.invalidate(PID)
+        cache.invalidate(2)
+        cache.invalidate(3)
+
+        self.assertEqual(len(backend._generations), 2)
+        new_key = cache.make_key('default', PID, 'SELECT 1', [])
+        self.assertNotIn(new_key, (key, stale_key))
+        self.assertIsNone(cache.get(new_key))
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+)
+class DjangoCacheBackendTestCase(TestCase):
+
+    def test_generation(self):
+        backend = DjangoCacheBackend()
+        backend.clear()
+        generation = backend.get_generation('1')
+        self.assertEqual(backend.get_generation('1'), generation)
+
+        backend.incr_generation('1')
+        backend.incr_generation('1')
+
+        self.assertEqual(backend.get_generation('1'), generation + 2)
+
+    def test_lost_generation_does_not_revive_entries(self):
+        backend = DjangoCacheBackend()
+        backend.clear()
+        cache = TenantResultCache(backend)
+        key = cache.make_key('default', 1, 'SELECT 1', ())
+        cache.set(key, ['stale'])
+
+        # the generation is evicted, the entry itself is not
+        backend._cache.delete(backend._generation_key('1'))
+        self.assertNotEqual(cache.make_key('default', 1, 'SELECT 1', ()), key)
+        backend.incr_generation('1')
+        self.assertNotEqual(cache.make_key('default', 1, 'SELECT 1', ()), key)
+
+    def test_build(self):
+        cache = build_result_cache({'BACKEND': 'django', 'TIMEOUT': 10})
+        self.assertIsInstance(cache.backend, DjangoCacheBackend)
+        self.assertEqual(cache.timeout, 10)
+
+        with self.assertRaises(ValueError):
+            build_result_cache({'BACKEND': 'redis'})
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+    SHARD_RESULT_CACHE={'BACKEND': 'locmem'},
+)
+class CachedQuerySetTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        result_cache._result_cache = None
+        AppTShardedModel.objects.create(partner_id=PID, name='first')
+
+    def tearDown(self):
+        result_cache._result_cache = None
+
+    def test_hit(self):
+        qs = AppTShardedModel.objects.filter(partner_id=PID).cached()
+        self.assertEqual(len(list(qs)), 1)
+
+        with self.assertNumQueries(0):
+            names = [
+                obj.name for obj in
+                AppTShardedModel.objects.filter(partner_id=PID).cached()
+            ]
+
+        self.assertEqual(names, ['first'])
+        self.assertEqual(
+            result_cache.get_result_cache().stats()['hits'], 1
+        )
+
+    def test_write_invalidates_tenant(self):
+        list(AppTShardedModel.objects.filter(partner_id=PID).cached())
+
+        AppTShardedModel.objects.create(partner_id=PID, name='second')
+
+        with self.assertNumQueries(1):
+            objs = list(
+                AppTShardedModel.objects.filter(partner_id=PID).cached()
+            )
+        self.assertEqual(len(objs), 2)
+
+    def test_write_in_transaction_invalidates_on_commit(self):
+        backend = result_cache.get_result_cache().backend
+        generation = backend.get_generation(str(PID))
+
+        with transaction.atomic():
+            for name in ('second', 'third'):
+                AppTShardedModel.objects.create(partner_id=PID, name=name)
+            self.assertEqual(
+                backend.get_generation(str(PID)), generation + 2
+            )
+            callbacks = [
+                func for _, func in connection.run_on_commit
+                if getattr(func, 'tenant', None) == PID
+            ]
+
+        # the test case transaction never commits
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(backend.get_generation(str(PID)), generation + 3)
+
+    def test_values_are_cached_separately(self):
+        list(AppTShardedModel.objects.filter(partner_id=PID).cached())
+
+        values = list(
+            AppTShardedModel.objects.filter(partner_id=PID)
+            .values('name').cached()
+        )
+
+        self.assertEqual(values, [{'name': 'first'}])
+
+    def test_not_cached_without_opt_in(self):
+        list(AppTShardedModel.objects.filter(partner_id=PID))
+
+        with self.assertNumQueries(1):
+            list(AppTShardedModel.objects.filter(partner_id=PID))
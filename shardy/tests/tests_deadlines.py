@@ -0,0 +1,176 @@
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from django.db import connections
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.deadlines import (
+    Deadline, DeadlineExceeded, deadline, get_current_deadline,
+)
+from shardy.fanout import fan_out
+from shardy.health import ShardHealth
+from .models import TShardedModel
+
+# counts to 10**9, runs for minutes unless interrupted
+SLOW_SQL = (
+    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c '
+    'WHERE x < 1000000000) SELECT count(*) FROM c'
+)
+
+
+def mock_connection(in_atomic_block=False):
+    """:returns: mock of a PostgreSQL connection recording on_commit()"""
+    connection = mock.MagicMock(
+        vendor='postgresql', in_atomic_block=in_atomic_block,
+        run_on_commit=[],
+    )
+    connection.on_commit.side_effect = (
+        lambda func: connection.run_on_commit.append((set(), func))
+    )
+    return connection
+
+
+def slow_on(alias):
+    """:returns: fan-out func running SLOW_SQL on the shard ``alias``"""
+
+    def func(queryset):
+        if queryset.db == alias:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(SLOW_SQL)
+        return list(queryset.values_list('name', flat=True))
+    return func
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class DeadlineTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        TShardedModel.objects.create(partner_id=1, name='a')
+
+    def test_interrupts_slow_sqlite_query(self):
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            with Deadline(0.05).apply('default'):
+                with connections['default'].cursor() as cursor:
+                    cursor.execute(SLOW_SQL)
+        self.assertLess(time.monotonic() - started, 5)
+
+        # the handler is removed with the block
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def test_expired_before_query(self):
+        expired = Deadline(0)
+        with self.assertRaises(DeadlineExceeded):
+            with expired.apply('default'):
+                pass
+
+    def test_fan_out_flags_shards_missing_deadline(self):
+        health = ShardHealth(threshold=1)
+        result = fan_out(TShardedModel, slow_on('default'), tenant_ids=[1],
+                         parallel=False, health=health, timeout=0.05)
+
+        self.assertEqual(result.timed_out, ['default'])
+        self.assertEqual(result.results, {})
+        self.assertTrue(result.partial)
+        # a slow shard is not a broken one
+        self.assertFalse(health.is_open('default'))
+
+    def test_fan_out_within_deadline(self):
+        result = fan_out(TShardedModel, slow_on(None), tenant_ids=[1],
+                         parallel=False, timeout=10)
+
+        self.assertEqual(result.results, {'default': ['a']})
+        self.assertFalse(result.partial)
+
+    def test_queryset_fan_out_uses_current_deadline(self):
+        TShardedModel.objects.create(partner_id=1, name='b')
+        queryset = TShardedModel.objects.all().filter(name='b')
+
+        with deadline(10) as current:
+            with deadline(20) as nested:
+                self.assertIs(nested, current)
+                self.assertIs(get_current_deadline(), current)
+            result = queryset.fan_out(
+                lambda qs: list(qs.values_list('name', flat=True)),
+                tenant_ids=[1], parallel=False,
+            )
+        self.assertIsNone(get_current_deadline())
+        self.assertEqual(result.results, {'default': ['b']})
+
+        with deadline(0):
+            result = queryset.fan_out(tenant_ids=[1], parallel=False)
+        self.assertEqual(result.timed_out, ['default'])
+
+    def test_statement_timeout_is_sent_once_per_budget_step(self):
+        connection = mock_connection()
+        cursor = mock.Mock()
+        context = {
+            'connection': connection, 'cursor': mock.Mock(cursor=cursor),
+        }
+        budget = Deadline(10)
+        wrapper = budget._execute_wrapper(
+            'default', 'postgresql',
+            {'session': None, 'local': None, 'mark': None},
+        )
+
+        def execute(sql, params, many, context):
+            return sql
+
+        def sent():
+            return [call[0][0].split(' =')[0]
+                    for call in cursor.execute.call_args_list]
+
+        for _ in range(5):
+            wrapper(execute, 'SELECT 1', None, False, context)
+        self.assertEqual(sent(), ['SET statement_timeout'])
+
+        # the budget shrank by more than the slack
+        budget.end -= 2
+        wrapper(execute, 'SELECT 1', None, False, context)
+        self.assertEqual(len(sent()), 2)
+
+        # inside a transaction the session timeout still holds
+        connection.in_atomic_block = True
+        wrapper(execute, 'SELECT 1', None, False, context)
+        self.assertEqual(len(sent()), 2)
+        budget.end -= 2
+        wrapper(execute, 'SELECT 1', None, False, context)
+        wrapper(execute, 'SELECT 1', None, False, context)
+        self.assertEqual(sent()[2:], ['SET LOCAL statement_timeout'])
+
+        # the SET LOCAL ended with the commit, the next transaction gets one
+        connection.run_on_commit = []
+        wrapper(execute, 'SELECT 1', None, False, context)
+        self.assertEqual(sent()[3:], ['SET LOCAL statement_timeout'])
+
+    def test_local_statement_timeout_is_undone_in_the_transaction(self):
+        connection = mock_connection(in_atomic_block=True)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        wrappers = []
+
+        @contextmanager
+        def execute_wrapper(wrapper):
+            wrappers.append(wrapper)
+            yield
+
+        connection.execute_wrapper = execute_wrapper
+        context = {
+            'connection': connection, 'cursor': mock.Mock(cursor=cursor),
+        }
+        with mock.patch('shardy.deadlines.connections', {'pg': connection}):
+            with Deadline(10).apply('pg'):
+                wrappers[0](mock.Mock(), 'SELECT 1', None, False, context)
+
+        self.assertEqual(
+            [call[0][0] for call in cursor.execute.call_args_list][1:],
+            ['SET LOCAL statement_timeout TO DEFAULT'],
+        )
@@ -0,0 +1,282 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.dumps import (
+    dump_path, dump_tenant, load_tenant, run_per_tenant, sharded_models,
+)
+from .models import (
+    TShardedMetric, TShardedModel, TShardedNode, TShardedTypedA,
+    TShardedTypedModel, TSnowflakeItem, TSnowflakeModel,
+)
+
+
+MODELS = ['shardy.TSnowflakeItem', 'shardy.TSnowflakeModel',
+          'shardy.TShardedModel']
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class DumpsTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def create_rows(self, partner_id):
+        owner = TSnowflakeModel.objects.create(
+            partner_id=partner_id, name='owner'
+        )
+        for qty in range(3):
+            TSnowflakeItem.objects.create(
+                partner_id=partner_id, owner=owner, qty=qty
+            )
+        TShardedModel.objects.create(partner_id=partner_id, name='plain')
+        return owner
+
+    def test_sharded_models(self):
+        models = sharded_models()
+        self.assertIn(TShardedModel, models)
+        self.assertIn(TShardedTypedModel, models)
+        # proxies and models without a valid sharded field are skipped
+        self.assertNotIn(TShardedTypedA, models)
+        labels = [model._meta.label for model in models]
+        self.assertNotIn('shardy.TShardedUndefinedModel', labels)
+        self.assertNotIn('shardy.TShardedUnexpectedModel', labels)
+        # targets of foreign keys come first
+        self.assertLess(
+            models.index(TSnowflakeModel), models.index(TSnowflakeItem)
+        )
+        self.assertEqual(
+            sharded_models(MODELS),
+            [TSnowflakeModel, TSnowflakeItem, TShardedModel],
+        )
+
+    def test_dump_writes_one_file_per_model(self):
+        self.create_rows(1)
+        self.create_rows(2)
+        counts = dump_tenant(1, self.directory, sharded_models(MODELS))
+        self.assertEqual(counts, {
+            'shardy.TSnowflakeModel': 1,
+            'shardy.TSnowflakeItem': 3,
+            'shardy.TShardedModel': 1,
+        })
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.directory, '1'))),
+            ['shardy.tshardedmodel.jsonl.gz',
+             'shardy.tsnowflakeitem.jsonl.gz',
+             'shardy.tsnowflakemodel.jsonl.gz'],
+        )
+        path = dump_path(self.directory, 1, TSnowflakeItem)
+        with gzip.open(path, 'rt') as dump:
+            rows = [json.loads(line) for line in dump]
+        self.assertEqual([row['qty'] for row in rows], [0, 1, 2])
+        self.assertEqual({row['partner_id'] for row in rows}, {1})
+        self.assertEqual(
+            set(rows[0]), {'id', 'partner_id', 'owner_id', 'qty'}
+        )
+
+    def test_round_trip(self):
+        owner = self.create_rows(1)
+        self.create_rows(2)
+        models = sharded_models(MODELS)
+        dump_tenant(1, self.directory, models)
+        items = list(
+            TSnowflakeItem.objects.filter(partner_id=1).order_by('pk')
+            .values_list('pk', 'owner_id', 'qty')
+        )
+        TSnowflakeModel.objects.filter(partner_id=1).delete()
+        TShardedModel.objects.filter(partner_id=1).delete()
+
+        counts = load_tenant(1, self.directory, models, batch_size=2)
+        self.assertEqual(sum(counts.values()), 5)
+        self.assertEqual(
+            TSnowflakeModel.objects.get(partner_id=1).pk, owner.pk
+        )
+        self.assertEqual(
+            list(
+                TSnowflakeItem.objects.filter(partner_id=1).order_by('pk')
+                .values_list('pk', 'owner_id', 'qty')
+            ),
+            items,
+        )
+        self.assertEqual(
+            TShardedModel.objects.get(partner_id=1).name, 'plain'
+        )
+        # the other tenant is untouched
+        self.assertEqual(
+            TSnowflakeItem.objects.filter(partner_id=2).count(), 3
+        )
+        # the sequence is past the loaded pks
+        TShardedModel.objects.create(partner_id=1, name='new')
+
+    def test_round_trip_of_field_types(self):
+        created = datetime(2020, 5, 1, 12, 30, 15, 1234, tzinfo=timezone.utc)
+        TShardedMetric.objects.create(
+            partner_id=1, value=1.5, amount=Decimal('12.34'), flag=True,
+            created=created, day=date(2020, 5, 1), visits=None, label='a',
+        )
+        models = sharded_models(['shardy.TShardedMetric'])
+        dump_tenant(1, self.directory, models)
+        load_tenant(1, self.directory, models, clear=True)
+        metric = TShardedMetric.objects.get(partner_id=1)
+        self.assertEqual(metric.value, 1.5)
+        self.assertEqual(metric.amount, Decimal('12.34'))
+        self.assertTrue(metric.flag)
+        self.assertEqual(metric.created, created)
+        self.assertEqual(metric.day, date(2020, 5, 1))
+        self.assertIsNone(metric.visits)
+
+    def test_load_typed_and_tree_models(self):
+        TShardedTypedA.objects.create(partner_id=1, name='a', a_value=7)
+        root = TShardedNode.objects.create(
+            partner_id=1, desc='root', sib_order=0
+        )
+        TShardedNode.objects.create(
+            partner_id=1, desc='child', sib_order=0, parent=root
+        )
+        models = sharded_models([
+            'shardy.TShardedTypedModel', 'shardy.TShardedNode'
+        ])
+        dump_tenant(1, self.directory, models)
+        load_tenant(1, self.directory, models, clear=True)
+        typed = TShardedTypedModel.objects.get(partner_id=1)
+        self.assertIsInstance(typed, TShardedTypedA)
+        self.assertEqual(typed.a_value, 7)
+        child = TShardedNode.objects.get(partner_id=1, desc='child')
+        self.assertEqual(child.parent_id, root.pk)
+
+    def test_clear_replaces_the_rows(self):
+        self.create_rows(1)
+        models = sharded_models(MODELS)
+        dump_tenant(1, self.directory, models)
+        TShardedModel.objects.create(partner_id=1, name='later')
+        load_tenant(1, self.directory, models, clear=True)
+        self.assertEqual(
+            list(
+                TShardedModel.objects.filter(partner_id=1)
+                .values_list('name', flat=True)
+            ),
+            ['plain'],
+        )
+
+    def test_load_without_clear_conflicts(self):
+        self.create_rows(1)
+        models = sharded_models(MODELS)
+        dump_tenant(1, self.directory, models)
+        with self.assertRaises(IntegrityError):
+            load_tenant(1, self.directory, models)
+
+    def test_missing_files_are_skipped(self):
+        self.assertEqual(
+            load_tenant(3, self.directory, sharded_models(MODELS)), {}
+        )
+
+    def test_run_per_tenant_collects_errors(self):
+        def func(tenant):
+            if tenant == 2:
+                raise ValueError('broken')
+            return tenant * 10
+
+        results = run_per_tenant(func, [1, 2, 3])
+        self.assertEqual(results[0], (1, 10))
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(results[2], (3, 30))
+
+    def test_commands(self):
+        self.create_rows(1)
+        self.create_rows(2)
+        stdout = StringIO()
+        call_command(
+            'dump_tenant', self.directory, '1', '2', '--models', *MODELS,
+            stdout=stdout,
+        )
+        self.assertEqual(
+            stdout.getvalue().splitlines(), ['1\t5 rows', '2\t5 rows']
+        )
+        TSnowflakeModel.objects.all().for_tenants([1, 2]).delete()
+        TShardedModel.objects.all().for_tenants([1, 2]).delete()
+
+        stdout = StringIO()
+        call_command(
+            'load_tenant', self.directory, '--models', *MODELS,
+            stdout=stdout,
+        )
+        self.assertEqual(
+            stdout.getvalue().splitlines(), ['1\t5 rows', '2\t5 rows']
+        )
+        self.assertEqual(
+            TSnowflakeItem.objects.all().for_tenants([1, 2]).count(), 6
+        )
+
+    def test_load_command_reports_failures(self):
+        self.create_rows(1)
+        call_command(
+            'dump_tenant', self.directory, '1', '--models', *MODELS,
+            stdout=StringIO(),
+        )
+        stderr = StringIO()
+        with self.assertRaisesMessage(CommandError, '1 of 1 tenants failed'):
+            call_command(
+                'load_tenant', self.directory, '1', '--models', *MODELS,
+                stdout=StringIO(), stderr=stderr,
+            )
+        self.assertIn('1\tfailed', stderr.getvalue())
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ParallelDumpsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_parallel_round_trip(self):
+        for partner_id in range(1, 5):
+            TShardedModel.objects.bulk_create([
+                TShardedModel(partner_id=partner_id, name=str(i))
+                for i in range(20)
+            ])
+        models = sharded_models(['shardy.TShardedModel'])
+
+        def dump(tenant):
+            return dump_tenant(tenant, self.directory, models, chunk_size=7)
+
+        results = run_per_tenant(dump, [1, 2, 3, 4], workers=2)
+        self.assertEqual(
+            [result for _, result in results],
+            [{'shardy.TShardedModel': 20}] * 4,
+        )
+        tenants = TShardedModel.objects.all().for_tenants([1, 2, 3, 4])
+        tenants.delete()
+
+        def load(tenant):
+            return load_tenant(tenant, self.directory, models, batch_size=6)
+
+        # concurrent writers lock the tables of the in-memory test database
+        results = run_per_tenant(load, [1, 2, 3, 4])
+        self.assertEqual(
+            [result for _, result in results],
+            [{'shardy.TShardedModel': 20}] * 4,
+        )
+        self.assertEqual(tenants.count(), 80)
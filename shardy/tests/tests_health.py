@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy import health as health_module
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.fanout import fan_out
+from shardy.health import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ShardHealth, ShardUnavailable,
+)
+from shardy.tenants import get_tenant_registry
+from .models import TShardedModel
+
+BROKEN = 'default__2'
+
+
+def add_broken_alias(test_case):
+    """Adds the shard of tenant 2, an SQLite file that can't be opened"""
+    connections.databases[BROKEN] = dict(
+        connections.databases['default'],
+        NAME='/nonexistent/shardy/db.sqlite3',
+    )
+
+    def remove():
+        connections[BROKEN].close()
+        del connections.databases[BROKEN]
+        if hasattr(connections._connections, BROKEN):
+            delattr(connections._connections, BROKEN)
+
+    test_case.addCleanup(remove)
+
+
+def allow_in_thread(breaker):
+    allowed = []
+    thread = threading.Thread(target=lambda: allowed.append(breaker.allow()))
+    thread.start()
+    thread.join()
+    return allowed[0]
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+        breaker.record_failure()
+
+        with mock.patch('shardy.health.time.time',
+                        return_value=breaker.opened_at + 31):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, HALF_OPEN)
+            # the trial thread goes on, the others wait for its outcome
+            self.assertTrue(breaker.allow())
+            self.assertFalse(allow_in_thread(breaker))
+
+            breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+
+        with mock.patch('shardy.health.time.time',
+                        return_value=breaker.opened_at + 31):
+            self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual((breaker.state, breaker.failures), (CLOSED, 0))
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ShardHealthTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        add_broken_alias(self)
+        TShardedModel.objects.create(partner_id=1, name='a')
+
+    def test_guard_fails_fast_once_open(self):
+        health = ShardHealth(threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(OperationalError):
+                with health.guard(BROKEN):
+                    connections[BROKEN].cursor()
+
+        with mock.patch.object(connections[BROKEN], 'cursor') as cursor:
+            with self.assertRaises(ShardUnavailable):
+                with health.guard(BROKEN):
+                    connections[BROKEN].cursor()
+        cursor.assert_not_called()
+        self.assertEqual(health.status()[BROKEN][:2], (OPEN, 2))
+
+    def test_probe_closes_circuit_when_shard_is_back(self):
+        health = ShardHealth(threshold=1, reset_timeout=60)
+        self.assertFalse(health.probe(BROKEN))
+        self.assertTrue(health.is_open(BROKEN))
+
+        connections.databases[BROKEN]['NAME'] = ':memory:'
+        self.assertFalse(health.probe(BROKEN))
+
+        opened_at = health.get_breaker(BROKEN).opened_at
+        with mock.patch('shardy.health.time.time',
+                        return_value=opened_at + 61):
+            self.assertTrue(health.probe(BROKEN))
+        self.assertEqual(health.status()[BROKEN][0], CLOSED)
+
+    def test_fan_out_reports_partial_results(self):
+        health = ShardHealth(threshold=1, reset_timeout=60)
+
+        def names(queryset):
+            return list(queryset.values_list('name', flat=True))
+
+        result = fan_out(TShardedModel, names, tenant_ids=[1, 2],
+                         parallel=False, health=health)
+
+        self.assertEqual(result.results, {'default': ['a']})
+        self.assertIsInstance(result.errors[BROKEN], OperationalError)
+        self.assertTrue(result.partial)
+
+        result = fan_out(TShardedModel, names, tenant_ids=[1, 2],
+                         parallel=False, health=health)
+
+        self.assertEqual(result.skipped, [BROKEN])
+        self.assertEqual(result.errors, {})
+        self.assertEqual(result.values(), [['a']])
+
+    @override_settings(SHARD_HEALTH_CHECKS=True)
+    def test_router_fails_fast(self):
+        health = ShardHealth(threshold=1, reset_timeout=60)
+        health.probe(BROKEN)
+
+        with mock.patch.object(health_module, '_shard_health', health):
+            with self.assertRaises(ShardUnavailable):
+                TShardedModel.objects.filter(partner_id=2).count()
+            self.assertEqual(
+                TShardedModel.objects.filter(partner_id=1).count(), 1
+            )
+
+    def create_shard(self):
+        """:return: path of an SQLite file with the TShardedModel table"""
+        handle, name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.remove, name)
+        with closing(sqlite3.connect(name)) as database:
+            database.execute(
+                'CREATE TABLE {} (id integer primary key, '
+                'partner_id integer, name varchar(10))'.format(
+                    TShardedModel._meta.db_table
+                )
+            )
+        return name
+
+    @override_settings(SHARD_HEALTH_CHECKS=True)
+    def test_orm_queries_feed_the_breaker(self):
+        health = ShardHealth(threshold=2, reset_timeout=60)
+
+        with mock.patch.object(health_module, '_shard_health', health):
+            for _ in range(2):
+                with self.assertRaises(OperationalError) as context:
+                    TShardedModel.objects.filter(partner_id=2).count()
+                self.assertNotIsInstance(context.exception, ShardUnavailable)
+            self.assertEqual(health.status()[BROKEN][:2], (OPEN, 2))
+            with self.assertRaises(ShardUnavailable):
+                TShardedModel.objects.filter(partner_id=2).count()
+
+            # the shard is back: one caller runs the trial
+            connections.databases[BROKEN]['NAME'] = self.create_shard()
+            breaker = health.get_breaker(BROKEN)
+            with mock.patch('shardy.health.time.time',
+                            return_value=breaker.opened_at + 61):
+                self.assertTrue(breaker.allow())
+                self.assertFalse(allow_in_thread(breaker))
+                self.assertEqual(
+                    TShardedModel.objects.filter(partner_id=2).count(), 0
+                )
+            self.assertEqual(health.status()[BROKEN][:2], (CLOSED, 0))
+
+    @override_settings(SHARD_HEALTH_CHECKS=True)
+    def test_guard_counts_tracked_failures_once(self):
+        health = ShardHealth(threshold=5, reset_timeout=60)
+        health.track(BROKEN)
+        with self.assertRaises(OperationalError):
+            with health.guard(BROKEN):
+                connections[BROKEN].cursor()
+        self.assertEqual(health.status()[BROKEN][1], 1)
+
+    @override_settings(SHARD_TENANT_REGISTRY=[1, 2])
+    def test_command(self):
+        get_tenant_registry().refresh()
+        out, err = StringIO(), StringIO()
+
+        call_command('shard_health', 'shardy.TShardedModel',
+                     stdout=out, stderr=err)
+
+        self.assertIn('default\tok\t1 tenants', out.getvalue())
+        self.assertIn('default__2\tunavailable', out.getvalue())
+        self.assertIn('1 of 2 shards unavailable', err.getvalue())
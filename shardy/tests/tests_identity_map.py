@@ -0,0 +1,89 @@
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+
+from app.models import AppTShardedModel
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.identity_map import get_identity_map, identity_map
+from shardy.middleware import IdentityMapMiddleware
+
+PID = 1
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class IdentityMapTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.obj = AppTShardedModel.objects.create(partner_id=PID, name='a')
+
+    def test_get_by_pk_is_served_from_memory(self):
+        with identity_map():
+            first = AppTShardedModel.objects.get(
+                partner_id=PID, pk=self.obj.pk
+            )
+            with self.assertNumQueries(0):
+                second = AppTShardedModel.objects.get(
+                    partner_id=PID, id__exact=str(self.obj.pk)
+                )
+
+        self.assertIs(first, second)
+
+    def test_other_lookups_hit_db(self):
+        with identity_map():
+            AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+            with self.assertNumQueries(1):
+                AppTShardedModel.objects.get(
+                    partner_id=PID, pk=self.obj.pk, name='a'
+                )
+            with self.assertNumQueries(1):
+                AppTShardedModel.objects.filter(name='a').get(
+                    partner_id=PID, pk=self.obj.pk
+                )
+
+    def test_no_map_outside_of_block(self):
+        with identity_map():
+            AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+
+        self.assertIsNone(get_identity_map())
+        with self.assertNumQueries(1):
+            AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+
+    def test_save_updates_entry(self):
+        with identity_map():
+            obj = AppTShardedModel(partner_id=PID, name='b')
+            obj.save()
+            with self.assertNumQueries(0):
+                self.assertIs(
+                    AppTShardedModel.objects.get(partner_id=PID, pk=obj.pk),
+                    obj
+                )
+
+    def test_delete_evicts_entry(self):
+        with identity_map():
+            obj = AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+            obj.delete()
+            with self.assertRaises(AppTShardedModel.DoesNotExist):
+                AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+
+    def test_queryset_update_evicts_model(self):
+        with identity_map():
+            AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+            AppTShardedModel.objects.filter(partner_id=PID).update(name='c')
+            obj = AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+
+        self.assertEqual(obj.name, 'c')
+
+    def test_middleware_clears_map(self):
+        def view(request):
+            AppTShardedModel.objects.get(partner_id=PID, pk=self.obj.pk)
+            self.assertEqual(len(get_identity_map()), 1)
+            return HttpResponse()
+
+        IdentityMapMiddleware(view)(RequestFactory().get('/'))
+
+        self.assertIsNone(get_identity_map())
@@ -0,0 +1,168 @@
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.ids import (
+    MAX_SEQUENCE, SnowflakeGenerator, get_node_id, parse_id,
+)
+from .models import TSnowflakeModel
+
+EPOCH = 1577836800000
+
+
+class FixedClock(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self):
+        return self.seconds
+
+    def sleep(self, seconds):
+        self.seconds += seconds
+
+    def milliseconds(self):
+        return int(self.seconds * 1000)
+
+
+class SnowflakeGeneratorTestCase(TestCase):
+
+    def test_layout(self):
+        clock = FixedClock((EPOCH + 1234) / 1000.0)
+        generator = SnowflakeGenerator(7, epoch=EPOCH, clock=clock)
+
+        first, second = generator.next_id(), generator.next_id()
+
+        self.assertEqual(parse_id(first, EPOCH), (EPOCH + 1234, 7, 0))
+        self.assertEqual(parse_id(second, EPOCH), (EPOCH + 1234, 7, 1))
+        self.assertLess(first, 1 << 63)
+
+    def test_sequence_overflow_waits_for_next_millisecond(self):
+        clock = FixedClock(EPOCH / 1000.0)
+        generator = SnowflakeGenerator(
+            1, epoch=EPOCH, clock=clock, sleep=clock.sleep
+        )
+
+        ids = generator.next_ids(2 * MAX_SEQUENCE + 3)
+        ids.append(generator.next_id())
+
+        self.assertEqual(ids, sorted(set(ids)))
+        timestamp, _, sequence = parse_id(ids[-1], EPOCH)
+        self.assertEqual(sequence, 1)
+        # the clock was waited for, never run ahead of
+        self.assertGreater(timestamp, EPOCH + 1)
+        self.assertLessEqual(timestamp, clock.milliseconds())
+
+    def test_clock_going_backwards(self):
+        clock = FixedClock(EPOCH / 1000.0 + 10)
+        generator = SnowflakeGenerator(
+            1, epoch=EPOCH, clock=clock, sleep=clock.sleep
+        )
+        before = generator.next_id()
+
+        clock.seconds -= 5
+
+        self.assertGreater(generator.next_id(), before)
+        ids = generator.next_ids(MAX_SEQUENCE + 1)
+        self.assertEqual(ids, sorted(set(ids)))
+        # the sequence of the last millisecond ran out: waited 5 seconds
+        self.assertGreater(clock.milliseconds(), EPOCH + 10000)
+        self.assertLessEqual(parse_id(ids[-1], EPOCH)[0], clock.milliseconds())
+
+    def test_nodes_never_collide(self):
+        clock = FixedClock(EPOCH / 1000.0)
+        one = SnowflakeGenerator(1, epoch=EPOCH, clock=clock)
+        two = SnowflakeGenerator(2, epoch=EPOCH, clock=clock)
+
+        self.assertFalse(set(one.next_ids(1000)) & set(two.next_ids(1000)))
+
+    def test_unique_under_many_threads(self):
+        generator = SnowflakeGenerator(3, epoch=EPOCH)
+        results = []
+        start = threading.Barrier(16)
+
+        def generate(batch):
+            start.wait()
+            ids = []
+            for _ in range(200):
+                if batch:
+                    ids.extend(generator.next_ids(50))
+                else:
+                    ids.append(generator.next_id())
+            results.append(ids)
+
+        threads = [
+            threading.Thread(target=generate, args=(i % 2,))
+            for i in range(16)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [value for chunk in results for value in chunk]
+        self.assertEqual(len(ids), 8 * 200 + 8 * 200 * 50)
+        self.assertEqual(len(set(ids)), len(ids))
+        for chunk in results:
+            # every thread sees increasing ids
+            self.assertEqual(chunk, sorted(chunk))
+
+    def test_invalid_node_id(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(1024)
+
+    def test_node_id_setting(self):
+        with override_settings(SHARD_SNOWFLAKE_NODE_ID=lambda: 12):
+            self.assertEqual(get_node_id(), 12)
+        with override_settings(SHARD_SNOWFLAKE_NODE_ID=2048):
+            with self.assertRaises(ImproperlyConfigured):
+                get_node_id()
+        with override_settings(SHARD_SNOWFLAKE_NODE_ID=None):
+            # no default: equal pids on two hosts would share a node id
+            with self.assertRaises(ImproperlyConfigured):
+                get_node_id()
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class SnowflakeFieldTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def test_save_inserts_without_update(self):
+        obj = TSnowflakeModel(partner_id=1, name='a')
+
+        with self.assertNumQueries(1):
+            obj.save()
+
+        self.assertIsNotNone(obj.pk)
+        self.assertEqual(
+            TSnowflakeModel.objects.get(partner_id=1, pk=obj.pk).name, 'a'
+        )
+
+        obj.name = 'b'
+        obj.save()
+        self.assertEqual(
+            TSnowflakeModel.objects.filter(partner_id=1).count(), 1
+        )
+
+    def test_bulk_create_assigns_ids_client_side(self):
+        objs = [TSnowflakeModel(partner_id=1, name=str(i)) for i in range(5)]
+        preset = TSnowflakeModel(partner_id=1, name='p', id=42)
+
+        with self.assertNumQueries(1):
+            TSnowflakeModel.objects.bulk_create(objs + [preset])
+
+        self.assertEqual(preset.pk, 42)
+        self.assertEqual(
+            sorted(TSnowflakeModel.objects.filter(partner_id=1)
+                   .values_list('pk', 'name')),
+            sorted([(obj.pk, obj.name) for obj in objs] + [(42, 'p')])
+        )
@@ -0,0 +1,163 @@
+import pickle
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from app.models import AppTShardedModel
+from shardy import load
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.load import TenantLoadTracker, get_published_report
+from shardy.sketches import SpaceSaving
+
+
+class SpaceSavingTestCase(TestCase):
+
+    def test_keeps_capacity(self):
+        sketch = SpaceSaving(3)
+        for key in range(100):
+            sketch.add(key)
+
+        self.assertEqual(len(sketch), 3)
+        self.assertEqual(sketch.total, 100)
+
+    def test_finds_heavy_hitters(self):
+        sketch = SpaceSaving(5)
+        for i in range(1000):
+            sketch.add('hot')
+            sketch.add('cold{}'.format(i))
+
+        key, count, error = sketch.top(1)[0]
+        self.assertEqual(key, 'hot')
+        self.assertGreaterEqual(count, 1000)
+        self.assertLessEqual(count - error, 1000)
+
+    def test_evicts_smallest_counter(self):
+        sketch = SpaceSaving(3)
+        for key, weight in (('a', 5), ('b', 1), ('c', 2), ('c', 1)):
+            sketch.add(key, weight)
+
+        sketch.add('d')
+        self.assertNotIn('b', sketch)
+        self.assertEqual(sketch.get('d'), (2, 1))
+        sketch.add('e')
+        self.assertNotIn('d', sketch)
+        self.assertEqual(sketch.get('c'), (3, 0))
+        self.assertEqual(sketch.get('e'), (3, 2))
+
+        for i in range(50):
+            sketch.add('a')
+            sketch.add('f{}'.format(i))
+        self.assertEqual(sketch.get('a'), (55, 0))
+        # counters add up to the total, the evicted ones included
+        self.assertEqual(
+            sum(count for _, count, _ in sketch.top()), sketch.total
+        )
+        self.assertLessEqual(len(sketch._heap), 2 * sketch.capacity)
+
+    def test_pickle(self):
+        sketch = SpaceSaving(2)
+        for key in ('a', 'a', 'a', 'b', 'c'):
+            sketch.add(key)
+
+        copy = pickle.loads(pickle.dumps(sketch))
+        copy.add('d')
+
+        self.assertEqual(copy.top(), [('a', 3, 0), ('d', 3, 2)])
+
+    def test_weighted(self):
+        sketch = SpaceSaving(2)
+        sketch.add('a', 0.5)
+        sketch.add('a', 0.25)
+        sketch.add('b', 0.1)
+
+        self.assertEqual(sketch.get('a'), (0.75, 0))
+        self.assertEqual(sketch.get('missing'), (0, 0))
+
+    def test_merge(self):
+        first, second = SpaceSaving(2), SpaceSaving(2)
+        first.add('a', 5)
+        second.add('a', 3)
+        second.add('b', 1)
+
+        first.merge(second)
+
+        self.assertEqual(first.get('a'), (8, 0))
+        self.assertEqual(first.get('b'), (1, 0))
+        self.assertEqual(first.total, 9)
+
+
+class TenantLoadTrackerTestCase(TestCase):
+
+    def test_report_ranks_per_alias(self):
+        tracker = TenantLoadTracker(10)
+        tracker.record_resolved('db__1', 1)
+        for _ in range(3):
+            tracker.record_query('db__1', 0.1)
+        tracker.record_resolved('db__1', 2)
+        tracker.record_query('db__1', 2.0)
+        tracker.record_resolved('db__3', 3)
+        tracker.record_query('db__3', 0.1)
+
+        report = tracker.report()
+
+        self.assertEqual([l.tenant for l in report['db__1']], [2, 1])
+        self.assertEqual(report['db__1'][1].queries, 3)
+        self.assertEqual(report['db__1'][0].time, 2.0)
+        self.assertEqual(report['db__3'][0].queries, 1)
+
+    def test_queries_are_charged_to_the_tenant_on_the_same_alias(self):
+        tracker = TenantLoadTracker(10)
+        tracker.record_resolved('db__1', 1)
+        tracker.record_query('db__2', 1.0)
+
+        self.assertEqual(tracker.report(), {})
+
+    @override_settings(
+        DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+        DEFAULT_DB_GROUP='default',
+        DATABASE_CONFIG={'routing': {}},
+        SHARD_LOAD_TRACKING=True,
+    )
+    def test_router_feeds_tracker(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        tracker = load.get_load_tracker()
+        tracker.reset()
+
+        with tracker.track_queries(aliases=['default']):
+            AppTShardedModel.objects.create(partner_id=7)
+            queryset = AppTShardedModel.objects.filter(partner_id=7)
+            # routing without a query is not counted
+            for _ in range(3):
+                queryset.db
+            list(queryset)
+
+        loads = tracker.report()['default']
+        self.assertEqual(loads[0].tenant, 7)
+        self.assertEqual(loads[0].queries, 2)
+        self.assertGreater(loads[0].time, 0)
+        tracker.reset()
+
+    @override_settings(
+        CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            }
+        }
+    )
+    def test_publish_and_command(self):
+        tracker = TenantLoadTracker(10)
+        tracker.record_resolved('db__1', 1)
+        tracker.record_query('db__1', 0.1)
+        tracker.publish()
+        tracker.record_query('db__1', 0.1)
+        tracker.publish()
+
+        self.assertEqual(get_published_report()['db__1'][0].queries, 2)
+
+        out = StringIO()
+        call_command('shard_load_report', '--reset', stdout=out)
+
+        self.assertIn('db__1', out.getvalue())
+        self.assertEqual(get_published_report(), {})
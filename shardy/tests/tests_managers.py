@@ -1,10 +1,31 @@
-from django.test import TestCase
+from django.db import OperationalError, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.fanout import RawFanOut
 from shardy.querysets import (
     ShardPerTenantQuerySet,
     ShardRawPerTenantQuerySet
 )
+from shardy.tenants import tenant
 from .models import TShardedModel
+from .tests_health import BROKEN, add_broken_alias
+
+SHARD = 'default__3'
+
+
+def add_shard_alias(test_case):
+    """Adds the shard of tenant 3, another alias of the test database"""
+    connections.databases[SHARD] = dict(connections.databases['default'])
+
+    def remove():
+        connections[SHARD].close()
+        del connections.databases[SHARD]
+        if hasattr(connections._connections, SHARD):
+            delattr(connections._connections, SHARD)
+
+    test_case.addCleanup(remove)
 
 
 class ShardedPerTenantManagerTestCase(TestCase):
@@ -16,3 +37,99 @@ class ShardedPerTenantManagerTestCase(TestCase):
     def test_raw(self):
         qs = TShardedModel.objects.raw('SELECT 1;')
         self.assertIsInstance(qs, ShardRawPerTenantQuerySet)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class RawRoutingTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        add_shard_alias(self)
+        add_broken_alias(self)
+        self.sql = 'SELECT * FROM {} WHERE partner_id = %s'.format(
+            TShardedModel._meta.db_table
+        )
+        TShardedModel.objects.create(partner_id=1, name='a')
+
+    def test_routes_to_shared_value(self):
+        raw = TShardedModel.objects.raw(
+            self.sql, params=[3], shared_value=3
+        )
+        self.assertEqual(raw.db, SHARD)
+        self.assertEqual(raw.using('replica').db, 'default__3__replica')
+
+    def test_routes_to_current_tenant(self):
+        with tenant(3):
+            raw = TShardedModel.objects.raw(self.sql, params=[3])
+        self.assertEqual(raw.db, SHARD)
+        self.assertEqual(raw._clone().db, SHARD)
+
+    def test_falls_back_to_db_group(self):
+        raw = TShardedModel.objects.raw(self.sql, params=[1])
+        self.assertEqual(raw.db, 'default')
+        self.assertEqual([obj.name for obj in raw], ['a'])
+
+    def test_fan_out_streams_rows_of_answered_shards(self):
+        TShardedModel.objects.create(partner_id=1, name='b')
+        report = TShardedModel.objects.raw_fan_out(
+            self.sql + ' ORDER BY id', params=lambda ids: [ids[0]],
+            tenant_ids=[1, 2], parallel=False,
+        )
+        self.assertIsInstance(report, RawFanOut)
+
+        rows = [(obj._state.db, obj.name) for obj in report]
+
+        self.assertEqual(rows, [('default', 'a'), ('default', 'b')])
+        self.assertEqual(report.results, {'default': 2, BROKEN: 0})
+        self.assertIsInstance(report.errors[BROKEN], OperationalError)
+        self.assertTrue(report.partial)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ParallelRawFanOutTestCase(TransactionTestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        add_shard_alias(self)
+        TShardedModel.objects.bulk_create(
+            [TShardedModel(partner_id=1, name=str(i)) for i in range(50)]
+        )
+        TShardedModel.objects.bulk_create(
+            [TShardedModel(partner_id=3, name=str(i)) for i in range(50)]
+        )
+
+    def test_streams_all_rows_with_small_buffer(self):
+        report = TShardedModel.objects.raw_fan_out(
+            'SELECT * FROM {} WHERE partner_id = %s'.format(
+                TShardedModel._meta.db_table
+            ),
+            params=lambda ids: [ids[0]],
+            tenant_ids=[1, 3], buffer_size=2,
+        )
+
+        rows = sorted((obj.partner_id, int(obj.name)) for obj in report)
+
+        self.assertEqual(rows, sorted(
+            (partner_id, i) for partner_id in (1, 3) for i in range(50)
+        ))
+        self.assertEqual(report.results, {'default': 50, SHARD: 50})
+        self.assertFalse(report.partial)
+
+    def test_consumer_stops_early(self):
+        report = TShardedModel.objects.raw_fan_out(
+            'SELECT * FROM {}'.format(TShardedModel._meta.db_table),
+            tenant_ids=[1, 3], buffer_size=1,
+        )
+        iterator = iter(report)
+        self.assertIsInstance(next(iterator), TShardedModel)
+        # releases the workers blocked on the full buffer
+        iterator.close()
+        self.assertLess(sum(report.results.values()), 100)
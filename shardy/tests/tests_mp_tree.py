@@ -0,0 +1,259 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from treebeard.exceptions import InvalidMoveToDescendant
+
+from shardy.db_routers import ShardedPerTenantRouter
+from .models import TShardedMPNode, TShardedSortedMPNode
+
+PID = 1
+OTHER_PID = 2
+
+
+def build_tree(partner_id):
+    """
+    1
+      11
+        111
+      12
+    2
+      21
+    """
+    root1 = TShardedMPNode.add_root(partner_id=partner_id, desc='1')
+    root2 = TShardedMPNode.add_root(partner_id=partner_id, desc='2')
+    node11 = root1.add_child(desc='11')
+    root1.add_child(desc='12')
+    node11.add_child(desc='111')
+    root2.add_child(desc='21')
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class MPShardedPerTenantNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        build_tree(PID)
+        build_tree(OTHER_PID)
+
+    def get_node(self, desc):
+        return TShardedMPNode.objects.get(partner_id=PID, desc=desc)
+
+    def descs(self, nodes):
+        return [node.desc for node in nodes]
+
+    def test_paths_are_per_tenant(self):
+        self.assertEqual(
+            [(n.desc, n.path, n.numchild) for n in TShardedMPNode.get_tree(PID)],
+            [('1', '0001', 2), ('11', '00010001', 1),
+             ('111', '000100010001', 0), ('12', '00010002', 0),
+             ('2', '0002', 1), ('21', '00020001', 0)]
+        )
+        self.assertEqual(
+            self.descs(TShardedMPNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_child_inherits_tenant(self):
+        self.assertEqual(self.get_node('111').partner_id, PID)
+
+    def test_get_tree_with_parent(self):
+        parent = self.get_node('1')
+
+        with self.assertNumQueries(1):
+            tree = list(TShardedMPNode.get_tree(PID, parent))
+        self.assertEqual(self.descs(tree), ['1', '11', '111', '12'])
+
+    def test_get_root_nodes(self):
+        self.assertEqual(
+            self.descs(TShardedMPNode.get_root_nodes(PID)), ['1', '2']
+        )
+        self.assertEqual(TShardedMPNode.get_last_root_node(PID).desc, '2')
+
+    def test_relatives(self):
+        node = self.get_node('111')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.descs(node.get_ancestors()), ['1', '11'])
+        self.assertEqual(node.get_parent().desc, '11')
+        self.assertEqual(node.get_root().desc, '1')
+        self.assertEqual(self.descs(self.get_node('1').get_children()),
+                         ['11', '12'])
+        self.assertEqual(self.descs(self.get_node('1').get_descendants()),
+                         ['11', '111', '12'])
+        self.assertEqual(self.descs(self.get_node('12').get_siblings()),
+                         ['11', '12'])
+
+    def test_delete_subtree(self):
+        self.get_node('11').delete()
+
+        root = self.get_node('1')
+        self.assertEqual(root.numchild, 1)
+        self.assertEqual(self.descs(TShardedMPNode.get_tree(PID)),
+                         ['1', '12', '2', '21'])
+        self.assertEqual(TShardedMPNode.objects.filter(
+            partner_id=OTHER_PID).count(), 6)
+
+    def test_add_child_after_delete(self):
+        self.get_node('12').delete()
+
+        node = self.get_node('1').add_child(desc='13')
+
+        self.assertEqual(node.path, '00010002')
+        self.assertEqual(self.get_node('1').numchild, 2)
+
+    def tree(self, partner_id=PID):
+        return [
+            (n.desc, n.path, n.depth, n.numchild)
+            for n in TShardedMPNode.get_tree(partner_id)
+        ]
+
+    def test_delete_across_tenants(self):
+        nodes = TShardedMPNode.objects.filter(partner_id=PID, desc='11')
+        nodes |= TShardedMPNode.objects.filter(partner_id=OTHER_PID, desc='11')
+        nodes.delete()
+
+        for partner_id in (PID, OTHER_PID):
+            self.assertEqual(
+                self.tree(partner_id),
+                [('1', '0001', 1, 1), ('12', '00010002', 2, 0),
+                 ('2', '0002', 1, 1), ('21', '00020001', 2, 0)]
+            )
+
+    def test_add_sibling(self):
+        self.get_node('12').add_sibling('left', desc='115')
+        self.get_node('2').add_sibling('first-sibling', desc='0')
+
+        self.assertEqual(self.tree(), [
+            ('0', '0001', 1, 0),
+            ('1', '0002', 1, 3), ('11', '00020001', 2, 1),
+            ('111', '000200010001', 3, 0), ('115', '00020002', 2, 0),
+            ('12', '00020003', 2, 0),
+            ('2', '0003', 1, 1), ('21', '00030001', 2, 0),
+        ])
+        self.assertEqual(
+            self.descs(TShardedMPNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_move_branch(self):
+        self.get_node('11').move(self.get_node('2'), 'last-child')
+
+        self.assertEqual(self.tree(), [
+            ('1', '0001', 1, 1), ('12', '00010002', 2, 0),
+            ('2', '0002', 1, 2), ('21', '00020001', 2, 0),
+            ('11', '00020002', 2, 1), ('111', '000200020001', 3, 0),
+        ])
+        self.assertEqual(TShardedMPNode.find_problems(PID),
+                         ([], [], [], [], []))
+        self.assertEqual(
+            self.descs(TShardedMPNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_move_left_among_siblings(self):
+        self.get_node('12').move(self.get_node('11'), 'left')
+        self.get_node('111').move(self.get_node('2'), 'left')
+
+        self.assertEqual(self.tree(), [
+            ('1', '0001', 1, 2), ('12', '00010001', 2, 0),
+            ('11', '00010002', 2, 0),
+            ('111', '0002', 1, 0),
+            ('2', '0003', 1, 1), ('21', '00030001', 2, 0),
+        ])
+
+    def test_invalid_moves(self):
+        with self.assertRaises(InvalidMoveToDescendant):
+            self.get_node('1').move(self.get_node('111'), 'last-child')
+        other = TShardedMPNode.objects.get(partner_id=OTHER_PID, desc='2')
+        with self.assertRaises(ValueError):
+            self.get_node('11').move(other, 'last-child')
+
+    def test_dump_and_load_bulk(self):
+        dump = TShardedMPNode.dump_bulk(PID, keep_ids=False)
+
+        self.assertEqual(dump[0], {'data': {'desc': '1'}, 'children': [
+            {'data': {'desc': '11'}, 'children': [{'data': {'desc': '111'}}]},
+            {'data': {'desc': '12'}},
+        ]})
+        TShardedMPNode.load_bulk(3, dump)
+        self.assertEqual(self.tree(3), self.tree(PID))
+
+    def test_find_problems_and_fix_tree(self):
+        TShardedMPNode.objects.filter(partner_id=PID, desc='111').update(
+            depth=1
+        )
+        TShardedMPNode.objects.filter(partner_id=PID, desc='2').update(
+            numchild=3
+        )
+        node111 = self.get_node('111').pk
+        node2 = self.get_node('2').pk
+
+        self.assertEqual(TShardedMPNode.find_problems(PID),
+                         ([], [], [], [node111], [node2]))
+        self.assertEqual(TShardedMPNode.find_problems(OTHER_PID),
+                         ([], [], [], [], []))
+
+        TShardedMPNode.fix_tree(PID)
+        self.assertEqual(TShardedMPNode.find_problems(PID),
+                         ([], [], [], [], []))
+
+    def test_fix_tree_destructive_closes_holes(self):
+        self.get_node('11').delete()
+
+        TShardedMPNode.fix_tree(PID, destructive=True)
+
+        self.assertEqual(self.tree(), [
+            ('1', '0001', 1, 1), ('12', '00010001', 2, 0),
+            ('2', '0002', 1, 1), ('21', '00020001', 2, 0),
+        ])
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class MPShardedSortedNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def descs(self, partner_id=PID):
+        return [
+            node.desc for node in TShardedSortedMPNode.get_tree(partner_id)
+        ]
+
+    def test_sorted_inserts(self):
+        for partner_id in (PID, OTHER_PID):
+            TShardedSortedMPNode.add_root(
+                partner_id=partner_id, val=2, desc='b'
+            )
+            TShardedSortedMPNode.add_root(
+                partner_id=partner_id, val=1, desc='a'
+            )
+            # 'a' was inserted before 'b', which moved
+            root = TShardedSortedMPNode.objects.get(
+                partner_id=partner_id, desc='b'
+            )
+            for val, desc in ((3, 'b3'), (1, 'b1'), (2, 'b2')):
+                root.add_child(val=val, desc=desc)
+
+        self.assertEqual(self.descs(), ['a', 'b', 'b1', 'b2', 'b3'])
+        self.assertEqual(self.descs(OTHER_PID), self.descs())
+        self.assertEqual(TShardedSortedMPNode.find_problems(PID),
+                         ([], [], [], [], []))
+
+    def test_sorted_move(self):
+        root_a = TShardedSortedMPNode.add_root(partner_id=PID, val=1,
+                                               desc='a')
+        root_b = TShardedSortedMPNode.add_root(partner_id=PID, val=2,
+                                               desc='b')
+        root_a.add_child(val=2, desc='a2')
+        node = root_b.add_child(val=1, desc='b1')
+
+        node.move(root_a, 'sorted-child')
+
+        self.assertEqual(self.descs(), ['a', 'b1', 'a2', 'b'])
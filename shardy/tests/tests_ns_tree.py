@@ -0,0 +1,226 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from treebeard.exceptions import InvalidMoveToDescendant
+
+from shardy.db_routers import ShardedPerTenantRouter
+from .models import TShardedNSNode, TShardedSortedNSNode
+
+PID = 1
+OTHER_PID = 2
+
+
+def build_tree(partner_id):
+    """
+    1
+      11
+        111
+      12
+    2
+      21
+    """
+    root1 = TShardedNSNode.add_root(partner_id=partner_id, desc='1')
+    root2 = TShardedNSNode.add_root(partner_id=partner_id, desc='2')
+    node11 = root1.add_child(desc='11')
+    root1.add_child(desc='12')
+    node11.add_child(desc='111')
+    root2.add_child(desc='21')
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class NSShardedPerTenantNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        build_tree(PID)
+        build_tree(OTHER_PID)
+
+    def get_node(self, desc):
+        return TShardedNSNode.objects.get(partner_id=PID, desc=desc)
+
+    def descs(self, nodes):
+        return [node.desc for node in nodes]
+
+    def test_bounds_are_per_tenant(self):
+        self.assertEqual(
+            [(n.desc, n.tree_id, n.lft, n.rgt)
+             for n in TShardedNSNode.get_tree(PID)],
+            [('1', 1, 1, 8), ('11', 1, 2, 5), ('111', 1, 3, 4),
+             ('12', 1, 6, 7), ('2', 2, 1, 4), ('21', 2, 2, 3)]
+        )
+        self.assertEqual(
+            self.descs(TShardedNSNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_get_tree_with_parent(self):
+        parent = self.get_node('1')
+
+        with self.assertNumQueries(1):
+            tree = list(TShardedNSNode.get_tree(PID, parent))
+        self.assertEqual(self.descs(tree), ['1', '11', '111', '12'])
+
+    def test_get_root_nodes(self):
+        self.assertEqual(
+            self.descs(TShardedNSNode.get_root_nodes(PID)), ['1', '2']
+        )
+
+    def test_relatives(self):
+        node = self.get_node('111')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.descs(node.get_ancestors()), ['1', '11'])
+        self.assertEqual(node.get_parent().desc, '11')
+        self.assertEqual(node.get_root().desc, '1')
+        self.assertEqual(self.descs(self.get_node('1').get_children()),
+                         ['11', '12'])
+        self.assertEqual(self.descs(self.get_node('1').get_descendants()),
+                         ['11', '111', '12'])
+        self.assertEqual(self.descs(self.get_node('12').get_siblings()),
+                         ['11', '12'])
+
+    def test_add_child_with_stale_parent(self):
+        root = self.get_node('1')
+        self.get_node('11').add_child(desc='112')
+
+        root.add_child(desc='13')
+
+        self.assertEqual(
+            [(n.desc, n.lft, n.rgt) for n in self.get_node('1').get_tree(
+                PID, self.get_node('1'))],
+            [('1', 1, 12), ('11', 2, 7), ('111', 3, 4), ('112', 5, 6),
+             ('12', 8, 9), ('13', 10, 11)]
+        )
+
+    def test_delete_subtree_closes_gap(self):
+        self.get_node('11').delete()
+
+        self.assertEqual(
+            [(n.desc, n.lft, n.rgt) for n in TShardedNSNode.get_tree(PID)],
+            [('1', 1, 4), ('12', 2, 3), ('2', 1, 4), ('21', 2, 3)]
+        )
+        self.assertEqual(TShardedNSNode.objects.filter(
+            partner_id=OTHER_PID).count(), 6)
+
+    def tree(self, partner_id=PID):
+        return [
+            (n.desc, n.tree_id, n.lft, n.rgt, n.depth)
+            for n in TShardedNSNode.get_tree(partner_id)
+        ]
+
+    def test_delete_across_tenants(self):
+        nodes = TShardedNSNode.objects.filter(partner_id=PID, desc='11')
+        nodes |= TShardedNSNode.objects.filter(partner_id=OTHER_PID, desc='11')
+        nodes.delete()
+
+        for partner_id in (PID, OTHER_PID):
+            self.assertEqual(self.tree(partner_id), [
+                ('1', 1, 1, 4, 1), ('12', 1, 2, 3, 2),
+                ('2', 2, 1, 4, 1), ('21', 2, 2, 3, 2),
+            ])
+
+    def test_add_sibling(self):
+        self.get_node('12').add_sibling('left', desc='115')
+        self.get_node('2').add_sibling('first-sibling', desc='0')
+
+        self.assertEqual(self.tree(), [
+            ('0', 1, 1, 2, 1),
+            ('1', 2, 1, 10, 1), ('11', 2, 2, 5, 2), ('111', 2, 3, 4, 3),
+            ('115', 2, 6, 7, 2), ('12', 2, 8, 9, 2),
+            ('2', 3, 1, 4, 1), ('21', 3, 2, 3, 2),
+        ])
+        self.assertEqual(
+            self.descs(TShardedNSNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_move_branch(self):
+        self.get_node('11').move(self.get_node('2'), 'last-child')
+
+        self.assertEqual(self.tree(), [
+            ('1', 1, 1, 4, 1), ('12', 1, 2, 3, 2),
+            ('2', 2, 1, 8, 1), ('21', 2, 2, 3, 2),
+            ('11', 2, 4, 7, 2), ('111', 2, 5, 6, 3),
+        ])
+        self.assertEqual(
+            self.descs(TShardedNSNode.get_tree(OTHER_PID)),
+            ['1', '11', '111', '12', '2', '21']
+        )
+
+    def test_move_to_root(self):
+        self.get_node('12').move(self.get_node('11'), 'left')
+        self.get_node('111').move(self.get_node('2'), 'left')
+
+        self.assertEqual(self.tree(), [
+            ('1', 1, 1, 6, 1), ('12', 1, 2, 3, 2), ('11', 1, 4, 5, 2),
+            ('111', 2, 1, 2, 1),
+            ('2', 3, 1, 4, 1), ('21', 3, 2, 3, 2),
+        ])
+
+    def test_invalid_moves(self):
+        with self.assertRaises(InvalidMoveToDescendant):
+            self.get_node('1').move(self.get_node('111'), 'last-child')
+        other = TShardedNSNode.objects.get(partner_id=OTHER_PID, desc='2')
+        with self.assertRaises(ValueError):
+            self.get_node('11').move(other, 'last-child')
+
+    def test_dump_and_load_bulk(self):
+        dump = TShardedNSNode.dump_bulk(PID, keep_ids=False)
+
+        self.assertEqual(dump[0], {'data': {'desc': '1'}, 'children': [
+            {'data': {'desc': '11'}, 'children': [{'data': {'desc': '111'}}]},
+            {'data': {'desc': '12'}},
+        ]})
+        with self.assertNumQueries(1):
+            TShardedNSNode.dump_bulk(PID)
+        TShardedNSNode.load_bulk(3, dump)
+        self.assertEqual(self.tree(3), self.tree(PID))
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class NSShardedSortedNodeTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def descs(self, partner_id=PID):
+        return [
+            node.desc for node in TShardedSortedNSNode.get_tree(partner_id)
+        ]
+
+    def test_sorted_inserts(self):
+        for partner_id in (PID, OTHER_PID):
+            TShardedSortedNSNode.add_root(
+                partner_id=partner_id, val=2, desc='b'
+            )
+            TShardedSortedNSNode.add_root(
+                partner_id=partner_id, val=1, desc='a'
+            )
+            # 'a' was inserted before 'b', which moved
+            root = TShardedSortedNSNode.objects.get(
+                partner_id=partner_id, desc='b'
+            )
+            for val, desc in ((3, 'b3'), (1, 'b1'), (2, 'b2')):
+                root.add_child(val=val, desc=desc)
+
+        self.assertEqual(self.descs(), ['a', 'b', 'b1', 'b2', 'b3'])
+        self.assertEqual(self.descs(OTHER_PID), self.descs())
+
+    def test_sorted_move(self):
+        root_a = TShardedSortedNSNode.add_root(partner_id=PID, val=1,
+                                               desc='a')
+        root_b = TShardedSortedNSNode.add_root(partner_id=PID, val=2,
+                                               desc='b')
+        root_a.add_child(val=2, desc='a2')
+        node = root_b.add_child(val=1, desc='b1')
+
+        node.move(root_a, 'sorted-child')
+
+        self.assertEqual(self.descs(), ['a', 'b1', 'a2', 'b'])
@@ -0,0 +1,212 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.pagination import InvalidCursor, ShardCursorPaginator
+from .models import TShardedMetric, TShardedModel
+from .tests_health import BROKEN, add_broken_alias
+from .tests_managers import SHARD, add_shard_alias
+
+
+def read_all(paginator):
+    """:return: list of the pages, as lists of instances"""
+    pages = []
+    cursor = None
+    while True:
+        page = paginator.page(cursor)
+        pages.append(list(page))
+        if not page.has_next:
+            return pages
+        cursor = page.next_cursor
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ShardCursorPaginatorTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.objs = []
+        for i in range(10):
+            for partner_id in (1, 2):
+                self.objs.append(TShardedModel.objects.create(
+                    partner_id=partner_id, name=str(i % 4)
+                ))
+
+    def paginator(self, ordering='pk', page_size=3, **kwargs):
+        kwargs.setdefault('tenant_ids', [1, 2])
+        kwargs.setdefault('parallel', False)
+        return ShardCursorPaginator(
+            TShardedModel.objects.all(), ordering, page_size, **kwargs
+        )
+
+    def test_pages_by_pk(self):
+        pages = read_all(self.paginator())
+        self.assertEqual([len(page) for page in pages], [3] * 6 + [2])
+        self.assertEqual(
+            [obj.pk for page in pages for obj in page],
+            [obj.pk for obj in self.objs],
+        )
+
+    def test_pages_by_field_then_pk(self):
+        pages = read_all(self.paginator('name', page_size=4))
+        self.assertEqual(
+            [obj.pk for page in pages for obj in page],
+            [obj.pk for obj in sorted(self.objs, key=lambda o: (o.name, o.pk))],
+        )
+
+    def test_descending(self):
+        pages = read_all(self.paginator('-name', page_size=7))
+        self.assertEqual(
+            [obj.pk for page in pages for obj in page],
+            [
+                obj.pk for obj in
+                sorted(self.objs, key=lambda o: (o.name, o.pk), reverse=True)
+            ],
+        )
+
+    def test_last_page_has_no_cursor(self):
+        page = self.paginator(page_size=20).page()
+        self.assertEqual(len(page), 20)
+        self.assertFalse(page.has_next)
+        self.assertIsNone(page.next_cursor)
+
+        page = self.paginator(page_size=19).page()
+        self.assertTrue(page.has_next)
+        self.assertEqual(len(self.paginator(page_size=19).page(
+            page.next_cursor
+        )), 1)
+
+    def test_filters_of_the_queryset(self):
+        paginator = ShardCursorPaginator(
+            TShardedModel.objects.filter(name='1'), 'pk', 2,
+            tenant_ids=[1], parallel=False,
+        )
+        pages = read_all(paginator)
+        self.assertEqual(
+            [obj.pk for page in pages for obj in page],
+            [obj.pk for obj in self.objs
+             if obj.partner_id == 1 and obj.name == '1'],
+        )
+
+    def test_deep_pages_use_the_keyset(self):
+        paginator = self.paginator('name', page_size=2)
+        page = paginator.page()
+        for _ in range(5):
+            page = paginator.page(page.next_cursor)
+        with CaptureQueriesContext(connection) as context:
+            paginator.page(page.next_cursor)
+        (query,) = context.captured_queries
+        self.assertNotIn('OFFSET', query['sql'])
+        self.assertIn('LIMIT 3', query['sql'])
+
+    def test_datetime_keys(self):
+        created = datetime(2020, 5, 1, 12, 0, 0, 1, tzinfo=timezone.utc)
+        metrics = [
+            TShardedMetric.objects.create(
+                partner_id=1, value=i, amount=Decimal(1), created=created +
+                timedelta(microseconds=i // 2), day=created.date(), label='x',
+            )
+            for i in range(6)
+        ]
+        paginator = ShardCursorPaginator(
+            TShardedMetric.objects.all(), '-created', 2,
+            tenant_ids=[1], parallel=False,
+        )
+        pages = read_all(paginator)
+        self.assertEqual(
+            [obj.pk for page in pages for obj in page],
+            [obj.pk for obj in reversed(metrics)],
+        )
+
+    def test_invalid_cursor(self):
+        paginator = self.paginator()
+        with self.assertRaises(InvalidCursor):
+            paginator.page('garbage')
+        cursor = self.paginator('name').page().next_cursor
+        with self.assertRaises(InvalidCursor):
+            paginator.page(cursor)
+        with self.assertRaises(InvalidCursor):
+            paginator.page(cursor[:-2] + 'xx')
+
+    def test_page_size(self):
+        with self.assertRaises(ValueError):
+            self.paginator(page_size=0)
+
+    def test_failed_shard_makes_partial_pages(self):
+        add_broken_alias(self)
+        paginator = self.paginator(page_size=30)
+        page = paginator.page()
+        self.assertTrue(page.partial)
+        self.assertIn(BROKEN, page.fan_out.errors)
+        self.assertEqual({obj.partner_id for obj in page}, {1})
+        # the failed shard is retried on the next page
+        self.assertTrue(page.has_next)
+        page = paginator.page(page.next_cursor)
+        self.assertEqual(len(page), 0)
+        self.assertIn(BROKEN, page.fan_out.errors)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ShardCursorPaginatorShardsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        add_shard_alias(self)
+        for partner_id in (1, 3):
+            TShardedModel.objects.bulk_create([
+                TShardedModel(partner_id=partner_id, name=str(i % 7))
+                for i in range(25)
+            ])
+        self.expected = sorted(
+            row for partner_id in (1, 3)
+            for row in TShardedModel.objects.filter(
+                partner_id=partner_id
+            ).values_list('name', 'pk', 'partner_id')
+        )
+
+    def test_merges_the_shards(self):
+        for parallel in (False, True):
+            paginator = ShardCursorPaginator(
+                TShardedModel.objects.all(), 'name', 8,
+                tenant_ids=[1, 3], parallel=parallel,
+            )
+            pages = read_all(paginator)
+            self.assertEqual([len(page) for page in pages], [8] * 6 + [2])
+            rows = [
+                (obj.name, obj.pk, obj.partner_id)
+                for page in pages for obj in page
+            ]
+            # pks repeat across shards, their order is free on ties
+            self.assertEqual(
+                [row[0] for row in rows], [row[0] for row in self.expected]
+            )
+            self.assertEqual(sorted(rows), self.expected)
+            self.assertEqual(
+                {obj._state.db for page in pages for obj in page},
+                {'default', SHARD},
+            )
+
+    def test_exhausted_shards_are_not_queried(self):
+        TShardedModel.objects.filter(partner_id=3).delete()
+        TShardedModel.objects.create(partner_id=3, name='0')
+        paginator = ShardCursorPaginator(
+            TShardedModel.objects.all(), 'name', 5,
+            tenant_ids=[1, 3], parallel=False,
+        )
+        page = paginator.page()
+        self.assertIn(3, {obj.partner_id for obj in page})
+        with CaptureQueriesContext(connections[SHARD]) as context:
+            paginator.page(page.next_cursor)
+        self.assertEqual(len(context.captured_queries), 0)
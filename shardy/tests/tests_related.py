@@ -0,0 +1,143 @@
+from django.db.models import Subquery
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.querysets import ShardPerTenantQuerySet
+from .models import (
+    TPartner, TPartnerOrder, TShardedModel, TSnowflakeItem, TSnowflakeModel,
+)
+from .tests_managers import SHARD, add_shard_alias
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class RelatedRoutingTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.owner = TSnowflakeModel.objects.create(partner_id=1, name='o')
+        self.items = [
+            TSnowflakeItem.objects.create(
+                partner_id=1, owner=self.owner, qty=qty
+            )
+            for qty in range(3)
+        ]
+
+    def test_filter_by_related_instance(self):
+        queryset = TSnowflakeItem.objects.filter(owner=self.owner)
+        self.assertEqual(queryset._exact_lookups['partner_id'], 1)
+        self.assertEqual(
+            sorted(queryset.values_list('qty', flat=True)), [0, 1, 2]
+        )
+        self.assertEqual(
+            TSnowflakeItem.objects.filter(owner__exact=self.owner).count(), 3
+        )
+
+    def test_filter_by_related_instances(self):
+        other = TSnowflakeModel.objects.create(partner_id=1, name='p')
+        queryset = TSnowflakeItem.objects.filter(
+            owner__in=[self.owner, other]
+        )
+        self.assertEqual(queryset.count(), 3)
+
+    def test_related_instances_of_several_tenants_are_not_routed(self):
+        other = TSnowflakeModel.objects.create(partner_id=2, name='p')
+        queryset = TSnowflakeItem.objects.filter(
+            owner__in=[self.owner, other]
+        )
+        self.assertNotIn('partner_id', queryset._exact_lookups)
+
+    def test_exclude_is_not_routed(self):
+        queryset = TSnowflakeItem.objects.exclude(owner=self.owner)
+        self.assertNotIn('partner_id', queryset._exact_lookups)
+
+    def test_explicit_sharded_value_wins(self):
+        queryset = TSnowflakeItem.objects.filter(
+            partner_id=2, owner=self.owner
+        )
+        self.assertEqual(queryset._exact_lookups['partner_id'], 2)
+
+    def test_filter_by_tenant_instance(self):
+        partner = TPartner.objects.create(name='p')
+        TPartnerOrder.objects.create(partner=partner, total=5)
+        queryset = TPartnerOrder.objects.filter(partner=partner)
+        self.assertEqual(queryset._exact_lookups['partner_id'], partner.pk)
+        self.assertEqual(queryset.get().total, 5)
+
+    def test_subquery_is_not_evaluated(self):
+        partner = TPartner.objects.create(name='p')
+        TPartnerOrder.objects.create(partner=partner, total=5)
+        partners = TPartner.objects.filter(name='p')
+
+        with self.assertNumQueries(0):
+            queryset = TPartnerOrder.objects.filter(partner__in=partners)
+            TPartnerOrder.objects.filter(partner__in=partners.query)
+        self.assertNotIn('partner_id', queryset._exact_lookups)
+        self.assertIsNone(partners._result_cache)
+
+    def test_expression_is_skipped(self):
+        owners = Subquery(
+            TSnowflakeModel.objects.filter(partner_id=1).values('pk')
+        )
+        queryset = TSnowflakeItem.objects.filter(owner__in=owners)
+        self.assertNotIn('partner_id', queryset._exact_lookups)
+        self.assertEqual(queryset.filter(partner_id=1).count(), 3)
+
+    def test_falls_back_to_the_shard_the_instance_was_read_from(self):
+        add_shard_alias(self)
+        owner = TSnowflakeModel(partner_id=None, name='o')
+        owner._state.db = SHARD
+        queryset = TSnowflakeItem.objects.filter(owner=owner)
+        self.assertEqual(queryset.db, SHARD)
+
+    def test_unsaved_instance_without_tenant_is_not_routed(self):
+        owner = TSnowflakeModel(partner_id=None, name='o')
+        queryset = TSnowflakeItem.objects.filter(owner=owner)
+        self.assertNotIn('instance', queryset._hints)
+
+    def test_reverse_manager_stays_on_the_shard(self):
+        add_shard_alias(self)
+        self.owner._state.db = SHARD
+        queryset = self.owner.tsnowflakeitem_set.filter(qty=1)
+        self.assertIsInstance(queryset, ShardPerTenantQuerySet)
+        self.assertEqual(queryset.db, SHARD)
+
+    def test_reverse_manager(self):
+        self.assertEqual(self.owner.tsnowflakeitem_set.count(), 3)
+        item = self.owner.tsnowflakeitem_set.create(partner_id=1, qty=9)
+        self.assertEqual(item._state.db, 'default')
+        self.assertEqual(
+            sorted(
+                self.owner.tsnowflakeitem_set.values_list('qty', flat=True)
+            ),
+            [0, 1, 2, 9],
+        )
+
+    def test_forward_descriptor(self):
+        item = TSnowflakeItem.objects.get(partner_id=1, pk=self.items[0].pk)
+        self.assertEqual(item.owner, self.owner)
+        self.assertEqual(item.owner._state.db, 'default')
+
+    def test_prefetch_related(self):
+        owners = list(
+            TSnowflakeModel.objects.filter(partner_id=1)
+            .prefetch_related('tsnowflakeitem_set')
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(owners[0].tsnowflakeitem_set.count(), 3)
+
+        items = list(
+            TSnowflakeItem.objects.filter(partner_id=1)
+            .prefetch_related('owner')
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual({item.owner.pk for item in items},
+                             {self.owner.pk})
+
+    def test_unrelated_models_are_unaffected(self):
+        queryset = TShardedModel.objects.filter(name='x')
+        self.assertEqual(queryset._exact_lookups, {'name': 'x'})
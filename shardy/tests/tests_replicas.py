@@ -0,0 +1,173 @@
+import os
+import tempfile
+
+from django.db import connections
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.replicas import ReplicaReadStats, ReplicaReads, get_replica_stats
+from .models import TShardedModel
+
+
+REPLICA = 'default__replica'
+
+
+def add_replica_alias(test_case, name=None):
+    """
+    Adds the replica of the default shard, an empty SQLite file with the
+    tables of TShardedModel, or an unopenable path with ``name``
+    """
+    if name is None:
+        handle, name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        test_case.addCleanup(os.remove, name)
+    connections.databases[REPLICA] = dict(
+        connections.databases['default'], NAME=name, TEST={},
+    )
+
+    def remove():
+        connections[REPLICA].close()
+        del connections.databases[REPLICA]
+        if hasattr(connections._connections, REPLICA):
+            delattr(connections._connections, REPLICA)
+
+    test_case.addCleanup(remove)
+    if not name.startswith('/nonexistent'):
+        with connections[REPLICA].schema_editor() as editor:
+            editor.create_model(TShardedModel)
+
+
+class ReplicaReadStatsTestCase(TestCase):
+
+    def test_status(self):
+        stats = ReplicaReadStats()
+        for _ in range(4):
+            stats.record_read('db__1')
+        stats.record_miss('db__1')
+        stats.record_error('db__1')
+        stats.record_read('db__2')
+        self.assertEqual(stats.status(), {
+            'db__1': ReplicaReads(4, 1, 1, 0.5),
+            'db__2': ReplicaReads(1, 0, 0, 0.0),
+        })
+        stats.reset()
+        self.assertEqual(stats.status(), {})
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ReplicaFirstTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        get_replica_stats().reset()
+        self.addCleanup(get_replica_stats().reset)
+        self.primary = TShardedModel.objects.create(partner_id=1, name='p')
+
+    def queryset(self, **kwargs):
+        return TShardedModel.objects.all().replica_first(**kwargs)
+
+    def copy_to_replica(self, obj, **changes):
+        replica = TShardedModel(
+            pk=obj.pk, partner_id=obj.partner_id, name=obj.name
+        )
+        for name, value in changes.items():
+            setattr(replica, name, value)
+        replica.save(using=REPLICA, force_insert=True)
+
+    def test_get_reads_the_replica(self):
+        add_replica_alias(self)
+        self.copy_to_replica(self.primary, name='r')
+        with CaptureQueriesContext(connections['default']) as primary:
+            obj = self.queryset().get(partner_id=1, pk=self.primary.pk)
+        self.assertEqual(obj.name, 'r')
+        self.assertEqual(obj._state.db, REPLICA)
+        self.assertEqual(len(primary), 0)
+        self.assertEqual(
+            get_replica_stats().status(),
+            {'default': ReplicaReads(1, 0, 0, 0.0)},
+        )
+
+    def test_get_falls_back_to_the_primary(self):
+        add_replica_alias(self)
+        obj = self.queryset().get(partner_id=1, name='p')
+        self.assertEqual(obj.pk, self.primary.pk)
+        self.assertEqual(obj._state.db, 'default')
+        self.assertEqual(
+            get_replica_stats().status(),
+            {'default': ReplicaReads(1, 1, 0, 1.0)},
+        )
+
+    def test_get_missing_everywhere(self):
+        add_replica_alias(self)
+        with self.assertRaises(TShardedModel.DoesNotExist):
+            self.queryset().get(partner_id=1, name='missing')
+        self.assertEqual(get_replica_stats().status()['default'].misses, 1)
+
+    def test_exists(self):
+        add_replica_alias(self)
+        queryset = self.queryset().filter(partner_id=1)
+        self.assertTrue(queryset.filter(name='p').exists())
+        self.assertFalse(queryset.filter(name='missing').exists())
+        self.assertEqual(
+            get_replica_stats().status(),
+            {'default': ReplicaReads(2, 2, 0, 1.0)},
+        )
+
+        self.copy_to_replica(self.primary)
+        with CaptureQueriesContext(connections['default']) as primary:
+            self.assertTrue(queryset.filter(name='p').exists())
+        self.assertEqual(len(primary), 0)
+
+    def test_unreachable_replica_falls_back(self):
+        add_replica_alias(self, name='/nonexistent/shardy/replica.sqlite3')
+        obj = self.queryset().get(partner_id=1, pk=self.primary.pk)
+        self.assertEqual(obj._state.db, 'default')
+        self.assertEqual(
+            get_replica_stats().status(),
+            {'default': ReplicaReads(1, 0, 1, 1.0)},
+        )
+
+    def test_shard_without_replica_reads_the_primary(self):
+        obj = self.queryset().get(partner_id=1, pk=self.primary.pk)
+        self.assertEqual(obj._state.db, 'default')
+        self.assertTrue(self.queryset().filter(partner_id=1).exists())
+        self.assertEqual(get_replica_stats().status(), {})
+
+    def test_replica_suffix(self):
+        add_replica_alias(self)
+        self.copy_to_replica(self.primary, name='r')
+        with override_settings(SHARD_REPLICA_SUFFIX='other'):
+            # default__other isn't configured
+            self.assertEqual(
+                self.queryset().get(partner_id=1, pk=self.primary.pk).name,
+                'p',
+            )
+        self.assertEqual(
+            self.queryset(using='replica')
+            .get(partner_id=1, pk=self.primary.pk).name,
+            'r',
+        )
+
+    def test_writes_use_the_primary(self):
+        add_replica_alias(self)
+        self.copy_to_replica(self.primary, name='r')
+        obj, created = self.queryset().get_or_create(
+            partner_id=1, pk=self.primary.pk
+        )
+        self.assertFalse(created)
+        self.assertEqual(obj.name, 'p')
+        self.assertEqual(get_replica_stats().status(), {})
+
+    def test_other_evaluations_are_not_affected(self):
+        add_replica_alias(self)
+        self.assertEqual(
+            [obj.name for obj in self.queryset().filter(partner_id=1)],
+            ['p'],
+        )
+        self.assertEqual(self.queryset().filter(partner_id=1).count(), 1)
+        self.assertEqual(get_replica_stats().status(), {})
@@ -0,0 +1,102 @@
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.tenants import TenantRegistry, get_tenant_registry
+from shardy.utils import (
+    get_all_model_master_db_aliases,
+    get_all_model_replica_db_aliases,
+)
+from .models import TShardedModel
+
+calls = []
+
+
+def tenant_ids():
+    calls.append(1)
+    return [3, 1, 3, 2]
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class TenantRegistryTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        del calls[:]
+
+    def test_static_list(self):
+        registry = TenantRegistry([1, 2, 2, 5])
+
+        self.assertEqual(registry.get_tenant_ids(), [1, 2, 5])
+
+    def test_callable_path(self):
+        registry = TenantRegistry('shardy.tests.tests_tenants.tenant_ids')
+
+        self.assertEqual(registry.get_tenant_ids(), [3, 1, 2])
+
+    def test_model(self):
+        Group.objects.create(name='on')
+        Group.objects.create(name='off')
+        registry = TenantRegistry({
+            'MODEL': 'auth.Group', 'FILTER': {'name': 'on'}, 'FIELD': 'name',
+        })
+
+        self.assertEqual(registry.get_tenant_ids(), ['on'])
+
+    def test_not_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TenantRegistry().get_tenant_ids()
+
+    def test_ids_are_cached_until_ttl(self):
+        registry = TenantRegistry(tenant_ids, ttl=60)
+        registry.get_tenant_ids()
+        registry.get_tenant_ids()
+        self.assertEqual(len(calls), 1)
+
+        with mock.patch('shardy.tenants.time.time',
+                        return_value=registry._loaded_at + 61):
+            registry.get_tenant_ids()
+        self.assertEqual(len(calls), 2)
+
+        registry.refresh()
+        self.assertEqual(len(calls), 3)
+
+    def test_aliases(self):
+        registry = TenantRegistry([1, 2])
+
+        self.assertEqual(
+            registry.get_tenants_by_alias(TShardedModel), {'default': [1, 2]}
+        )
+        self.assertEqual(registry.get_db_aliases(TShardedModel), {'default'})
+        self.assertEqual(
+            registry.get_db_aliases(TShardedModel, using='replica'),
+            {'default__replica'}
+        )
+
+    def test_aliases_are_cached(self):
+        registry = TenantRegistry([1, 2])
+        registry.get_db_aliases(TShardedModel)
+
+        with mock.patch.object(TShardedModel, 'get_db_alias') as get_alias:
+            registry.get_db_aliases(TShardedModel)
+        get_alias.assert_not_called()
+
+    @override_settings(SHARD_TENANT_REGISTRY=[1, 2])
+    def test_utils(self):
+        get_tenant_registry().refresh()
+
+        self.assertEqual(
+            get_all_model_master_db_aliases(TShardedModel), {'default'}
+        )
+        self.assertEqual(
+            get_all_model_replica_db_aliases(TShardedModel),
+            {'default__replica'}
+        )
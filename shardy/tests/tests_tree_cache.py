@@ -0,0 +1,150 @@
+import time
+from unittest import mock
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.al_tree import ANCESTOR_DISTANCE
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.tree_cache import (
+    TOO_LARGE, TenantTree, TreeCache, get_tree_cache,
+)
+from .models import TShardedCachedNode, TShardedNode
+from .tests_al_tree import OTHER_PID, PID, build_tree
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class TreeCacheTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        # the cache outlives the rolled back transactions of other tests
+        get_tree_cache().clear()
+        build_tree(PID)
+        build_tree(OTHER_PID)
+
+    def get_node(self, desc):
+        return TShardedCachedNode.objects.get(partner_id=PID, desc=desc)
+
+    def test_get_tree_from_memory(self):
+        with self.assertNumQueries(1):
+            TShardedCachedNode.get_tree(PID)
+        with self.assertNumQueries(0):
+            tree = TShardedCachedNode.get_tree(PID)
+
+        self.assertEqual(
+            [(node.desc, node._cached_depth) for node in tree],
+            [('1', 1), ('11', 2), ('111', 3), ('12', 2), ('2', 1), ('21', 2)]
+        )
+        self.assertIsInstance(tree[0], TShardedCachedNode)
+        self.assertIsNot(tree[0], TShardedCachedNode.get_tree(PID)[0])
+
+    def test_relatives_from_memory(self):
+        root = self.get_node('1')
+        leaf = self.get_node('111')
+        TShardedCachedNode.get_tree(PID)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [n.desc for n in TShardedCachedNode.get_tree(PID, root)],
+                ['1', '11', '111', '12']
+            )
+            self.assertEqual([n.desc for n in root.get_children()],
+                             ['11', '12'])
+            self.assertEqual([n.desc for n in root.get_descendants()],
+                             ['11', '111', '12'])
+            self.assertEqual(root.get_descendant_count(), 3)
+            self.assertTrue(leaf.is_descendant_of(root))
+            self.assertFalse(root.is_descendant_of(leaf))
+            ancestors = leaf.get_ancestors()
+
+        self.assertEqual(
+            [(n.desc, getattr(n, ANCESTOR_DISTANCE)) for n in ancestors],
+            [('1', 2), ('11', 1)]
+        )
+
+    def test_invalidated_by_writes(self):
+        root = self.get_node('1')
+        TShardedCachedNode.get_tree(PID)
+
+        root.add_child(partner_id=PID, desc='13')
+        self.assertEqual([n.desc for n in root.get_children()],
+                         ['11', '12', '13'])
+
+        node = self.get_node('12')
+        node.desc = '12x'
+        node.save()
+        self.assertEqual([n.desc for n in root.get_children()],
+                         ['11', '12x', '13'])
+
+        self.get_node('11').delete()
+        self.assertEqual([n.desc for n in root.get_children()],
+                         ['12x', '13'])
+
+    def test_invalidated_by_concrete_model_writes(self):
+        TShardedCachedNode.get_tree(PID)
+
+        TShardedNode.objects.get(partner_id=PID, desc='21').delete()
+
+        self.assertEqual(len(TShardedCachedNode.get_tree(PID)), 5)
+
+    def test_other_tenant_is_kept(self):
+        TShardedCachedNode.get_tree(PID)
+        TShardedCachedNode.get_tree(OTHER_PID)
+
+        self.get_node('21').delete()
+
+        with self.assertNumQueries(0):
+            TShardedCachedNode.get_tree(OTHER_PID)
+
+    def test_too_large_tree_is_not_cached(self):
+        cache = TreeCache(max_nodes=5)
+        with mock.patch('shardy.al_tree.get_tree_cache', return_value=cache):
+            TShardedCachedNode.get_tree(PID)
+            self.assertIs(cache.get(TShardedCachedNode, PID), TOO_LARGE)
+
+            with self.assertNumQueries(1):
+                tree = TShardedCachedNode.get_tree(PID)
+        self.assertEqual(len(tree), 6)
+
+    def test_invalidation_during_load_discards_tree(self):
+        cache = TreeCache()
+        load = TenantTree.load
+
+        def load_and_write(*args):
+            tree = load(*args)
+            # another thread writes once the rows are read
+            cache.invalidate(TShardedCachedNode, PID)
+            return tree
+
+        with mock.patch('shardy.al_tree.get_tree_cache', return_value=cache), \
+                mock.patch('shardy.al_tree.TenantTree.load', load_and_write):
+            TShardedCachedNode.get_tree(PID)
+        self.assertIsNone(cache.get(TShardedCachedNode, PID))
+
+        with mock.patch('shardy.al_tree.get_tree_cache', return_value=cache):
+            TShardedCachedNode.get_tree(PID)
+        self.assertIsNotNone(cache.get(TShardedCachedNode, PID))
+
+    def test_entries_expire(self):
+        cache = TreeCache(timeout=60)
+        with mock.patch('shardy.al_tree.get_tree_cache', return_value=cache):
+            TShardedCachedNode.get_tree(PID)
+            with mock.patch('shardy.tree_cache.time.time',
+                            return_value=time.time() + 61):
+                self.assertIsNone(cache.get(TShardedCachedNode, PID))
+                with self.assertNumQueries(1):
+                    TShardedCachedNode.get_tree(PID)
+
+    def test_lru_across_tenants(self):
+        cache = TreeCache(max_tenants=1)
+        with mock.patch('shardy.al_tree.get_tree_cache', return_value=cache):
+            TShardedCachedNode.get_tree(PID)
+            TShardedCachedNode.get_tree(OTHER_PID)
+
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get(TShardedCachedNode, PID))
@@ -0,0 +1,250 @@
+import os
+import tempfile
+
+from django.db import connections
+from django.db.models.signals import post_init
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from .models import (
+    TShardedTypedA, TShardedTypedB, TShardedTypedC, TShardedTypedModel,
+)
+
+PID = 1
+OTHER_PID = 2
+
+
+def add_write_shards(test_case, aliases, models=(TShardedTypedModel,)):
+    """
+    Adds write aliases, each an SQLite file of its own with the tables of
+    ``models``
+    """
+    for alias in aliases:
+        handle, name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        test_case.addCleanup(os.remove, name)
+        connections.databases[alias] = dict(
+            connections.databases['default'], NAME=name, TEST={},
+        )
+
+        def remove(alias=alias):
+            connections[alias].close()
+            del connections.databases[alias]
+            if hasattr(connections._connections, alias):
+                delattr(connections._connections, alias)
+
+        test_case.addCleanup(remove)
+        with connections[alias].schema_editor() as editor:
+            for model in models:
+                editor.create_model(model)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ShardedTypedModelTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        TShardedTypedA.objects.create(partner_id=PID, name='a', a_value=1)
+        TShardedTypedB.objects.create(partner_id=PID, name='b', b_value='x')
+
+    def load(self, model=TShardedTypedModel):
+        return list(model.objects.filter(partner_id=PID).order_by('pk'))
+
+    def test_registry_base_is_precomputed(self):
+        self.assertIs(TShardedTypedModel._typedmodels_registry_base,
+                      TShardedTypedModel)
+        self.assertIs(TShardedTypedA._typedmodels_registry_base,
+                      TShardedTypedModel)
+
+    def test_from_db_builds_subclasses(self):
+        a, b = self.load()
+
+        self.assertIs(a.__class__, TShardedTypedA)
+        self.assertIs(b.__class__, TShardedTypedB)
+        self.assertEqual((a.partner_id, a.name, a.a_value), (PID, 'a', 1))
+        self.assertEqual(b.b_value, 'x')
+        self.assertFalse(a._state.adding)
+        self.assertEqual(a._state.db, 'default')
+
+    def test_from_db_for_subclass_queryset(self):
+        [a] = self.load(TShardedTypedA)
+
+        self.assertIs(a.__class__, TShardedTypedA)
+        self.assertEqual(a.a_value, 1)
+
+    def test_from_db_with_deferred_fields(self):
+        a, b = TShardedTypedModel.objects.filter(
+            partner_id=PID
+        ).only('name', 'type').order_by('pk')
+
+        self.assertIs(a.__class__, TShardedTypedA)
+        self.assertIn('a_value', a.get_deferred_fields())
+        with self.assertNumQueries(1):
+            self.assertEqual(a.a_value, 1)
+
+    def test_from_db_without_type_uses_queryset_model(self):
+        a = TShardedTypedA.objects.filter(partner_id=PID).defer('type').get()
+
+        self.assertIs(a.__class__, TShardedTypedA)
+        self.assertEqual(a.type, 'shardy.tshardedtypeda')
+
+    def test_from_db_sends_post_init(self):
+        senders = []
+
+        def on_init(sender, **kwargs):
+            senders.append(sender)
+
+        post_init.connect(on_init)
+        try:
+            self.load()
+        finally:
+            post_init.disconnect(on_init)
+
+        self.assertEqual(senders, [TShardedTypedModel, TShardedTypedModel])
+
+    def test_saves_after_from_db(self):
+        a, _ = self.load()
+        a.a_value = 2
+        a.save()
+
+        self.assertEqual(self.load(TShardedTypedA)[0].a_value, 2)
+
+    def test_recast(self):
+        a, _ = self.load()
+
+        a.recast(TShardedTypedB)
+
+        self.assertIs(a.__class__, TShardedTypedB)
+        self.assertEqual(a.type, 'shardy.tshardedtypedb')
+        with self.assertRaises(ValueError):
+            a.recast('shardy.missing')
+
+    def test_foreign_key_to_typed_subclass_targets_the_base(self):
+        field = TShardedTypedC._meta.get_field('a')
+
+        self.assertIs(field.remote_field.model, TShardedTypedModel)
+        self.assertEqual(field.remote_field.limit_choices_to,
+                         {'type__in': ['shardy.tshardedtypeda']})
+
+        a, _ = self.load()
+        c = TShardedTypedC.objects.create(partner_id=PID, a=a)
+        c = TShardedTypedModel.objects.filter(partner_id=PID).get(pk=c.pk)
+        self.assertIs(c.__class__, TShardedTypedC)
+        self.assertIs(c.a.__class__, TShardedTypedA)
+        self.assertEqual(c.a.a_value, 1)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class ShardedTypedQuerySetTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def test_bulk_create_mixed_types_and_tenants(self):
+        objs = [
+            TShardedTypedA(partner_id=PID, name='a', a_value=1),
+            TShardedTypedB(partner_id=PID, name='b', b_value='x'),
+            TShardedTypedA(partner_id=OTHER_PID, name='a2', a_value=2),
+        ]
+
+        # every tenant lives on the default shard: one insert
+        with self.assertNumQueries(1):
+            TShardedTypedModel.objects.bulk_create(objs)
+
+        self.assertEqual(
+            [(o.__class__, o.name) for o in TShardedTypedModel.objects.filter(
+                partner_id=PID).order_by('name')],
+            [(TShardedTypedA, 'a'), (TShardedTypedB, 'b')]
+        )
+        self.assertEqual(
+            TShardedTypedA.objects.get(partner_id=OTHER_PID).a_value, 2
+        )
+
+    def test_bulk_create_validates_types(self):
+        with self.assertRaises(RuntimeError):
+            TShardedTypedModel.objects.bulk_create(
+                [TShardedTypedModel(partner_id=PID)]
+            )
+        with self.assertRaises(ValueError):
+            TShardedTypedA.objects.bulk_create(
+                [TShardedTypedB(partner_id=PID, b_value='x')]
+            )
+
+    def test_bulk_update_mixed_types(self):
+        TShardedTypedA.objects.create(partner_id=PID, name='a', a_value=1)
+        TShardedTypedB.objects.create(partner_id=PID, name='b', b_value='x')
+        a, b = TShardedTypedModel.objects.filter(
+            partner_id=PID).order_by('pk')
+        a.name, a.a_value = 'a!', 10
+        b.name, b.b_value = 'b!', 'y'
+
+        TShardedTypedModel.objects.bulk_update(
+            [a, b], ['name', 'a_value', 'b_value']
+        )
+
+        a, b = TShardedTypedModel.objects.filter(
+            partner_id=PID).order_by('pk')
+        self.assertEqual((a.name, a.a_value), ('a!', 10))
+        self.assertEqual((b.name, b.b_value), ('b!', 'y'))
+
+    def test_count_by_type(self):
+        TShardedTypedModel.objects.bulk_create([
+            TShardedTypedA(partner_id=PID, a_value=1),
+            TShardedTypedA(partner_id=PID, a_value=2),
+            TShardedTypedB(partner_id=PID, b_value='x'),
+            TShardedTypedB(partner_id=OTHER_PID, b_value='x'),
+        ])
+
+        with self.assertNumQueries(1):
+            counts = TShardedTypedModel.objects.filter(
+                partner_id=PID).count_by_type()
+
+        self.assertEqual(counts, {TShardedTypedA: 2, TShardedTypedB: 1})
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {
+        'shardy.tshardedtypedmodel': {'read': 'default', 'write': 'writes'},
+    }},
+)
+class ShardedTypedWriteGroupTestCase(TestCase):
+    """Both tenants read from ``default``, each writes to a shard of its own"""
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+        self.addCleanup(setattr, ShardedPerTenantRouter, '_lookup_cache', {})
+        add_write_shards(self, ['writes__1', 'writes__2'])
+
+    def rows(self, alias):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT partner_id, name FROM {}'.format(
+                TShardedTypedModel._meta.db_table
+            ))
+            return sorted(cursor.fetchall())
+
+    def test_bulk_writes_go_to_the_write_shard_of_each_tenant(self):
+        objs = [
+            TShardedTypedA(pk=1, partner_id=1, name='a1', a_value=1),
+            TShardedTypedB(pk=2, partner_id=2, name='b2', b_value='x'),
+            TShardedTypedA(pk=3, partner_id=2, name='a2', a_value=2),
+        ]
+        TShardedTypedModel.objects.all().bulk_create(objs)
+        self.assertEqual(self.rows('writes__1'), [(1, 'a1')])
+        self.assertEqual(self.rows('writes__2'), [(2, 'a2'), (2, 'b2')])
+
+        for obj in objs:
+            obj.name = obj.name.upper()
+        TShardedTypedModel.objects.all().bulk_update(objs, ['name'])
+        self.assertEqual(self.rows('writes__1'), [(1, 'A1')])
+        self.assertEqual(self.rows('writes__2'), [(2, 'A2'), (2, 'B2')])
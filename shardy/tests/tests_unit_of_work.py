@@ -0,0 +1,161 @@
+from django.db import OperationalError, connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from shardy.db_routers import ShardedPerTenantRouter
+from shardy.middleware import UnitOfWorkMiddleware
+from shardy.unit_of_work import get_unit_of_work, unit_of_work
+from .models import (
+    TShardedModel, TSnowflakeItem, TSnowflakeModel, TStampedModel,
+)
+from .tests_health import add_broken_alias
+
+
+@override_settings(
+    DATABASE_ROUTERS=['shardy.db_routers.ShardedPerTenantRouter'],
+    DEFAULT_DB_GROUP='default',
+    DATABASE_CONFIG={'routing': {}},
+)
+class UnitOfWorkTestCase(TestCase):
+
+    def setUp(self):
+        ShardedPerTenantRouter._lookup_cache = {}
+
+    def names(self, model=TSnowflakeModel, partner_id=1):
+        return sorted(
+            model.objects.filter(partner_id=partner_id)
+            .values_list('name', flat=True)
+        )
+
+    def test_inserts_are_batched_per_shard(self):
+        with CaptureQueriesContext(connection) as context:
+            with unit_of_work() as unit:
+                for i in range(10):
+                    TSnowflakeModel(partner_id=1 + i % 2, name=str(i)).save()
+                self.assertEqual(len(unit), 10)
+                self.assertEqual(self.names(), [])
+
+        inserts = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('INSERT')
+        ]
+        # both tenants live on the default shard
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.names(), ['0', '2', '4', '6', '8'])
+        self.assertEqual(self.names(partner_id=2), ['1', '3', '5', '7', '9'])
+
+    def test_updates_merge_fields(self):
+        objs = [TSnowflakeModel(partner_id=1, name=str(i)) for i in range(3)]
+        TSnowflakeModel.objects.bulk_create(objs)
+        for obj in objs:
+            obj._state.adding = False
+
+        with CaptureQueriesContext(connection) as context:
+            with unit_of_work():
+                for obj in objs:
+                    obj.name = 'x' + obj.name
+                    obj.save(update_fields=['name'])
+                objs[0].save(update_fields=['name'])
+
+        updates = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.names(), ['x0', 'x1', 'x2'])
+
+    def test_updates_set_auto_now_fields(self):
+        obj = TStampedModel(partner_id=1, name='a')
+        obj.save()
+        modified = obj.modified
+
+        with unit_of_work():
+            obj.name = 'b'
+            obj.save()
+        self.assertGreater(obj.modified, modified)
+        stored = TStampedModel.objects.get(partner_id=1, pk=obj.pk)
+        self.assertEqual(stored.name, 'b')
+        self.assertEqual(stored.modified, obj.modified)
+
+        with unit_of_work():
+            obj.name = 'c'
+            obj.save(update_fields=['name', 'modified'])
+        stored = TStampedModel.objects.get(partner_id=1, pk=obj.pk)
+        self.assertEqual(stored.modified, obj.modified)
+
+    def test_deletes(self):
+        kept = TSnowflakeModel.objects.create(partner_id=1, name='kept')
+        deleted = TSnowflakeModel.objects.create(partner_id=1, name='deleted')
+
+        with self.assertNumQueries(0):
+            with unit_of_work() as unit:
+                never_written = TSnowflakeModel(partner_id=1, name='new')
+                never_written.save()
+                never_written.delete()
+                self.assertEqual(len(unit), 0)
+
+        with unit_of_work():
+            self.assertIsNone(deleted.delete())
+            # saving again cancels the delete
+            kept.delete()
+            kept.save()
+
+        self.assertEqual(self.names(), ['kept'])
+
+    def test_exception_drops_writes(self):
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                TSnowflakeModel(partner_id=1, name='a').save()
+                raise ValueError
+
+        self.assertEqual(self.names(), [])
+        self.assertIsNone(get_unit_of_work())
+
+    def test_nested_blocks_flush_once(self):
+        with unit_of_work() as outer:
+            with unit_of_work() as inner:
+                TSnowflakeModel(partner_id=1, name='a').save()
+            self.assertIs(inner, outer)
+            self.assertEqual(self.names(), [])
+        self.assertEqual(self.names(), ['a'])
+
+    def test_foreign_keys_of_new_instances(self):
+        with unit_of_work():
+            owner = TSnowflakeModel(partner_id=1, name='o')
+            owner.save()
+            item = TSnowflakeItem(partner_id=1, owner=owner, qty=3)
+            item.save()
+
+        self.assertIsNotNone(owner.pk)
+        self.assertEqual(
+            TSnowflakeItem.objects.get(partner_id=1, pk=item.pk).owner_id,
+            owner.pk
+        )
+
+    def test_backend_without_returned_ids(self):
+        with unit_of_work():
+            obj = TShardedModel(partner_id=1, name='a')
+            obj.save()
+            self.assertIsNone(obj.pk)
+
+        self.assertIsNotNone(obj.pk)
+        self.assertEqual(self.names(TShardedModel), ['a'])
+
+    def test_one_transaction_per_shard(self):
+        add_broken_alias(self)
+
+        with self.assertRaises(OperationalError):
+            with unit_of_work():
+                TSnowflakeModel(partner_id=1, name='a').save()
+                TSnowflakeModel(partner_id=2, name='b').save()
+
+        self.assertEqual(self.names(), ['a'])
+
+    def test_middleware(self):
+        def view(request):
+            TSnowflakeModel(partner_id=1, name='a').save()
+            self.assertEqual(len(get_unit_of_work()), 1)
+            return 'response'
+
+        self.assertEqual(UnitOfWorkMiddleware(view)(None), 'response')
+        self.assertEqual(self.names(), ['a'])
@@ -0,0 +1,242 @@
+# coding=utf-8
+"""Per-tenant in-memory cache of Adjacency List trees"""
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from django.apps import apps
+
+
+app = apps.get_app_config('shardy')
+
+# stored instead of a tree for tenants over SHARD_TREE_CACHE_MAX_NODES
+TOO_LARGE = object()
+
+
+class TenantTree(object):
+    """
+    Tree of one tenant flattened in DFS order. Row ``i`` holds the field
+    values of a node, ``parents[i]`` the row of its parent (-1 for roots),
+    ``depths[i]`` its depth and ``ends[i]`` the row after its last
+    descendant, so a subtree is the slice ``i:ends[i]``.
+
+    Nodes are built from the rows on every read, callers never share
+    instances.
+
+    The rows keep the values of every concrete field, not only the
+    structure and the pks: reads return full nodes without a query, which
+    a structure-only copy would need to fetch the rows. Memory grows with
+    the row width, bounded by SHARD_TREE_CACHE_MAX_NODES rows per tenant
+    and SHARD_TREE_CACHE_MAX_TENANTS tenants.
+    """
+
+    def __init__(self, model, alias, field_names, rows, parents, depths):
+        self.model = model
+        self.alias = alias
+        self.field_names = field_names
+        self.rows = rows
+        self.parents = array('i', parents)
+        self.depths = array('i', depths)
+        self.ends = array('i', range(1, len(rows) + 1))
+        for i in range(len(rows) - 1, -1, -1):
+            parent = self.parents[i]
+            if parent >= 0 and self.ends[i] > self.ends[parent]:
+                self.ends[parent] = self.ends[i]
+        pk_index = field_names.index(model._meta.pk.attname)
+        self.index = {row[pk_index]: i for i, row in enumerate(rows)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def load(cls, model, nodes, max_nodes):
+        """
+        Loads the tree with one query.
+
+        :param nodes: queryset of all the nodes of the tenant, in sibling
+            order
+        :returns: TenantTree or TOO_LARGE
+        """
+        field_names = [field.attname for field in model._meta.concrete_fields]
+        parent_index = field_names.index(model._meta.get_field('parent').attname)
+        pk_index = field_names.index(model._meta.pk.attname)
+
+        children = {}
+        count = 0
+        for row in nodes.values_list(*field_names)[:max_nodes + 1]:
+            children.setdefault(row[parent_index], []).append(row)
+            count += 1
+        if count > max_nodes:
+            return TOO_LARGE
+
+        rows, parents, depths = [], [], []
+        stack = [(row, -1, 1) for row in reversed(children.get(None, []))]
+        while stack:
+            row, parent, depth = stack.pop()
+            position = len(rows)
+            rows.append(row)
+            parents.append(parent)
+            depths.append(depth)
+            stack.extend(
+                (child, position, depth + 1)
+                for child in reversed(children.get(row[pk_index], []))
+            )
+        return cls(model, nodes.db, field_names, rows, parents, depths)
+
+    def node(self, i):
+        node = self.model.from_db(self.alias, self.field_names, self.rows[i])
+        node._cached_depth = self.depths[i]
+        return node
+
+    def nodes(self, positions):
+        return [self.node(i) for i in positions]
+
+    def position(self, pk):
+        """:returns: the row of the node or None if it's not in the tree"""
+        return self.index.get(pk)
+
+    def subtree(self, i):
+        """:returns: rows of the node and all its descendants, DFS ordered"""
+        return range(i, self.ends[i])
+
+    def children(self, i=None):
+        """:returns: rows of the children of the node, roots for None"""
+        if i is None:
+            j, end = 0, len(self.rows)
+        else:
+            j, end = i + 1, self.ends[i]
+        positions = []
+        while j < end:
+            positions.append(j)
+            j = self.ends[j]
+        return positions
+
+    def ancestors(self, i):
+        """:returns: rows of the ancestors of the node, the root first"""
+        positions = []
+        i = self.parents[i]
+        while i >= 0:
+            positions.append(i)
+            i = self.parents[i]
+        positions.reverse()
+        return positions
+
+
+class TreeCache(object):
+    """
+    Process local LRU of tenant trees, keyed by the concrete model and the
+    sharded value.
+
+    Writes of other processes are not seen: an entry lives at most
+    ``timeout`` seconds. A tree loaded while its tenant was invalidated is
+    not stored: set() compares the version read before the load with the
+    current one, under the lock.
+    """
+
+    def __init__(self, max_tenants=100, max_nodes=10000, timeout=None):
+        self.max_tenants = max_tenants
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._trees = OrderedDict()
+        # versions come from one counter, bumped by invalidate(); a tenant
+        # whose version was evicted gets the highest evicted one
+        self._versions = OrderedDict()
+        self._counter = 0
+        self._evicted = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    @staticmethod
+    def _key(model, shared_value):
+        return model._meta.concrete_model._meta.label, str(shared_value)
+
+    def version(self, model, shared_value):
+        """:returns: the version to pass to set() with the loaded tree"""
+        key = self._key(model, shared_value)
+        with self._lock:
+            return self._versions.get(key, self._evicted)
+
+    def get(self, model, shared_value):
+        """:returns: TenantTree, TOO_LARGE or None"""
+        key = self._key(model, shared_value)
+        with self._lock:
+            try:
+                expires_at, tree = self._trees[key]
+            except KeyError:
+                return None
+            if expires_at is not None and expires_at < time.time():
+                del self._trees[key]
+                return None
+            if tree is not TOO_LARGE and tree.model is not model:
+                # loaded for a proxy of the same table
+                return None
+            self._trees.move_to_end(key)
+            return tree
+
+    def set(self, model, shared_value, tree, version):
+        """
+        Stores the tree unless the tenant was invalidated since ``version``
+        was read.
+        """
+        key = self._key(model, shared_value)
+        expires_at = time.time() + self.timeout if self.timeout else None
+        with self._lock:
+            if self._versions.get(key, self._evicted) != version:
+                return
+            self._trees[key] = (expires_at, tree)
+            self._trees.move_to_end(key)
+            while len(self._trees) > self.max_tenants:
+                self._trees.popitem(last=False)
+
+    def invalidate(self, model, shared_value):
+        key = self._key(model, shared_value)
+        with self._lock:
+            self._trees.pop(key, None)
+            self._counter += 1
+            self._versions[key] = self._counter
+            self._versions.move_to_end(key)
+            while len(self._versions) > self.max_tenants:
+                _, version = self._versions.popitem(last=False)
+                self._evicted = max(self._evicted, version)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self._versions.clear()
+            # the trees being loaded are not stored
+            self._counter += 1
+            self._evicted = self._counter
+
+
+_tree_cache = None
+_tree_cache_lock = threading.Lock()
+
+
+def get_tree_cache(create=True):
+    """
+    :param create: build the cache from settings if it does not exist yet
+    :return: the process wide TreeCache or None
+    """
+    global _tree_cache
+    if _tree_cache is None and create:
+        with _tree_cache_lock:
+            if _tree_cache is None:
+                _tree_cache = TreeCache(
+                    app.settings.SHARD_TREE_CACHE_MAX_TENANTS,
+                    app.settings.SHARD_TREE_CACHE_MAX_NODES,
+                    app.settings.SHARD_TREE_CACHE_TIMEOUT,
+                )
+    return _tree_cache
+
+
+def invalidate_tree(model, shared_value):
+    """
+    Drops the cached tree of the tenant. Cheap no-op when no tree was cached
+    in this process.
+    """
+    cache = get_tree_cache(create=False)
+    if cache is not None:
+        cache.invalidate(model, shared_value)
@@ -0,0 +1,220 @@
+# coding=utf-8
+"""Buffered writes of sharded models, flushed per shard"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+
+
+_local = threading.local()
+
+
+class ShardWrites(object):
+    """Buffered writes of one db alias, grouped by concrete model"""
+
+    def __init__(self):
+        self.inserts = OrderedDict()
+        self.updates = OrderedDict()
+        self.deletes = OrderedDict()
+
+
+class UnitOfWork(object):
+    """
+    save() and delete() of ShardedPerTenantModel instances (with
+    ``buffer_writes``) registered while the unit is active, written on
+    flush() with one transaction per shard:
+
+    * new instances with one bulk insert per model,
+    * saved instances with one bulk update per model and set of fields,
+    * deleted instances with one delete per model.
+
+    Saving an instance again only merges its update fields, deleting an
+    instance that was never written drops it.
+    """
+
+    def __init__(self):
+        # id(instance) -> (instance, set of update fields or None for all)
+        self._saves = OrderedDict()
+        self._deletes = OrderedDict()
+
+    def __len__(self):
+        return len(self._saves) + len(self._deletes)
+
+    def add_save(self, instance, update_fields=None):
+        key = id(instance)
+        self._deletes.pop(key, None)
+        fields = None if update_fields is None else set(update_fields)
+        if key in self._saves:
+            previous = self._saves[key][1]
+            if previous is None or fields is None:
+                fields = None
+            else:
+                fields |= previous
+        self._saves[key] = (instance, fields)
+
+    def add_delete(self, instance):
+        key = id(instance)
+        self._saves.pop(key, None)
+        if not instance._state.adding:
+            self._deletes[key] = instance
+
+    def clear(self):
+        self._saves.clear()
+        self._deletes.clear()
+
+    def _group_by_shard(self):
+        """:return: OrderedDict alias -> ShardWrites"""
+        shards = OrderedDict()
+        for instance, fields in self._saves.values():
+            model = instance.__class__
+            alias = router.db_for_write(model, instance=instance)
+            writes = shards.setdefault(alias, ShardWrites())
+            concrete = model._meta.concrete_model
+            if instance._state.adding:
+                writes.inserts.setdefault(concrete, []).append(instance)
+            else:
+                key = concrete, None if fields is None else frozenset(fields)
+                writes.updates.setdefault(key, []).append(instance)
+        for instance in self._deletes.values():
+            model = instance.__class__
+            alias = router.db_for_write(model, instance=instance)
+            writes = shards.setdefault(alias, ShardWrites())
+            writes.deletes.setdefault(
+                model._meta.concrete_model, []
+            ).append(instance)
+        return shards
+
+    def flush(self):
+        """Writes the buffered changes, the buffer is emptied."""
+        from .cache import invalidate_tenant
+        from .identity_map import get_identity_map
+
+        shards = self._group_by_shard()
+        self.clear()
+        for alias, writes in shards.items():
+            with transaction.atomic(using=alias):
+                for model, objs in writes.inserts.items():
+                    _insert(alias, model, objs)
+                for (model, fields), objs in writes.updates.items():
+                    _update(alias, model, fields, objs)
+                for model, objs in writes.deletes.items():
+                    _shard_queryset(alias, model, objs).filter(
+                        pk__in=[obj.pk for obj in objs]
+                    ).delete()
+
+            identity_map = get_identity_map()
+            tenants = set()
+            for objs in (
+                    list(writes.inserts.values()) +
+                    list(writes.updates.values()) +
+                    list(writes.deletes.values())
+            ):
+                for obj in objs:
+                    tenants.add(obj.sharded_value)
+                    if identity_map is not None:
+                        identity_map.evict(obj)
+            for tenant in tenants:
+                invalidate_tenant(tenant)
+
+
+def _shard_queryset(alias, model, objs):
+    """:return: queryset of the tenants of ``objs``, pinned to ``alias``"""
+    queryset = model.objects.all().for_tenants(
+        {obj.sharded_value for obj in objs}
+    )
+    queryset._pinned_db = alias
+    return queryset
+
+
+def _attach_foreign_keys(objs):
+    """
+    Copies the pks of related instances inserted earlier in the flush to
+    the foreign key columns, what save() would refuse to do without them.
+    """
+    fields = [
+        field for field in objs[0]._meta.concrete_fields
+        if field.is_relation and field.many_to_one
+    ]
+    for field in fields:
+        for obj in objs:
+            if getattr(obj, field.attname) is None and field.is_cached(obj):
+                related = field.get_cached_value(obj)
+                if related is not None:
+                    setattr(obj, field.attname, related.pk)
+
+
+def _insert(alias, model, objs):
+    from .models.fields import assign_ids
+    from .querysets import ShardPerTenantQuerySet
+
+    _attach_foreign_keys(objs)
+    assign_ids(model, objs)
+    if model._meta.parents or not (
+            connections[alias].features.can_return_ids_from_bulk_insert or
+            all(obj.pk is not None for obj in objs)
+    ):
+        # multi-table inheritance or pks the database has to return
+        for obj in objs:
+            obj.save(using=alias, force_insert=True)
+        return
+    queryset = _shard_queryset(alias, model, objs)
+    # several tenants of the shard in one insert
+    super(ShardPerTenantQuerySet, queryset).bulk_create(objs)
+
+
+def _update(alias, model, fields, objs):
+    """
+    Bulk updates ``fields`` (all concrete ones when None) of ``objs``.
+    bulk_update() writes the attributes as they are, the pre_save() of the
+    fields runs first like in save(), so auto_now fields are set.
+    """
+    opts = model._meta
+    if fields is None:
+        fields = [
+            field for field in opts.concrete_fields if not field.primary_key
+        ]
+    else:
+        fields = [opts.get_field(name) for name in fields]
+    for obj in objs:
+        for field in fields:
+            setattr(obj, field.attname, field.pre_save(obj, False))
+    _shard_queryset(alias, model, objs).bulk_update(
+        objs, [field.name for field in fields]
+    )
+
+
+def get_unit_of_work():
+    """:return: the active UnitOfWork of the current thread or None"""
+    return getattr(_local, 'unit_of_work', None)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Buffers the writes of sharded models in the block and flushes them when
+    the outermost block exits without an exception; on an exception they
+    are dropped. Each shard is written in its own transaction, a failure on
+    one shard doesn't roll the others back.
+
+    Buffered saves send no pre_save/post_save signals, though the
+    pre_save() of the fields runs (auto_now fields are set); deletes send
+    their signals, like QuerySet.delete(). Models relying on save signals
+    should set ``buffer_writes = False``. New instances get their pks at
+    flush unless they use a SnowflakeField, and queries in the block don't
+    see the buffered changes.
+    """
+    current = get_unit_of_work()
+    if current is not None:
+        yield current
+        return
+
+    unit = _local.unit_of_work = UnitOfWork()
+    try:
+        yield unit
+    except BaseException:
+        _local.unit_of_work = None
+        unit.clear()
+        raise
+    _local.unit_of_work = None
+    unit.flush()
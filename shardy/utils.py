@@ -1,27 +1,22 @@
 # -*- coding: UTF-8 -*-
+from .tenants import get_tenant_registry
 
 
 def get_all_model_master_db_aliases(model):
     """
     Get all master db_aliases for sharded model
+    (tenants of the SHARD_TENANT_REGISTRY setting)
     :param model:
     :return:
     """
-    from skazka.stores.models import Store
-
-    enabled_partner_ids = Store.objects.only_enabled('id')
-
-    return set(model.get_db_alias(pid) for pid in enabled_partner_ids)
+    return get_tenant_registry().get_db_aliases(model)
 
 
 def get_all_model_replica_db_aliases(model):
     """
     Get all replication db_aliases for sharded model
+    (tenants of the SHARD_TENANT_REGISTRY setting)
     :param model:
     :return:
     """
-    from skazka.stores.models import Store
-
-    enabled_partner_ids = Store.objects.only_enabled('id')
-
-    return set(model.get_db_alias(pid, using='replica') for pid in enabled_partner_ids)
+    return get_tenant_registry().get_db_aliases(model, using='replica')